@@ -1,13 +1,39 @@
-from flask import Flask, flash, redirect, render_template, request, session, g
-from flask_session import Session
+from flask import Flask, Response, abort, flash, jsonify, redirect, render_template, request, send_file, session, stream_with_context, url_for, g
 from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import date
-from sqlalchemy import select, func, case
-from database import init_db, get_db, close_db
-from models import User, Account, Transaction, Category, Budget, Transfer
-from helpers import apology, login_required, usd, row_to_dict
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from database import init_db, get_db, close_db, engine, pool_status, rescale_user_money
+from models import User, Account, Transaction, Category, Budget, Transfer, RecurringRule
+from helpers import apology, login_required, metrics_required, usd, major, money_step, amount_step
+from money import DEFAULT_CURRENCY, MINOR_DIGITS, SYMBOLS, Money
+from cache import dashboard_cache
+from queries import (
+    TRANSACTION_FILTERS, decode_cursor, encode_cursor, parse_transaction_filters
+)
+import rollups
+import budget_states
+import ledger
+import archive
+import batch
+import search
+import recurring
+import charts
+import timeseries
+import pages
+import export
+import fx
+import refdata
+import sessions
+import jobs
+import tasks
+import profiling
 from dotenv import load_dotenv
+import click
+import hashlib
 import os
+import secrets
+import time
 
 load_dotenv()
 
@@ -15,22 +41,54 @@ app = Flask(__name__)
 
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 app.config["SESSION_COOKIE_SECURE"] = False
 app.config["SESSION_REFRESH_EACH_REQUEST"] = True
+sessions.init_session(app)
+app.config["TRANSACTIONS_PAGE_SIZE"] = int(os.getenv("TRANSACTIONS_PAGE_SIZE", 50))
+app.config["EXPORT_BATCH_SIZE"] = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+app.config["BATCH_MAX_ITEMS"] = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+# Bearer token for the /metrics endpoints; unset, they are not served
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
+
+# Upper bound for the ?per_page= override on paginated lists
+MAX_PAGE_SIZE = 500
 
 @app.before_request
 def before_request():
     g.db = get_db()
     g.theme = session.get('theme', 'light')
+    g.currency = refdata.currency(g.db, session["user_id"]) if "user_id" in session else DEFAULT_CURRENCY
+
+
+def write_currency():
+    """Take the write lock and re-read the user's currency for parsing amounts.
+
+    g.currency was read before the lock; change_currency needs the same
+    lock to rescale, so amounts parsed with the value returned here keep
+    their scale until the route commits or rolls back.
+    """
+    ledger.begin(g.db)
+    g.currency = refdata.currency(g.db, session["user_id"], for_update=True)
+    return g.currency
 
 app.jinja_env.filters["usd"] = usd
+app.jinja_env.filters["major"] = major
+app.jinja_env.globals["money_step"] = money_step
+app.jinja_env.globals["amount_step"] = amount_step
 
 with app.app_context():
     init_db()
 
+# Heavy per-user work (imports, background exports, rebuilds) runs on these workers
+job_queue = jobs.init_jobs(app, teardown=close_db)
+
+# Writes due recurring transactions in the background
+scheduler = recurring.init_scheduler(app, get_db, teardown=close_db)
+
+# Per-route query counts and DB time, served at /metrics
+profiler = profiling.init_profiling(app, engine)
+
 @app.before_request
 def before_request():
     g.db = get_db()
@@ -181,91 +239,15 @@ def home():
 
         session["account_id"] = main_account.id
 
-    account_id = session["account_id"]
-    current_month = date.today().strftime("%Y-%m")
-
-    # Get current account details
-    account = g.db.query(Account).filter_by(id=account_id, user_id=user_id).first()
-
-    if not account:
-        return apology("Account not found", 404)
-
-    account_balance = account.balance
-    account_name = account.name
-    account_type = account.type
-    # Get this month's income for THIS account only
-    monthly_income = g.db.query(
-        func.coalesce(func.sum(Transaction.amount), 0)
-    ).filter(
-        Transaction.user_id == user_id,
-        Transaction.account_id == account_id,
-        Transaction.type == 'income',
-        func.strftime('%Y-%m', Transaction.date) == current_month
-    ).scalar()
-
-    # Get this month's expenses for THIS account only
-    monthly_expense = g.db.query(
-        func.coalesce(func.sum(Transaction.amount), 0)
-    ).filter(
-        Transaction.user_id == user_id,
-        Transaction.account_id == account_id,
-        Transaction.type == 'expense',
-        func.strftime('%Y-%m', Transaction.date) == current_month
-    ).scalar()
-    # Calculate monthly net
-    monthly_net = monthly_income - monthly_expense
-
-    # Get budget alerts (spending across ALL accounts)
-    budget_alerts = g.db.query(
-        Category.name.label('category_name'),
-        Budget.monthly_limit.label('budget_limit'),
-        func.coalesce(func.sum(Transaction.amount), 0).label('spent'),
-        (func.coalesce(func.sum(Transaction.amount), 0) / Budget.monthly_limit * 100).label('percent')
-    )\
-    .select_from(Budget)\
-    .join(Category, Budget.category_id == Category.id)\
-    .outerjoin(
-        Transaction,
-        (Transaction.category_id == Category.id) &
-        (Transaction.user_id == user_id) &
-        (func.strftime('%Y-%m', Transaction.date) == current_month) &
-        (Transaction.type == 'expense')
-    )\
-    .filter(Budget.user_id == user_id, Budget.month == current_month)\
-    .group_by(Budget.id, Category.name, Budget.monthly_limit)\
-    .having((func.coalesce(func.sum(Transaction.amount), 0) / Budget.monthly_limit * 100) >= 80)\
-    .order_by((func.coalesce(func.sum(Transaction.amount), 0) / Budget.monthly_limit * 100).desc())\
-    .limit(5)\
-    .all()
-
-    # Get recent transactions for THIS account only
-    recent_transactions = g.db.query(
-        Transaction.id.label("id"),
-        Transaction.amount.label("amount"),
-        Transaction.date.label("date"),
-        Transaction.type.label("type"),
-        Transaction.person_name.label("person_name"),
-        Transaction.direction.label("direction"),
-        Category.name.label("name")
-    )\
-    .select_from(Transaction)\
-    .join(Category, Transaction.category_id == Category.id)\
-    .filter(Budget.user_id == user_id)\
-    .order_by(Transaction.date.desc(), Transaction.id.desc())\
-    .limit(8)\
-    .all()
-
-    return render_template('home.html',
-                         account_balance=account_balance,
-                         account_name=account_name,
-                         account_type=account_type,
-                         monthly_income=monthly_income,
-                         monthly_expenses=monthly_expense,
-                         monthly_net=monthly_net,
-                         budget_alerts=budget_alerts,
-                         recent_transactions=recent_transactions)
-
+    cache_key = (user_id, session["account_id"], date.today().strftime("%Y-%m"))
+    dashboard = dashboard_cache.get(cache_key, None)
+    if dashboard is None:
+        dashboard = pages.dashboard(pages.fetch(g.db, pages.dashboard_statements(*cache_key)))
+        if dashboard is None:
+            return apology("Account not found", 404)
+        dashboard_cache.set(cache_key, dashboard)
 
+    return render_template('home.html', **dashboard)
 
 
 @app.route('/logout')
@@ -280,24 +262,149 @@ def logout():
 @app.route('/transactions')
 @login_required
 def transactions():
+    filters, cursor, page_size = transactions_args()
+    rows = pages.fetch(g.db, pages.transactions_statements(session["user_id"], filters, cursor, page_size))
+    return render_transactions(rows['rows'], filters, cursor, page_size)
+
+
+def transactions_args():
+    """(filters, cursor, page_size) for /transactions from the query string"""
+    filters = parse_transaction_filters(request.args)
+    page_size = request.args.get("per_page", app.config["TRANSACTIONS_PAGE_SIZE"], type=int)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    return filters, decode_cursor(request.args.get("after")), page_size
+
+
+def render_transactions(rows, filters, cursor, page_size):
+    """transactions.html for a page of rows fetched with one extra row"""
     user_id = session["user_id"]
-    
-    transactions = g.db.query(
-        Transaction.id,
-        Transaction.amount,
-        Transaction.description,
-        Transaction.date,
-        Transaction.type,
-        Transaction.person_name,
-        Transaction.direction,
-        Category.name
-    )\
-    .outerjoin(Category, Transaction.category_id == Category.id)\
-    .filter(Transaction.user_id == user_id)\
-    .order_by(Transaction.date.desc())\
-    .all()
+    # Paging past the transactions table continues into archived years
+    rows = archive.page(g.db, user_id, rows, filters, cursor, page_size)
+    transactions = rows[:page_size]
+    filter_args = {key: request.args[key] for key in TRANSACTION_FILTERS if request.args.get(key)}
+    page_args = dict(filter_args)
+    if "per_page" in request.args:
+        page_args["per_page"] = page_size
+    next_url = None
+    if len(rows) > page_size:
+        next_url = url_for('transactions', after=encode_cursor(transactions[-1]), **page_args)
+
+    # Dropdown options for the filter form
+    accounts = refdata.accounts(g.db, user_id)
+    categories = sorted(refdata.categories(g.db, user_id), key=lambda c: (c.type, c.name))
+
+    return render_template('transactions.html',
+                         transactions=transactions,
+                         filters=filter_args,
+                         accounts=accounts,
+                         currencies={account.id: account.currency for account in accounts},
+                         categories=categories,
+                         next_url=next_url,
+                         first_url=url_for('transactions', **page_args) if cursor else None)
+
+
+@app.route('/api/transactions/search')
+@login_required
+def search_transactions():
+    query, filters, limit, offset = search_args()
+    if not query:
+        return jsonify(error="Missing search text (q)"), 400
+    rows = pages.fetch(g.db, pages.search_statements(session["user_id"], query, filters, limit, offset))
+    return search_response(rows['rows'], query, limit, offset)
+
+
+def search_args():
+    """(query, filters, limit, offset) for /api/transactions/search from the query string"""
+    filters = parse_transaction_filters(request.args)
+    limit = request.args.get("limit", app.config["TRANSACTIONS_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, request.args.get("offset", 0, type=int))
+    return filters.get('q', ''), filters, limit, offset
+
+
+def search_response(rows, query, limit, offset):
+    """JSON for a page of search results fetched with one extra row"""
+    currencies = {account.id: account.currency or g.currency for account in refdata.accounts(g.db, session["user_id"])}
+    return jsonify(
+        query=query,
+        results=[{
+            'id': row.id,
+            'date': row.date.isoformat(),
+            'type': row.type,
+            'amount': str(Money(row.amount, currencies.get(row.account_id, g.currency))),
+            'currency': currencies.get(row.account_id, g.currency),
+            'category': row.category,
+            'account_id': row.account_id,
+            'description': row.description,
+            'person_name': row.person_name,
+            'direction': row.direction,
+            'score': row.score,
+        } for row in rows[:limit]],
+        next_offset=offset + limit if len(rows) > limit else None
+    )
+
+
+# ====================
+# Export transactions
+# ====================
+@app.route('/export')
+@login_required
+def export_transactions():
+    fmt = request.args.get("format", "csv")
+    if fmt not in export.FORMATS:
+        return apology("Unsupported export format", 400)
+
+    compress = request.args.get("gzip") == "1"
+
+    if request.args.get("background") == "1":
+        # Write the file on a job worker and let the user download it when ready
+        job_id = job_queue.enqueue(
+            session["user_id"], "export", fmt=fmt, compress=compress,
+            filters={key: request.args[key] for key in TRANSACTION_FILTERS if request.args.get(key)},
+            batch_size=app.config["EXPORT_BATCH_SIZE"]
+        )
+        return redirect(url_for("job_status", job_id=job_id))
+
+    filters = parse_transaction_filters(request.args)
+    filename = f"transactions-{date.today().isoformat()}.{fmt}" + (".gz" if compress else "")
+
+    chunks = export.stream_export(
+        g.db, session["user_id"], filters, fmt, compress, app.config["EXPORT_BATCH_SIZE"], g.currency
+    )
+    return Response(
+        stream_with_context(chunks),
+        mimetype="application/gzip" if compress else export.FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+# ====================
+# Import transactions
+# ====================
+@app.route('/import', methods=["GET", "POST"])
+@login_required
+def import_transactions():
+    if request.method == "GET":
+        return render_template('import.html')
 
-    return render_template('transactions.html', transactions=transactions)
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return apology("Please choose a CSV file", 400)
+
+    dry_run = request.form.get('dry_run') == "1"
+
+    # The file outlives this request, so hand it to the import job on disk
+    name = f"upload-{session['user_id']}-{secrets.token_hex(8)}.csv"
+    try:
+        upload.save(tasks.file_path(name))
+        job_id = job_queue.enqueue(
+            session["user_id"], "import", upload=name, account_id=session.get("account_id"), dry_run=dry_run
+        )
+    except Exception as e:
+        print(f"Import error: {e}")
+        return apology("Import failed", 400)
+
+    return redirect(url_for("job_status", job_id=job_id))
 
 
 # ====================
@@ -307,19 +414,15 @@ def transactions():
 @login_required
 def add_transaction():
     if request.method == 'GET':
-        # Get user's accounts
-        accounts = g.db.query(Account).filter_by(user_id=session["user_id"]).all()
+        # Get user's accounts (balances are shown for transfers, so not cached)
+        accounts = g.db.query(Account.id, Account.name, Account.type, Account.balance, Account.currency)\
+            .filter_by(user_id=session["user_id"])\
+            .order_by(Account.created_at, Account.id)\
+            .all()
 
         # Get categories for dropdown
-        expense_categories = g.db.query(Category).filter(
-            (Category.user_id == session["user_id"]) | (Category.user_id == None),
-            Category.type == 'expense'
-        ).all()
-        
-        income_categories = g.db.query(Category).filter(
-            (Category.user_id == session["user_id"]) | (Category.user_id == None),
-            Category.type == 'income'
-        ).all()
+        expense_categories = refdata.categories(g.db, session["user_id"], 'expense')
+        income_categories = refdata.categories(g.db, session["user_id"], 'income')
 
         today = date.today()
 
@@ -338,9 +441,6 @@ def add_transaction():
         if not amount or not trans_type:
             return apology("Please enter all essential details", 400)
 
-        # Convert amount to float
-        amount = float(amount)
-
         # Handle TRANSFER transactions
         if trans_type == "transfer":
             from_account_id = request.form.get('from_account_id')
@@ -353,69 +453,89 @@ def add_transaction():
                 return apology("Cannot transfer to the same account", 400)
 
             # Verify both accounts belong to user
-            from_account = g.db.query(Account).filter_by(
-                id=from_account_id,
-                user_id=session["user_id"]
-            ).first()
-            
-            to_account = g.db.query(Account).filter_by(
-                id=to_account_id,
-                user_id=session["user_id"]
-            ).first()
+            from_account = refdata.find_account(g.db, session["user_id"], from_account_id)
+            to_account = refdata.find_account(g.db, session["user_id"], to_account_id)
 
             if not from_account or not to_account:
                 return apology("Invalid accounts", 400)
 
-            # Check sufficient balance
-            if from_account.balance < amount:
-                return apology("Insufficient balance in source account", 400)
+            # Exact integer minor units of the source account's currency
+            currency = write_currency()
+            try:
+                amount = parse_amount(amount, from_account.currency or currency)
+            except ValueError as e:
+                return apology(str(e), 400)
+
+            # Between currencies the destination gets the amount at the latest rate
+            try:
+                received = fx.rates(g.db).convert(
+                    amount.minor, amount.currency, to_account.currency or currency,
+                    date.today().strftime("%Y-%m"), closing=True
+                )
+            except fx.MissingRate as e:
+                return apology(str(e), 400)
+            if received <= 0:
+                return apology("Amount is too small to convert", 400)
 
             try:
+                ledger.begin(g.db)
+
                 # 1. Create transfer record in transfers table
                 new_transfer = Transfer(
                     user_id=session["user_id"],
-                    from_account_id=from_account_id,
-                    to_account_id=to_account_id,
-                    amount=amount,
+                    from_account_id=from_account.id,
+                    to_account_id=to_account.id,
+                    amount=amount.minor,
                     description=description
                 )
                 g.db.add(new_transfer)
 
-                # 2. Update account balances
-                from_account.balance -= amount
-                to_account.balance += amount
-
-                # 3. Create two transaction records for display in transaction history
+                # 2. Create two transaction records, which also move the balances
                 # Outgoing transaction (from source account)
                 outgoing_transaction = Transaction(
                     user_id=session["user_id"],
-                    account_id=from_account_id,
+                    account_id=from_account.id,
                     category_id=None,
-                    amount=amount,
+                    amount=amount.minor,
                     description=f"Transfer to {to_account.name}" + (f" - {description}" if description else ""),
                     type='expense',
                     person_name=to_account.name,
-                    direction=None
+                    direction=None,
+                    date=date.today()
                 )
                 g.db.add(outgoing_transaction)
+                rollups.record(g.db, outgoing_transaction)
+                # Only debited while the source balance covers it
+                ledger.record(g.db, outgoing_transaction, require_funds=True)
 
                 # Incoming transaction (to destination account)
                 incoming_transaction = Transaction(
                     user_id=session["user_id"],
-                    account_id=to_account_id,
+                    account_id=to_account.id,
                     category_id=None,
-                    amount=amount,
+                    amount=received,
                     description=f"Transfer from {from_account.name}" + (f" - {description}" if description else ""),
                     type='income',
                     person_name=from_account.name,
-                    direction=None
+                    direction=None,
+                    date=date.today()
                 )
                 g.db.add(incoming_transaction)
+                rollups.record(g.db, incoming_transaction)
+                ledger.record(g.db, incoming_transaction)
+                g.db.flush()
+                search.record(g.db, session["user_id"], [outgoing_transaction, incoming_transaction])
+                charts.mark_stale(g.db, session["user_id"], charts.charts_for('income', 'expense'))
 
                 g.db.commit()
-                flash(f"Transferred {amount} from {from_account.name} to {to_account.name}", "success")
+                dashboard_cache.invalidate(session["user_id"])
+                timeseries.invalidate(session["user_id"])
+                flash(f"Transferred {amount.format()} from {from_account.name} to {to_account.name}", "success")
                 return redirect("/transactions")
 
+            except ledger.InsufficientFunds as e:
+                g.db.rollback()
+                return apology(str(e), 400)
             except Exception as e:
                 g.db.rollback()
                 print(f"Transfer error: {e}")
@@ -428,14 +548,18 @@ def add_transaction():
             return apology("Please select an account", 400)
 
         # Validate account belongs to user
-        account = g.db.query(Account).filter_by(
-            id=account_id,
-            user_id=session["user_id"]
-        ).first()
-        
+        account = refdata.find_account(g.db, session["user_id"], account_id)
+
         if not account:
             return apology("Invalid account", 400)
 
+        # Exact integer minor units of the account's currency
+        currency = write_currency()
+        try:
+            amount = parse_amount(amount, account.currency or currency)
+        except ValueError as e:
+            return apology(str(e), 400)
+
         # Handle personal transactions
         if trans_type == "personal":
             person_name = request.form.get('person_name')
@@ -445,24 +569,29 @@ def add_transaction():
                 return apology("Please enter person name and direction", 400)
 
             try:
+                ledger.begin(g.db)
                 new_transaction = Transaction(
                     user_id=session['user_id'],
-                    account_id=account_id,
+                    account_id=account.id,
                     category_id=None,
-                    amount=amount,
+                    amount=amount.minor,
                     description=description,
                     type=trans_type,
                     person_name=person_name,
-                    direction=direction
+                    direction=direction,
+                    date=date.today()
                 )
                 g.db.add(new_transaction)
-
-                if direction == "lent":
-                    account.balance -= amount
-                else:  # borrowed
-                    account.balance += amount
+                rollups.record(g.db, new_transaction)
+                # Lent money leaves the account, borrowed money arrives
+                ledger.record(g.db, new_transaction)
+                g.db.flush()
+                search.record(g.db, session["user_id"], [new_transaction])
+                charts.mark_stale(g.db, session["user_id"], charts.charts_for(trans_type))
 
                 g.db.commit()
+                dashboard_cache.invalidate(session["user_id"])
+                timeseries.invalidate(session["user_id"])
                 return redirect("/transactions")
             except Exception as e:
                 g.db.rollback()
@@ -475,37 +604,105 @@ def add_transaction():
             if not category_name:
                 return apology("Please select a category", 400)
 
-            category = g.db.query(Category).filter_by(name=category_name).first()
+            category = refdata.find_category(g.db, session["user_id"], category_name, trans_type)
             if not category:
                 return apology("Invalid category", 400)
 
             category_id = category.id
 
             try:
+                ledger.begin(g.db)
                 new_transaction = Transaction(
                     user_id=session['user_id'],
-                    account_id=account_id,
+                    account_id=account.id,
                     category_id=category_id,
-                    amount=amount,
+                    amount=amount.minor,
                     description=description,
                     type=trans_type,
                     person_name=None,
-                    direction=None
+                    direction=None,
+                    date=date.today()
                 )
                 g.db.add(new_transaction)
-
-                if trans_type == "income":
-                    account.balance += amount
-                elif trans_type == "expense":
-                    account.balance -= amount
+                rollups.record(g.db, new_transaction)
+                budget_states.record(g.db, new_transaction)
+                ledger.record(g.db, new_transaction)
+                g.db.flush()
+                search.record(g.db, session["user_id"], [new_transaction])
+                charts.mark_stale(g.db, session["user_id"], charts.charts_for(trans_type))
 
                 g.db.commit()
+                dashboard_cache.invalidate(session["user_id"])
+                timeseries.invalidate(session["user_id"])
                 return redirect("/transactions")
             except Exception as e:
                 g.db.rollback()
                 print(f"Error: {e}")
                 return apology("Something went wrong", 400)
 
+def parse_amount(text, currency):
+    """Money from a form's amount field, or raise ValueError unless it is positive"""
+    amount = Money.parse(text, currency)
+    if amount.minor <= 0:
+        raise ValueError("Amount must be positive")
+    return amount
+
+# ====================
+# Batch transactions (JSON API)
+# ====================
+@app.route('/api/transactions/batch', methods=["POST"])
+@login_required
+def batch_transactions():
+    payload = request.get_json(silent=True)
+    entries = payload.get('transactions') if isinstance(payload, dict) else payload
+    if not isinstance(entries, list) or not entries:
+        return jsonify(error="Expected a JSON list of transactions"), 400
+    if len(entries) > app.config["BATCH_MAX_ITEMS"]:
+        return jsonify(error=f"A batch holds at most {app.config['BATCH_MAX_ITEMS']} transactions"), 413
+
+    key = request.headers.get("Idempotency-Key")
+    if key is not None:
+        key = key.strip()
+        if not key or len(key) > batch.MAX_KEY_LENGTH:
+            return jsonify(error=f"Idempotency-Key must be 1 to {batch.MAX_KEY_LENGTH} characters"), 400
+    request_hash = hashlib.sha256(request.get_data()).hexdigest()
+
+    user_id = session["user_id"]
+    if key:
+        stored = batch.replay(g.db, user_id, key)
+        if stored is not None:
+            return replayed_response(stored, request_hash)
+
+    try:
+        ok, results = batch.post_batch(g.db, user_id, entries)
+        if not ok:
+            g.db.rollback()
+            return jsonify(error="No transactions were saved", results=results), 422
+        body = {'created': len(results), 'results': results}
+        if key:
+            batch.remember(g.db, user_id, key, request_hash, 201, body)
+        g.db.commit()
+    except Exception as e:
+        g.db.rollback()
+        # A concurrent retry with the same key may have committed first
+        stored = batch.replay(g.db, user_id, key) if key else None
+        if stored is not None:
+            return replayed_response(stored, request_hash)
+        print(f"Batch transactions error: {e}")
+        return jsonify(error="Batch failed"), 400
+
+    dashboard_cache.invalidate(user_id)
+    timeseries.invalidate(user_id)
+    return jsonify(body), 201
+
+
+def replayed_response(stored, request_hash):
+    """The stored response for a retried Idempotency-Key, if it was sent with the same body"""
+    if stored.request_hash != request_hash:
+        return jsonify(error="Idempotency-Key was already used for a different batch"), 409
+    return Response(stored.response, status=stored.status, mimetype="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
 # ====================
 # Delete transactions
 # ====================
@@ -523,41 +720,25 @@ def delete_transaction():
     if not transaction or transaction.user_id != session["user_id"]:
         return apology("Unauthorized", 403)
 
-    # Extract transaction details
-    account_id = transaction.account_id
-    amount = transaction.amount
-    trans_type = transaction.type
-    direction = transaction.direction
-
-    # Update Account balance according to transaction type
+    # Delete it, then reverse its effect on the account balance
     try:
-        if trans_type == "income":
-            # Subtrat the money if income
-            g.db.query(Account)\
-                .filter_by(id=account_id)\
-                .update({"balance": Account.balance - amount})
-        elif trans_type == "expense":
-            # Add the money if expense
-            g.db.query(Account)\
-                .filter_by(id=account_id)\
-                .update({"balance": Account.balance + amount})
-        elif trans_type == "personal":
-            if direction == "lent":
-                # Add if lent
-                g.db.query(Account)\
-                    .filter_by(id=account_id)\
-                    .update({"balance": Account.balance + amount})
-            elif direction == "borrowed":
-                # Subtract if borrowed
-                g.db.query(Account)\
-                    .filter_by(id=account_id)\
-                    .update({"balance": Account.balance - amount})
-                
-        # Delete the transaction
-        g.db.query(Transaction)\
-            .filter_by(id=transaction_id)\
+        ledger.begin(g.db)
+        deleted = g.db.query(Transaction)\
+            .filter_by(id=transaction.id)\
             .delete()
+        # A concurrent request deleted it first and has already reversed it
+        if not deleted:
+            g.db.rollback()
+            return redirect("/transactions")
+
+        ledger.unrecord(g.db, transaction)
+        rollups.unrecord(g.db, transaction)
+        budget_states.unrecord(g.db, transaction)
+        search.unrecord(g.db, [transaction.id])
+        charts.mark_stale(g.db, session["user_id"], charts.charts_for(transaction.type))
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        timeseries.invalidate(session["user_id"])
     except Exception as e:
         g.db.rollback()
         print(f"Delete transaction error: {e}")
@@ -574,38 +755,8 @@ def delete_transaction():
 def budgets():
     if request.method == "GET":
         current_month = date.today().strftime("%Y-%m")
-
-        # Get all expense categories (preset + user-created)
-        categories = g.db.query(Category.name, Category.id).filter(
-            (Category.user_id == session['user_id']) | (Category.user_id == None),
-            Category.type == 'expense'
-        ).all()
-
-        # Get budgets for current month
-        budgets = g.db.query(Budget).filter_by(
-            user_id=session['user_id'],
-            month=current_month
-        ).all()
-
-        # Calculate spent amount for each category this month
-        spent = g.db.query(
-            Transaction.category_id,
-            func.sum(Transaction.amount).label('total_spent')
-        ).filter(
-            Transaction.user_id == session['user_id'],
-            Transaction.type == 'expense',
-            func.strftime('%Y-%m', Transaction.date) == current_month
-        ).group_by(Transaction.category_id).all()
-
-        # Convert to dictionaries for easier lookup in template
-        budgets_dict = {b.category_id: b.monthly_limit for b in budgets}
-        spent_dict = {s.category_id: s.total_spent for s in spent}
-
-        return render_template('budgets.html',
-                             current_month=current_month,
-                             categories=categories,
-                             budgets=budgets_dict,
-                             spent=spent_dict)
+        rows = pages.fetch(g.db, pages.budgets_statements(session['user_id'], current_month))
+        return render_budgets(rows, current_month)
 
     if request.method == "POST":
         current_month = date.today().strftime("%Y-%m")
@@ -614,40 +765,164 @@ def budgets():
 
         if not category_id or not monthly_limit:
             return apology("Please provide all fields", 400)
-    monthly_income = g.db.query(
-        func.coalesce(func.sum(Transaction.amount), 0)
-    ).filter(
-        Transaction.user_id == session["user_id"],
-        Transaction.account_id == session["account_id"],
-        Transaction.type == 'income',
-        func.strftime('%Y-%m', Transaction.date) == current_month
-    ).scalar()
-        # Check if budget already exists
-    existing_budget = g.db.query(Budget).filter_by(
-            user_id=session['user_id'],
-            category_id=category_id,
-            month=current_month
-        ).first()
-
-    if not existing_budget:
-        # Insert new budget
-        new_budget = Budget(
+        if not category_id.isdigit():
+            return apology("Invalid category", 400)
+        category_id = int(category_id)
+
+        try:
+            monthly_limit = Money.parse(monthly_limit, write_currency()).minor
+        except ValueError as e:
+            return apology(str(e), 400)
+        if monthly_limit <= 0:
+            return apology("Budget must be positive", 400)
+
+        try:
+            # Already taken by write_currency(): on SQLite no other request adds this budget meanwhile
+            ledger.begin(g.db)
+
+            # Check if budget already exists
+            existing_budget = g.db.query(Budget).filter_by(
                 user_id=session['user_id'],
                 category_id=category_id,
-                monthly_limit=monthly_limit,
                 month=current_month
-            )
-        g.db.add(new_budget)
-    else:
-        # Update existing budget
-        existing_budget.monthly_limit = monthly_limit
+            ).with_for_update().first()
+
+            if not existing_budget:
+                # Insert new budget
+                new_budget = Budget(
+                    user_id=session['user_id'],
+                    category_id=category_id,
+                    monthly_limit=monthly_limit,
+                    month=current_month
+                )
+                g.db.add(new_budget)
+            else:
+                # Update existing budget
+                existing_budget.monthly_limit = monthly_limit
+            g.db.flush()
+            budget_states.set_limit(g.db, session['user_id'], category_id, current_month, monthly_limit)
+
+            charts.mark_stale(g.db, session["user_id"], ('budget',))
+            g.db.commit()
+            dashboard_cache.invalidate(session["user_id"])
+        except IntegrityError:
+            # Another request created the same budget first (row locks only cover existing rows)
+            g.db.rollback()
+            return apology("This budget was just set by another request; please try again", 409)
+        except Exception as e:
+            g.db.rollback()
+            print(f"Budget error: {e}")
+            return apology("Something went wrong", 400)
+        return redirect('/budgets')
+
+# ====================
+# Recurring transactions
+# ====================
+@app.route('/recurring', methods=["GET", "POST"])
+@login_required
+def recurring_rules():
+    if request.method == "GET":
+        rules = g.db.query(RecurringRule, Account.name.label("account_name"), Account.currency.label("account_currency"),
+                           Category.name.label("category_name"))\
+            .join(Account, Account.id == RecurringRule.account_id)\
+            .outerjoin(Category, Category.id == RecurringRule.category_id)\
+            .filter(RecurringRule.user_id == session["user_id"])\
+            .order_by(RecurringRule.next_due.is_(None), RecurringRule.next_due, RecurringRule.id)\
+            .all()
+        return render_template('recurring.html',
+                             rules=rules,
+                             accounts=refdata.accounts(g.db, session["user_id"]),
+                             expense_categories=refdata.categories(g.db, session["user_id"], 'expense'),
+                             income_categories=refdata.categories(g.db, session["user_id"], 'income'),
+                             frequencies=recurring.FREQUENCIES,
+                             today=date.today())
+
+    trans_type = request.form.get("type")
+    amount = request.form.get("amount")
+    frequency = request.form.get("frequency")
+    if trans_type not in ('income', 'expense') or not amount or frequency not in recurring.FREQUENCIES:
+        return apology("Please provide all fields", 400)
+
+    account = refdata.find_account(g.db, session["user_id"], request.form.get("account_id"))
+    if not account:
+        return apology("Invalid account", 400)
+    currency = write_currency()
+    try:
+        amount = parse_amount(amount, account.currency or currency).minor
+    except ValueError as e:
+        return apology(str(e), 400)
+    category = refdata.find_category(g.db, session["user_id"], request.form.get("category"), trans_type)
+    if not category:
+        return apology("Invalid category", 400)
+
+    try:
+        interval = int(request.form.get("interval") or 1)
+        start_date = date.fromisoformat(request.form.get("start_date") or date.today().isoformat())
+        end_date = request.form.get("end_date")
+        end_date = date.fromisoformat(end_date) if end_date else None
+    except ValueError:
+        return apology("Invalid interval or date", 400)
+    if interval < 1:
+        return apology("Interval must be at least 1", 400)
+    if end_date is not None and end_date < start_date:
+        return apology("End date is before the start date", 400)
 
+    try:
+        ledger.begin(g.db)
+        rule = RecurringRule(
+            user_id=session["user_id"],
+            account_id=account.id,
+            category_id=category.id,
+            type=trans_type,
+            amount=amount,
+            description=request.form.get("description") or None,
+            frequency=frequency,
+            interval=interval,
+            start_date=start_date,
+            end_date=end_date,
+            occurrences=0,
+            next_due=start_date
+        )
+        g.db.add(rule)
+        g.db.flush()
+        # Occurrences up to today (a start date in the past) are written straight away
+        recurring.catch_up(g.db, session["user_id"], [rule])
+        g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        timeseries.invalidate(session["user_id"])
+    except Exception as e:
+        g.db.rollback()
+        print(f"Recurring rule error: {e}")
+        return apology("Something went wrong", 400)
+    return redirect('/recurring')
+
+
+@app.route('/delete_recurring', methods=["POST"])
+@login_required
+def delete_recurring():
+    # Transactions already written stay; only future occurrences are dropped
+    g.db.query(RecurringRule)\
+        .filter_by(id=request.form.get("rule_id"), user_id=session["user_id"])\
+        .delete()
     g.db.commit()
-    return redirect('/budgets')
+    return redirect('/recurring')
 
 # ====================
 # Settings
 # ====================
+def render_budgets(rows, current_month):
+    """budgets.html from budgets_statements() rows"""
+    # Get all expense categories (preset + user-created)
+    categories = refdata.categories(g.db, session['user_id'], 'expense')
+    budgets_dict, spent_dict, events = pages.budgets(rows)
+
+    return render_template('budgets.html',
+                         current_month=current_month,
+                         categories=categories,
+                         budgets=budgets_dict,
+                         spent=spent_dict,
+                         events=events)
+
 @app.route('/settings', methods=["GET"])
 @login_required
 def settings():
@@ -672,20 +947,23 @@ def settings():
     user_currency = user.currency if user else "USD"
 
     # Get user's custom categories
-    user_categories = g.db.query(Category)\
-        .filter_by(
-            user_id=current_account_id,
-            is_preset=0
-        )\
-        .order_by(Category.type, Category.name)\
-        .all()
+    user_categories = refdata.user_categories(g.db, user_id)
+
+    # Balances in every currency, summed at the latest rates
+    try:
+        net_worth = fx.net_worth(g.db, user_id)
+    except fx.MissingRate:
+        net_worth = None
 
     return render_template('settings.html',
                          accounts=accounts,
                          current_account_id=current_account_id,
                          current_account=current_account if current_account else None,
                          user_currency=user_currency,
-                         user_categories=user_categories)
+                         user_categories=user_categories,
+                         net_worth=net_worth,
+                         multi_currency=any(account.currency for account in accounts),
+                         currencies=SYMBOLS)
 
 # ====================
 # Switch account
@@ -700,12 +978,7 @@ def switch_account():
         return redirect("/settings")
 
     # Verify the account belongs to the user
-    account = g.db.query(Account)\
-        .filter_by(
-            id=new_account_id,
-            user_id=session["user_id"]
-        )\
-        .first()
+    account = refdata.find_account(g.db, session["user_id"], new_account_id)
 
     if not account:
         flash("Invalid account", "error")
@@ -713,6 +986,7 @@ def switch_account():
 
     # Update session with new account
     session["account_id"] = int(new_account_id)
+    dashboard_cache.invalidate(session["user_id"])
 
     # Flash success message
     flash(f"Switched to {account.name} successfully!", "success")
@@ -728,6 +1002,9 @@ def create_account():
     account_name = request.form.get('account_name')
     account_type = request.form.get('account_type')
     initial_balance = request.form.get('initial_balance')
+    # An account following the user's currency starts with a balance in it
+    home = write_currency()
+    currency = request.form.get('currency') or home
 
     if not account_name or not account_type:
         flash("Account name and type are required", "error")
@@ -739,19 +1016,35 @@ def create_account():
         flash("Invalid account type", "error")
         return redirect("/settings")
 
+    # Another currency can only be summed with the rest once its rates are known
+    if currency not in MINOR_DIGITS:
+        flash("Invalid currency", "error")
+        return redirect("/settings")
+    rates = fx.rates(g.db)
+    if currency != home and not (rates.has(currency) and rates.has(home)):
+        flash(f"No exchange rates for {currency}; import them first", "error")
+        return redirect("/settings")
+
     try:
-        initial_balance = float(initial_balance) if initial_balance else 0
+        initial_balance = Money.parse(initial_balance, currency).minor if initial_balance else 0
         account = Account(
             user_id=session["user_id"],
             name=account_name,
             type=account_type,
-            balance=initial_balance
+            # NULL follows the user's currency
+            currency=currency if currency != home else None,
+            balance=initial_balance,
+            opening_balance=initial_balance
         )
 
         g.db.add(account)
+        charts.mark_stale(g.db, session["user_id"], ('balances',))
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        refdata.invalidate(session["user_id"])
         flash(f"Account '{account_name}' created successfully!", "success")
     except Exception as e:
+        g.db.rollback()
         flash("Failed to create account", "error")
 
     return redirect("/settings")
@@ -770,12 +1063,7 @@ def rename_account():
         return redirect("/settings")
 
     # Verify account belongs to user
-    account = g.db.query(Account)\
-        .filter_by(
-            id=account_id,
-            user_id=session["user_id"]
-        )\
-        .first()
+    account = refdata.find_account(g.db, session["user_id"], account_id)
 
     if not account:
         flash("Account not found", "error")
@@ -785,7 +1073,10 @@ def rename_account():
         g.db.query(Account)\
             .filter_by(id=account_id)\
             .update({"name": new_name})
+        charts.mark_stale(g.db, session["user_id"], ('balances',))
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        refdata.invalidate(session["user_id"])
         flash(f"Account renamed to '{new_name}' successfully!", "success")
     except Exception as e:
         flash("Failed to rename account", "error")
@@ -805,12 +1096,7 @@ def delete_account():
         return redirect("/settings")
 
     # Verify that account belongs to user
-    account = g.db.query(Account)\
-        .filter_by(
-            id=account_id,
-            user_id=session["user_id"]
-        )\
-        .first()
+    account = refdata.find_account(g.db, session["user_id"], account_id)
 
     if not account:
         flash("Account not found", "error")
@@ -822,22 +1108,43 @@ def delete_account():
         return redirect("/settings")
 
     # Check if user has more than one account
-    account = g.db.query(func.coalesce(func.count(Account.id)).label("count")).filter_by(user_id=session["user_id"])
-    if account.count <= 1:
+    account_count = g.db.query(func.count(Account.id)).filter_by(user_id=session["user_id"]).scalar()
+    if account_count <= 1:
         flash("Cannot delete your only account", "error")
         return redirect("/settings")
 
     try:
+        ledger.begin(g.db)
+
         # Delete all transactions for this account
+        search.unrecord(g.db, select(Transaction.id).where(Transaction.account_id == account_id))
         g.db.query(Transaction)\
             .filter_by(account_id=account_id)\
             .delete()
+        archive.drop_account(g.db, session["user_id"], account_id)
+        budget_states.drop_account(g.db, session["user_id"], account_id)
+        rollups.drop_account(g.db, account_id)
+        ledger.drop_account(g.db, account_id)
+
+        # Its recurring rules go with it
+        g.db.query(RecurringRule)\
+            .filter_by(account_id=account_id)\
+            .delete()
+
+        # Delete transfer records that involve this account
+        g.db.query(Transfer)\
+            .filter((Transfer.from_account_id == account_id) | (Transfer.to_account_id == account_id))\
+            .delete()
 
         # Delete the account
         g.db.query(Account)\
             .filter_by(id=account_id)\
             .delete()
+        charts.mark_stale(g.db, session["user_id"])
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        timeseries.invalidate(session["user_id"])
+        refdata.invalidate(session["user_id"])
         flash("Account deleted successfully!", "success")
     except Exception as e:
         g.db.rollback()
@@ -899,13 +1206,36 @@ def change_currency():
         flash("Invalid currency", "error")
         return redirect("/settings")
 
+    # Accounts in other currencies are converted to the new one from now on
+    held = {account.currency for account in refdata.accounts(g.db, session["user_id"])} - {None}
+    missing = [currency for currency in sorted(held | {new_currency}) if not fx.rates(g.db).has(currency)]
+    if held - {new_currency} and missing:
+        flash(f"No exchange rates for {', '.join(missing)}; import them first", "error")
+        return redirect("/settings")
+
     try:
+        ledger.begin(g.db)
+        old_currency = refdata.currency(g.db, session["user_id"], for_update=True)
         g.db.query(User)\
             .filter_by(id=session["user_id"])\
             .update({"currency": new_currency})
+        # Amounts are minor units, so a different minor unit means rescaling
+        if rescale_user_money(g.db, session["user_id"], old_currency, new_currency):
+            rollups.regenerate(g.db, session["user_id"])
+            budget_states.regenerate(g.db, session["user_id"])
+            ledger.regenerate(g.db, session["user_id"])
+        elif held:
+            # Spending in the accounts' own currencies now converts to a different one
+            budget_states.regenerate(g.db, session["user_id"])
+        # Chart payloads are in major units of the currency
+        charts.mark_stale(g.db, session["user_id"])
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        timeseries.invalidate(session["user_id"])
+        refdata.invalidate(session["user_id"])
         flash(f"Currency changed to {new_currency} successfully!", "success")
     except Exception as e:
+        g.db.rollback()
         flash("Failed to change currency", "error")
 
     return redirect("/settings")
@@ -936,6 +1266,8 @@ def create_category():
         )
         g.db.add(new_category)
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        refdata.invalidate(session["user_id"])
 
         flash(f"Category '{category_name}' created successfully!", "success")
     except Exception as e:
@@ -957,27 +1289,47 @@ def delete_category():
         return redirect("/settings")
 
     # Verify category belongs to user and is not preset
-    category_id = g.db.query(Category)\
+    category = g.db.query(Category)\
         .filter_by(
             id=category_id,
             user_id=session["user_id"]
-        ).first().id
+        ).first()
 
-    if not category_id:
+    if not category:
         flash("Category not found or cannot be deleted", "error")
         return redirect("/settings")
 
+    category_id = category.id
+
     try:
         # Set category_id to NULL for transactions using this category
+        recategorized = [row.id for row in g.db.query(Transaction.id).filter_by(category_id=category_id)]
         g.db.query(Transaction)\
             .filter_by(category_id=category_id)\
             .update({"category_id": None})
+        search.refresh(g.db, Transaction.id.in_(recategorized))
+        rollups.uncategorize(g.db, session["user_id"], category_id)
+        archive.uncategorize(g.db, session["user_id"], category_id)
+
+        g.db.query(RecurringRule)\
+            .filter_by(category_id=category_id)\
+            .update({"category_id": None})
+
+        # Budgets for this category go with it
+        budget_states.drop_category(g.db, category_id)
+        g.db.query(Budget)\
+            .filter_by(category_id=category_id)\
+            .delete()
 
         # Delete the category
         g.db.query(Category)\
             .filter_by(id=category_id)\
             .delete()
+        charts.mark_stale(g.db, session["user_id"], ('budget', 'income_sources', 'expense_breakdown'))
         g.db.commit()
+        dashboard_cache.invalidate(session["user_id"])
+        timeseries.invalidate(session["user_id"])
+        refdata.invalidate(session["user_id"])
         flash("Category deleted successfully!", "success")
     except Exception as e:
         g.db.rollback()
@@ -991,83 +1343,447 @@ def delete_category():
 @app.route('/analytics')
 @login_required
 def analytics():
-    try:
-        from dateutil.relativedelta import relativedelta
+    # Chart data is fetched from /api/analytics/<chart> once the page is up
+    return render_template('analytics.html')
 
-        user_id = session["user_id"]
-        today = date.today()
-        twelve_months_ago = today - relativedelta(months=12)
-
-        # 1. Income vs Expense by Month
-        monthly_data = g.db.query(
-            func.strftime('%Y-%m', Transaction.date).label('month'),
-            func.sum(case((Transaction.type == 'income', Transaction.amount), else_=0)).label('income'),
-            func.sum(case((Transaction.type == 'expense', Transaction.amount), else_=0)).label('expense')
-        ).filter(
-            Transaction.user_id == user_id,
-            Transaction.date >= twelve_months_ago
-        ).group_by(func.strftime('%Y-%m', Transaction.date))\
-        .order_by(func.strftime('%Y-%m', Transaction.date)).all()
-
-        # 2. Budget vs Actual Spending
-        current_month = today.strftime("%Y-%m")
-        budget_data = g.db.query(
-            Category.name.label('category'),
-            Budget.monthly_limit.label('budget'),
-            func.coalesce(func.sum(Transaction.amount), 0).label('actual')
-        ).select_from(Budget)\
-        .join(Category, Budget.category_id == Category.id)\
-        .outerjoin(
-            Transaction,
-            (Transaction.category_id == Category.id) &
-            (Transaction.user_id == user_id) &
-            (func.strftime('%Y-%m', Transaction.date) == current_month) &
-            (Transaction.type == 'expense')
-        ).filter(Budget.user_id == user_id, Budget.month == current_month)\
-        .group_by(Category.name, Budget.monthly_limit)\
-        .order_by(Category.name).all()
-
-        # 3. Account Balance Over Time
-        account_balances = g.db.query(
-            Account.name,
-            Account.balance,
-            Account.created_at
-        ).filter_by(user_id=user_id)\
-        .order_by(Account.created_at).all()
-
-        # 4. Income Sources Breakdown
-        income_sources = g.db.query(
-            Category.name.label('category'),
-            func.sum(Transaction.amount).label('total')
-        ).select_from(Transaction)\
-        .join(Category, Transaction.category_id == Category.id)\
-        .filter(
-            Transaction.user_id == user_id,
-            Transaction.type == 'income',
-            Transaction.date >= twelve_months_ago
-        ).group_by(Category.name)\
-        .order_by(func.sum(Transaction.amount).desc()).all()
-
-        # 5. Expense Categories Breakdown
-        expense_breakdown = g.db.query(
-            Category.name.label('category'),
-            func.sum(Transaction.amount).label('total')
-        ).select_from(Transaction)\
-        .join(Category, Transaction.category_id == Category.id)\
-        .filter(
-            Transaction.user_id == user_id,
-            Transaction.type == 'expense',
-            Transaction.date >= twelve_months_ago
-        ).group_by(Category.name)\
-        .order_by(func.sum(Transaction.amount).desc()).all()
-
-        return render_template('analytics.html',
-            monthly_data=[row_to_dict(r) for r in monthly_data],
-            budget_data=[row_to_dict(r) for r in budget_data],
-            account_balances=[row_to_dict(r) for r in account_balances],
-            income_sources=[row_to_dict(r) for r in income_sources],
-            expense_breakdown=[row_to_dict(r) for r in expense_breakdown]
-        )
+
+@app.route('/api/analytics/<chart>')
+@login_required
+def analytics_data(chart):
+    if chart not in charts.CHARTS:
+        return jsonify(error="Unknown chart"), 404
+
+    try:
+        data, etag, updated_at = charts.payload(g.db, session["user_id"], chart, g.currency)
     except Exception as e:
+        g.db.rollback()
         print(f"Analytics error: {e}")
-        return apology("Could not load analytics", 400)
\ No newline at end of file
+        return jsonify(error="Could not load analytics"), 500
+
+    return chart_response(data, etag, updated_at)
+
+
+@app.route('/api/analytics/trends')
+@login_required
+def analytics_trends():
+    """Rolling averages, changes, category trends and a forecast from the cached columns"""
+    months = max(2, min(request.args.get("months", 24, type=int), timeseries.MAX_MONTHS))
+    horizon = max(1, min(request.args.get("horizon", 3, type=int), timeseries.MAX_HORIZON))
+    window = max(1, min(request.args.get("window", 30, type=int), timeseries.MAX_WINDOW))
+
+    try:
+        data = timeseries.trends(g.db, session["user_id"], months=months, horizon=horizon, window=window)
+    except Exception as e:
+        g.db.rollback()
+        print(f"Trends error: {e}")
+        return jsonify(error="Could not load analytics"), 500
+
+    return jsonify(chart='trends', currency=g.currency, data=data)
+
+
+def chart_response(data, etag, updated_at):
+    """A stored chart payload as a conditional JSON response"""
+    response = Response(data, mimetype="application/json")
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    # Let the browser keep the payload but revalidate it on every view
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# ====================
+# Background jobs
+# ====================
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None:
+        return apology("Job not found", 404)
+    return render_template('job.html', job=job)
+
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def job_json(job_id):
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job)
+
+
+@app.route('/api/jobs')
+@login_required
+def jobs_json():
+    return jsonify(jobs=job_queue.recent(session["user_id"]))
+
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def job_download(job_id):
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None or job["kind"] != "export" or job["status"] != "done":
+        abort(404)
+    path = tasks.file_path(job["result"]["file"])
+    if not path.exists():
+        return apology("This export has expired, please export again", 410)
+    return send_file(path.resolve(), mimetype=job["result"]["mimetype"], as_attachment=True,
+                     download_name=f"transactions-{date.today().isoformat()}{''.join(path.suffixes)}")
+
+
+@app.route('/jobs/rebuild', methods=["POST"])
+@login_required
+def rebuild_totals():
+    job_id = job_queue.enqueue(session["user_id"], "rebuild")
+    return redirect(url_for("job_status", job_id=job_id))
+
+
+# ====================
+# Balance on a date
+# ====================
+@app.route('/balance')
+@login_required
+def balance_on_date():
+    account_id = request.args.get("account_id", type=int)
+    day = request.args.get("date") or date.today().isoformat()
+    try:
+        day = date.fromisoformat(day)
+    except ValueError:
+        return jsonify(error="date must be YYYY-MM-DD"), 400
+
+    account = refdata.find_account(g.db, session["user_id"], account_id)
+    if account is None:
+        return jsonify(error="Account not found"), 404
+
+    currency = account.currency or g.currency
+    balance = Money(ledger.balance_as_of(g.db, session["user_id"], account_id, day), currency)
+    return jsonify(account_id=account_id, date=day.isoformat(), balance=str(balance), currency=currency)
+
+
+# ====================
+# Metrics
+# ====================
+@app.route('/metrics/cache')
+@metrics_required
+def cache_metrics():
+    return jsonify(dashboard=dashboard_cache.stats(), refdata=refdata.user_cache.stats(),
+                   timeseries=timeseries.series_cache.stats(), archive=archive.year_cache.stats())
+
+
+@app.route('/metrics/pool')
+@metrics_required
+def pool_metrics():
+    return jsonify(pool_status(engine))
+
+
+@app.route('/metrics')
+@metrics_required
+def prometheus_metrics():
+    """Query profiles, cache and pool statistics in the Prometheus text format"""
+    caches = {"dashboard": dashboard_cache.stats(), "refdata": refdata.user_cache.stats(),
+              "timeseries": timeseries.series_cache.stats(), "archive": archive.year_cache.stats()}
+    pool = pool_status(engine)
+    lines = profiling.prometheus(profiler)
+    lines += profiling.metric("fortuna_cache_hits_total", "counter", "Cache lookups that found an entry",
+                              [({"cache": name}, stats["hits"]) for name, stats in caches.items()])
+    lines += profiling.metric("fortuna_cache_misses_total", "counter", "Cache lookups that found nothing",
+                              [({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    lines += profiling.metric("fortuna_cache_entries", "gauge", "Entries held in each cache",
+                              [({"cache": name}, stats["size"]) for name, stats in caches.items()])
+    if "checked_out" in pool:
+        lines += profiling.metric("fortuna_pool_checked_out", "gauge", "Connections currently in use",
+                                  [({}, pool["checked_out"])])
+    if "checkouts" in pool:
+        lines += profiling.metric("fortuna_pool_checkouts_total", "counter", "Connection checkouts",
+                                  [({}, pool["checkouts"])])
+        lines += profiling.metric("fortuna_pool_timeouts_total", "counter", "Checkouts that timed out waiting",
+                                  [({}, pool["timeouts"])])
+        lines += profiling.metric("fortuna_pool_wait_seconds_total", "counter", "Time spent waiting for a connection",
+                                  [({}, pool["total_wait_ms"] / 1000)])
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# ====================
+# CLI: monthly rollups
+# ====================
+@app.cli.group("rollups")
+def rollups_cli():
+    """Maintain the monthly_rollups table"""
+
+
+@rollups_cli.command("rebuild")
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user's rollups")
+def rollups_rebuild(user_id):
+    """Regenerate rollups from the transactions table"""
+    rollups.rebuild(get_db(), user_id)
+    click.echo("Rollups rebuilt")
+
+
+@rollups_cli.command("verify")
+@click.option("--user-id", type=int, default=None, help="Only verify this user's rollups")
+def rollups_verify(user_id):
+    """Compare rollups against the transactions table"""
+    problems = rollups.verify(get_db(), user_id)
+    for key, expected, actual in problems:
+        click.echo(f"{key}: expected {expected}, found {actual}")
+    if problems:
+        raise SystemExit(f"{len(problems)} rollup bucket(s) out of sync")
+    click.echo("Rollups OK")
+
+
+# ====================
+# CLI: ledger
+# ====================
+@app.cli.group("ledger")
+def ledger_cli():
+    """Maintain account balances and balance_snapshots"""
+
+
+@ledger_cli.command("rebuild")
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user's balances")
+def ledger_rebuild(user_id):
+    """Regenerate balances and snapshots from the transactions table"""
+    ledger.rebuild(get_db(), user_id)
+    click.echo("Balances rebuilt")
+
+
+@ledger_cli.command("verify")
+@click.option("--user-id", type=int, default=None, help="Only verify this user's balances")
+def ledger_verify(user_id):
+    """Compare balances and snapshots against the transactions table"""
+    problems = ledger.verify(get_db(), user_id)
+    for what, key, expected, actual in problems:
+        click.echo(f"{what} {key}: expected {expected}, found {actual}")
+    if problems:
+        raise SystemExit(f"{len(problems)} balance(s) out of sync")
+    click.echo("Ledger OK")
+
+
+# ====================
+# CLI: budget states
+# ====================
+@app.cli.group("budgets")
+def budgets_cli():
+    """Maintain the budget_states table"""
+
+
+@budgets_cli.command("rebuild")
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user's budget states")
+def budgets_rebuild(user_id):
+    """Regenerate budget states from budgets and the transactions table"""
+    budget_states.rebuild(get_db(), user_id)
+    click.echo("Budget states rebuilt")
+
+
+@budgets_cli.command("verify")
+@click.option("--user-id", type=int, default=None, help="Only verify this user's budget states")
+def budgets_verify(user_id):
+    """Compare budget states against budgets and the transactions table"""
+    problems = budget_states.verify(get_db(), user_id)
+    for key, expected, actual in problems:
+        click.echo(f"{key}: expected {expected}, found {actual}")
+    if problems:
+        raise SystemExit(f"{len(problems)} budget state(s) out of sync")
+    click.echo("Budget states OK")
+
+
+# ====================
+# CLI: exchange rates
+# ====================
+@app.cli.group("fx")
+def fx_cli():
+    """Maintain the exchange rates of accounts held in other currencies"""
+
+
+@fx_cli.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--base", default=None, help=f"Currency the file's rates are quoted against (default {fx.FX_BASE})")
+def fx_import(path, base):
+    """Load daily rates from a local CSV file (date,currency,rate or one column per currency)"""
+    db = get_db()
+    with open(path, "rb") as stream:
+        result = fx.import_rates(db, stream, base)
+    for line, message in result['errors']:
+        click.echo(f"line {line}: {message}")
+    if result['errors']:
+        db.rollback()
+        raise SystemExit(f"{len(result['errors'])} error(s); no rates imported")
+    db.commit()
+
+    # Budgets and charts of users with accounts in other currencies were converted at the old rates
+    users = db.scalars(
+        select(Account.user_id).join(User, Account.user_id == User.id)
+        .where(Account.currency.is_not(None), Account.currency != User.currency)
+        .distinct()
+    ).all()
+    for user_id in users:
+        budget_states.regenerate(db, user_id)
+        charts.mark_stale(db, user_id)
+        db.commit()
+    click.echo(f"Imported {result['rates']:,} rates for {result['days']:,} days "
+               f"({', '.join(result['currencies'])}); {len(users)} user(s) updated")
+
+
+# ====================
+# CLI: search index
+# ====================
+@app.cli.group("search")
+def search_cli():
+    """Maintain the full-text transaction search index"""
+
+
+@search_cli.command("rebuild")
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user's entries")
+def search_rebuild(user_id):
+    """Regenerate the search index from the transactions table"""
+    if not search.enabled:
+        raise SystemExit("Full-text search needs SQLite with FTS5")
+    search.rebuild(get_db(), user_id)
+    click.echo("Search index rebuilt")
+
+
+@search_cli.command("verify")
+@click.option("--user-id", type=int, default=None, help="Only verify this user's entries")
+def search_verify(user_id):
+    """Compare the search index against the transactions table"""
+    if not search.enabled:
+        raise SystemExit("Full-text search needs SQLite with FTS5")
+    problems = search.verify(get_db(), user_id)
+    for what, transaction_id in problems[:100]:
+        click.echo(f"{what} transaction {transaction_id}")
+    if problems:
+        raise SystemExit(f"{len(problems)} search entries out of sync")
+    click.echo("Search index OK")
+
+
+# ====================
+# CLI: cold storage
+# ====================
+@app.cli.group("archive")
+def archive_cli():
+    """Move closed years of transactions to compressed files and back"""
+
+
+@archive_cli.command("run")
+@click.option("--user-id", type=int, default=None, help="Only archive this user's transactions")
+@click.option("--before", type=int, default=None,
+              help=f"Archive years before this one (default the current year minus {archive.KEEP_YEARS})")
+def archive_run(user_id, before):
+    """Move transactions of closed years out of the transactions table, one user per commit"""
+    db = get_db()
+    before = before or archive.cutoff()
+    if user_id is None:
+        users = db.execute(
+            select(Transaction.user_id).where(Transaction.date < date(before, 1, 1)).distinct()
+        ).scalars().all()
+    else:
+        users = [user_id]
+    total = 0
+    for owner in users:
+        ledger.begin(db)
+        moved = archive.run(db, owner, before)
+        db.commit()
+        if moved:
+            total += sum(moved.values())
+            years = ", ".join(f"{year}: {count:,}" for year, count in sorted(moved.items()))
+            click.echo(f"user {owner}: {years}")
+    click.echo(f"Archived {total:,} transaction(s) of {len(users)} user(s) dated before {before}")
+
+
+@archive_cli.command("restore")
+@click.option("--user-id", type=int, required=True)
+@click.option("--year", type=int, required=True)
+def archive_restore(user_id, year):
+    """Put an archived year back into the transactions table"""
+    db = get_db()
+    ledger.begin(db)
+    restored = archive.restore(db, user_id, year)
+    db.commit()
+    if not restored:
+        raise SystemExit(f"User {user_id} has no archived {year}")
+    click.echo(f"Restored {restored:,} transaction(s) of {year}")
+
+
+@archive_cli.command("verify")
+@click.option("--user-id", type=int, default=None, help="Only verify this user's archive")
+def archive_verify(user_id):
+    """Check every archived file against its archived_years row and archived_totals"""
+    problems = archive.verify(get_db(), user_id)
+    for what, key, expected, actual in problems[:100]:
+        click.echo(f"{what} {key}: expected {expected}, found {actual}")
+    if problems:
+        raise SystemExit(f"{len(problems)} archive problem(s)")
+    click.echo("Archive OK")
+
+
+# ====================
+# CLI: recurring transactions
+# ====================
+@app.cli.group("recurring")
+def recurring_cli():
+    """Write due recurring transactions"""
+
+
+@recurring_cli.command("run")
+@click.option("--date", "today", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Write occurrences due up to this date (default today)")
+def recurring_run(today):
+    """Catch up every rule that is due, e.g. from cron with RECURRING_INTERVAL=0"""
+    result = recurring.run_due(get_db(), today.date() if today else None)
+    click.echo(f"{result['transactions']} transactions written for {result['rules']} rules of {result['users']} users")
+    if result['failed']:
+        raise SystemExit(f"{result['failed']} user(s) failed and will be retried tomorrow")
+
+
+# ====================
+# CLI: background jobs
+# ====================
+@app.cli.group("jobs")
+def jobs_cli():
+    """Run and maintain the background job queue"""
+
+
+@jobs_cli.command("work")
+@click.option("--workers", type=int, default=None, help="Worker threads (default JOBS_WORKERS, at least 1)")
+def jobs_work(workers):
+    """Process jobs in the foreground, e.g. when the web app runs with JOBS_WORKERS=0"""
+    job_queue.workers = workers or max(job_queue.workers, 1)
+    job_queue.start()
+    click.echo(f"Processing jobs with {job_queue.workers} worker(s); Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        job_queue.stop(timeout=5)
+
+
+@jobs_cli.command("sweep")
+@click.option("--days", type=float, default=7, help="Delete jobs finished more than this many days ago")
+def jobs_sweep(days):
+    """Delete old finished jobs and their export files"""
+    removed = job_queue.store.sweep(time.time() - days * 86400)
+    for row in removed:
+        result = jobs.job_dict(row)["result"] or {}
+        if isinstance(result, dict) and result.get("file"):
+            tasks.file_path(result["file"]).unlink(missing_ok=True)
+    click.echo(f"Removed {len(removed)} job(s); {job_queue.store.counts()}")
+
+
+# ====================
+# CLI: sessions
+# ====================
+@app.cli.group("sessions")
+def sessions_cli():
+    """Maintain server-side session storage"""
+
+
+@sessions_cli.command("sweep")
+def sessions_sweep():
+    """Delete expired sessions from the SQLite session store"""
+    interface = app.session_interface
+    if not isinstance(interface, sessions.SqliteSessionInterface):
+        click.echo(f"Nothing to sweep for the '{app.config['SESSION_BACKEND']}' backend")
+        return
+    removed = interface.store.sweep()
+    click.echo(f"Removed {removed} expired session(s), {interface.store.count()} remaining")
@@ -0,0 +1,518 @@
+"""Cold storage for closed years of transactions.
+
+`flask archive run` moves a user's transactions dated before the last
+KEEP_YEARS years out of the transactions table into one compressed
+columnar file per user and year under ARCHIVE_DIR: parallel NumPy arrays
+(id, day number, amount, type and direction codes, account and category
+ids, description and person name) sorted by (day, id) and written with
+numpy.savez_compressed. The transactions table, its indexes and the full-
+text index then hold only recent years, so their size and the cost of
+queries over them stop growing with the age of an account.
+
+Nothing derived from the moved transactions changes: their rollups,
+balance snapshots and budget states stay where they are, so every total
+and chart reads exactly as before. archived_totals keeps what each
+archived month adds up to, and the rollup, ledger and budget rebuilds add
+it to what they read from the transactions table.
+
+Reads that reach into archived years merge the files in: the transaction
+list (records() and page(), newest first behind the same keyset cursor),
+exports, trend analytics and balances on a past date. Archived rows are
+read-only; the search box matches them by substring rather than by word.
+
+A file is never rewritten in place. Every change to a year writes a new
+file and points its archived_years row at it inside the caller's
+database transaction; the replaced file is deleted once that transaction
+commits, and the new one if it rolls back instead. Files are therefore
+immutable and cached by name in year_cache. Transactions added later
+with a date in an archived year stay in the table until the next run.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+import heapq
+from itertools import islice
+import os
+from pathlib import Path
+import uuid
+import numpy as np
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.orm import Session
+from cache import MISSING, TTLCache
+from models import Account, ArchivedTotal, ArchivedYear, Transaction
+import refdata
+import search
+
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", "data/archive"))
+# Years kept in the transactions table besides the current one
+KEEP_YEARS = int(os.getenv("ARCHIVE_KEEP_YEARS", 1))
+# Rows inserted per statement when a year is restored
+BATCH_SIZE = 1000
+
+TYPES = ('income', 'expense', 'personal')
+DIRECTIONS = (None, 'lent', 'borrowed')
+FIELDS = ('id', 'day', 'amount', 'type', 'direction', 'account_id', 'category_id', 'description', 'person_name')
+EPOCH = date(1970, 1, 1)
+
+transactions = Transaction.__table__
+archived_years = ArchivedYear.__table__
+archived_totals = ArchivedTotal.__table__
+
+# Files never change once written, so an entry is only dropped to make room
+year_cache = TTLCache(
+    maxsize=int(os.getenv("ARCHIVE_CACHE_SIZE", 32)),
+    ttl=float(os.getenv("ARCHIVE_CACHE_TTL", 3600))
+)
+
+# Session.info keys of the files a database transaction wrote and replaced
+WRITTEN = "archive_written"
+REPLACED = "archive_replaced"
+
+# An archived transaction in the shape of a transaction list row
+Record = namedtuple('Record', 'id account_id amount description date type person_name direction name archived')
+
+
+class Year:
+    """One archived year of a user's transactions as parallel arrays sorted by (day, id).
+
+    Missing account and category ids are -1, a missing description or
+    person name is ''.
+    """
+
+    __slots__ = FIELDS
+
+    def __init__(self, arrays):
+        order = np.lexsort((arrays['id'], arrays['day']))
+        for name in FIELDS:
+            setattr(self, name, np.asarray(arrays[name])[order])
+
+    def __len__(self):
+        return len(self.id)
+
+    def arrays(self, keep=slice(None)):
+        """{field: array} of the rows selected by `keep`, ready to be stored again"""
+        return {name: getattr(self, name)[keep] for name in FIELDS}
+
+    def between(self, first, last):
+        """Slice of the rows dated from `first` to `last`"""
+        start, stop = np.searchsorted(self.day, (day_number(first), day_number(last) + 1))
+        return slice(int(start), int(stop))
+
+
+def day_number(day):
+    return (day - EPOCH).days
+
+
+def cutoff(today=None):
+    """First year kept in the transactions table"""
+    return (today or date.today()).year - KEEP_YEARS
+
+
+def path(user_id, name):
+    return ARCHIVE_DIR / str(user_id) / name
+
+
+def _months(year):
+    return f"{year}-01", f"{year}-12"
+
+
+# ====================
+# Files
+# ====================
+def _columns(rows):
+    """{field: array} from (id, date, amount, type, direction, account_id, category_id, description, person_name) rows"""
+    ids, days, amounts, types, directions, accounts, categories, descriptions, people = zip(*rows) if rows else ((),) * 9
+    return {
+        'id': np.array(ids, dtype=np.int64),
+        'day': np.array([day_number(day) for day in days], dtype=np.int32),
+        'amount': np.array(amounts, dtype=np.int64),
+        'type': np.array([TYPES.index(t) for t in types], dtype=np.int8),
+        'direction': np.array([DIRECTIONS.index(d) for d in directions], dtype=np.int8),
+        'account_id': np.array([-1 if a is None else a for a in accounts], dtype=np.int64),
+        'category_id': np.array([-1 if c is None else c for c in categories], dtype=np.int64),
+        'description': np.array([d or '' for d in descriptions], dtype=str),
+        'person_name': np.array([p or '' for p in people], dtype=str),
+    }
+
+
+def _write(db, user_id, year, arrays):
+    """Write a year's arrays to a new file, deleted again if the transaction rolls back; returns its name"""
+    folder = ARCHIVE_DIR / str(user_id)
+    folder.mkdir(parents=True, exist_ok=True)
+    name = f"{year}-{uuid.uuid4().hex[:12]}.npz"
+    db.info.setdefault(WRITTEN, []).append(folder / name)
+    with open(folder / name, 'wb') as out:
+        np.savez_compressed(out, **arrays)
+    return name
+
+
+def read(user_id, name):
+    """The Year stored in one of a user's files"""
+    key = (user_id, name)
+    cached = year_cache.get(key)
+    if cached is MISSING:
+        with np.load(path(user_id, name)) as data:
+            cached = Year({field: data[field] for field in FIELDS})
+        year_cache.set(key, cached)
+    return cached
+
+
+@event.listens_for(Session, "after_commit")
+def _committed(session):
+    """The new files are live: delete the ones they replaced"""
+    session.info.pop(WRITTEN, None)
+    for replaced in session.info.pop(REPLACED, ()):
+        replaced.unlink(missing_ok=True)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discarded(session, transaction):
+    """A transaction ended without committing: delete the files it wrote and keep the old ones"""
+    if transaction.parent is not None:
+        return
+    session.info.pop(REPLACED, None)
+    for written in session.info.pop(WRITTEN, ()):
+        written.unlink(missing_ok=True)
+
+
+# ====================
+# Archived years
+# ====================
+def years(db, user_id, for_update=False):
+    """The user's archived_years rows, newest first"""
+    query = select(archived_years).where(archived_years.c.user_id == user_id).order_by(archived_years.c.year.desc())
+    if for_update:
+        query = query.with_for_update()
+    return db.execute(query).all()
+
+
+def load(db, user_id):
+    """Every archived Year of the user, oldest first"""
+    return [read(user_id, entry.file) for entry in reversed(years(db, user_id))]
+
+
+def _totals(user_id, arrays):
+    """archived_totals rows summarizing a year's arrays"""
+    if not len(arrays['id']):
+        return []
+    months = arrays['day'].astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    keys = np.stack([arrays['account_id'], arrays['category_id'], arrays['type'].astype(np.int64),
+                     arrays['direction'].astype(np.int64), months], axis=1)
+    buckets, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    totals = np.zeros(len(buckets), dtype=np.int64)
+    np.add.at(totals, inverse, arrays['amount'])
+    counts = np.bincount(inverse, minlength=len(buckets))
+    return [{
+        'user_id': user_id,
+        'account_id': None if account_id < 0 else int(account_id),
+        'category_id': None if category_id < 0 else int(category_id),
+        'type': TYPES[trans_type],
+        'direction': DIRECTIONS[direction],
+        'month': f"{1970 + month // 12}-{month % 12 + 1:02d}",
+        'total': int(total),
+        'count': int(count),
+    } for (account_id, category_id, trans_type, direction, month), total, count in zip(buckets.tolist(), totals, counts)]
+
+
+def _store(db, user_id, year, arrays, current=None):
+    """Make `arrays` the user's archived `year`, replacing the archived_years row `current`.
+
+    Empty arrays remove the year. The year's archived_totals are
+    recomputed from the arrays; the caller commits.
+    """
+    first, last = _months(year)
+    db.execute(delete(archived_totals).where(
+        archived_totals.c.user_id == user_id, archived_totals.c.month.between(first, last)
+    ))
+    if current is not None:
+        db.info.setdefault(REPLACED, []).append(path(user_id, current.file))
+    count = len(arrays['id'])
+    if not count:
+        if current is not None:
+            db.execute(delete(archived_years).where(archived_years.c.id == current.id))
+        return
+
+    values = {'file': _write(db, user_id, year, arrays), 'count': count, 'archived_at': datetime.now()}
+    if current is None:
+        db.execute(insert(archived_years).values(user_id=user_id, year=year, **values))
+    else:
+        db.execute(update(archived_years).where(archived_years.c.id == current.id).values(values))
+    db.execute(insert(archived_totals), _totals(user_id, arrays))
+
+
+def _rewrite(db, user_id, change):
+    """Store change(year) for every archived year where it returns new arrays (None leaves the year alone)"""
+    for entry in years(db, user_id, for_update=True):
+        arrays = change(read(user_id, entry.file))
+        if arrays is not None:
+            _store(db, user_id, entry.year, arrays, entry)
+
+
+def run(db, user_id, before=None):
+    """Move the user's transactions dated before the year `before` into their archive.
+
+    `before` defaults to cutoff() and never goes past the current year.
+    Rows dated in an already archived year are merged into its file.
+    Returns {year: transactions moved}; the caller commits, inside a write
+    transaction (ledger.begin()) so no row is added meanwhile.
+    """
+    before = min(before or cutoff(), date.today().year)
+    first = db.execute(
+        select(func.min(transactions.c.date))
+        .where(transactions.c.user_id == user_id, transactions.c.date < date(before, 1, 1))
+    ).scalar()
+    if first is None:
+        return {}
+    stored = {entry.year: entry for entry in years(db, user_id, for_update=True)}
+
+    moved = {}
+    for year in range(first.year, before):
+        conditions = (
+            transactions.c.user_id == user_id,
+            transactions.c.date >= date(year, 1, 1),
+            transactions.c.date < date(year + 1, 1, 1),
+        )
+        rows = db.execute(
+            select(transactions.c.id, transactions.c.date, transactions.c.amount, transactions.c.type,
+                   transactions.c.direction, transactions.c.account_id, transactions.c.category_id,
+                   transactions.c.description, transactions.c.person_name)
+            .where(*conditions)
+        ).all()
+        if not rows:
+            continue
+        arrays = _columns(rows)
+        current = stored.get(year)
+        if current is not None:
+            held = read(user_id, current.file)
+            arrays = {name: np.concatenate([getattr(held, name), arrays[name]]) for name in FIELDS}
+        _store(db, user_id, year, Year(arrays).arrays(), current)
+        search.unrecord(db, select(transactions.c.id).where(*conditions))
+        db.execute(delete(transactions).where(*conditions))
+        moved[year] = len(rows)
+    return moved
+
+
+def restore(db, user_id, year):
+    """Put an archived year back into the transactions table; returns the number of rows. The caller commits."""
+    current = next((entry for entry in years(db, user_id, for_update=True) if entry.year == year), None)
+    if current is None:
+        return 0
+    held = read(user_id, current.file)
+    rows = [{
+        'id': int(held.id[i]),
+        'user_id': user_id,
+        'account_id': None if held.account_id[i] < 0 else int(held.account_id[i]),
+        'category_id': None if held.category_id[i] < 0 else int(held.category_id[i]),
+        'amount': int(held.amount[i]),
+        'description': str(held.description[i]) or None,
+        'date': EPOCH + timedelta(days=int(held.day[i])),
+        'type': TYPES[held.type[i]],
+        'person_name': str(held.person_name[i]) or None,
+        'direction': DIRECTIONS[held.direction[i]],
+    } for i in range(len(held))]
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = rows[start:start + BATCH_SIZE]
+        db.execute(insert(transactions), batch)
+        search.record(db, user_id, batch)
+    _store(db, user_id, year, held.arrays(slice(0)), current)
+    return len(rows)
+
+
+def drop_account(db, user_id, account_id):
+    """Forget a deleted account's archived transactions; call before the account row is deleted"""
+    account_id = int(account_id)
+
+    def change(held):
+        mine = held.account_id == account_id
+        return held.arrays(~mine) if mine.any() else None
+    _rewrite(db, user_id, change)
+
+
+def uncategorize(db, user_id, category_id):
+    """Leave a deleted category's archived transactions uncategorized"""
+    category_id = int(category_id)
+
+    def change(held):
+        mine = held.category_id == category_id
+        if not mine.any():
+            return None
+        arrays = held.arrays()
+        arrays['category_id'] = np.where(mine, -1, held.category_id)
+        return arrays
+    _rewrite(db, user_id, change)
+
+
+def rescale(db, user_id, shift):
+    """Shift archived amounts of accounts following the user's currency by `shift` decimal digits.
+
+    Rounds half away from zero, like rescale_user_money() does in SQL.
+    """
+    following = [account_id for account_id, in db.execute(
+        select(Account.id).where(Account.user_id == user_id, Account.currency.is_(None))
+    )]
+
+    def change(held):
+        amounts = held.amount
+        if shift > 0:
+            scaled = amounts * 10 ** shift
+        else:
+            divisor = 10 ** -shift
+            scaled = np.sign(amounts) * ((np.abs(amounts) + divisor // 2) // divisor)
+        arrays = held.arrays()
+        arrays['amount'] = np.where(np.isin(held.account_id, following + [-1]), scaled, amounts)
+        return arrays
+    _rewrite(db, user_id, change)
+
+
+def verify(db, user_id=None):
+    """Return a list of (what, key, expected, actual) for every archived year whose file or totals disagree"""
+    query = select(archived_years)
+    if user_id is not None:
+        query = query.where(archived_years.c.user_id == user_id)
+    problems = []
+    for entry in db.execute(query.order_by(archived_years.c.user_id, archived_years.c.year)):
+        key = (entry.user_id, entry.year)
+        try:
+            held = read(entry.user_id, entry.file)
+        except (OSError, ValueError, KeyError) as e:
+            problems.append(('file', key, entry.file, str(e)))
+            continue
+        if len(held) != entry.count:
+            problems.append(('count', key, entry.count, len(held)))
+
+        first, last = _months(entry.year)
+        columns = ('account_id', 'category_id', 'type', 'direction', 'month')
+        expected = {tuple(row[c] for c in columns): (row['total'], row['count'])
+                    for row in _totals(entry.user_id, held.arrays())}
+        actual = {}
+        for row in db.execute(
+            select(archived_totals).where(archived_totals.c.user_id == entry.user_id,
+                                          archived_totals.c.month.between(first, last))
+        ):
+            bucket = tuple(getattr(row, c) for c in columns)
+            total, count = actual.get(bucket, (0, 0))
+            actual[bucket] = (total + row.total, count + row.count)
+        for bucket in sorted(expected.keys() | actual.keys(), key=str):
+            if expected.get(bucket) != actual.get(bucket):
+                problems.append(('total', (entry.user_id,) + bucket, expected.get(bucket), actual.get(bucket)))
+
+        # An archived id must not be in the table at all, whatever its user or date, or restore() fails
+        clash = 0
+        for start in range(0, len(held), BATCH_SIZE):
+            ids = [int(i) for i in held.id[start:start + BATCH_SIZE]]
+            clash += db.execute(select(func.count()).where(transactions.c.id.in_(ids))).scalar()
+        if clash:
+            problems.append(('duplicate', key, 0, clash))
+    return problems
+
+
+def max_id(db):
+    """Largest transaction id in any archived year, 0 without any"""
+    largest = 0
+    for entry in db.execute(select(archived_years.c.user_id, archived_years.c.file)):
+        held = read(entry.user_id, entry.file)
+        if len(held):
+            largest = max(largest, int(held.id.max()))
+    return largest
+
+
+# ====================
+# Reads
+# ====================
+def _match(held, filters, cursor, names):
+    """Positions in `held` of the rows passing the transaction list filters and the cursor, oldest first"""
+    keep = np.ones(len(held), dtype=bool)
+    if 'start' in filters:
+        keep &= held.day >= day_number(filters['start'])
+    if 'end' in filters:
+        keep &= held.day <= day_number(filters['end'])
+    if 'type' in filters:
+        keep &= held.type == TYPES.index(filters['type'])
+    if 'account_id' in filters:
+        keep &= held.account_id == filters['account_id']
+    if 'category_id' in filters:
+        keep &= held.category_id == filters['category_id']
+    if cursor:
+        day = day_number(cursor[0])
+        keep &= (held.day < day) | ((held.day == day) & (held.id < cursor[1]))
+    if 'q' in filters:
+        text = filters['q'].lower()
+        named = [category_id for category_id, name in names.items() if text in name.lower()]
+        keep &= (
+            (np.char.find(np.char.lower(held.description), text) >= 0)
+            | (np.char.find(np.char.lower(held.person_name), text) >= 0)
+            | np.isin(held.category_id, named)
+        )
+    return np.flatnonzero(keep)
+
+
+def _in_range(entry, filters, cursor):
+    if cursor and entry.year > cursor[0].year:
+        return False
+    if 'start' in filters and entry.year < filters['start'].year:
+        return False
+    return not ('end' in filters and entry.year > filters['end'].year)
+
+
+def records(db, user_id, filters, cursor=None, stored=None):
+    """The user's archived transactions passing `filters` and older than `cursor`, newest first.
+
+    Files are read one year at a time, only as far as the caller iterates.
+    """
+    names = None
+    for entry in years(db, user_id) if stored is None else stored:
+        if not _in_range(entry, filters, cursor):
+            continue
+        if names is None:
+            names = {category.id: category.name for category in refdata.categories(db, user_id)}
+        held = read(user_id, entry.file)
+        for i in _match(held, filters, cursor, names)[::-1]:
+            category_id = int(held.category_id[i])
+            yield Record(
+                id=int(held.id[i]),
+                account_id=None if held.account_id[i] < 0 else int(held.account_id[i]),
+                amount=int(held.amount[i]),
+                description=str(held.description[i]) or None,
+                date=EPOCH + timedelta(days=int(held.day[i])),
+                type=TYPES[held.type[i]],
+                person_name=str(held.person_name[i]) or None,
+                direction=DIRECTIONS[held.direction[i]],
+                name=names.get(category_id),
+                archived=True,
+            )
+
+
+def count(db, user_id, filters):
+    """Number of archived transactions passing `filters`"""
+    stored = [entry for entry in years(db, user_id) if _in_range(entry, filters, None)]
+    if not filters:
+        return sum(entry.count for entry in stored)
+    names = {category.id: category.name for category in refdata.categories(db, user_id)}
+    return sum(len(_match(read(user_id, entry.file), filters, None, names)) for entry in stored)
+
+
+def page(db, user_id, rows, filters, cursor, page_size):
+    """A page of transaction list rows (fetched with one extra row) with archived ones merged in"""
+    stored = years(db, user_id)
+    limit = page_size + 1
+    # A full page of rows newer than every archived year needs no file
+    if not stored or (len(rows) == limit and rows[-1].date.year > stored[0].year):
+        return rows
+    older = islice(records(db, user_id, filters, cursor, stored), limit)
+    merged = heapq.merge(rows, older, key=lambda row: (row.date, row.id), reverse=True)
+    return list(islice(merged, limit))
+
+
+def net(db, user_id, account_id, first, last):
+    """Ledger total (income and borrowing add) of an account's archived transactions dated `first` to `last`"""
+    total = 0
+    for entry in years(db, user_id):
+        if not first.year <= entry.year <= last.year:
+            continue
+        held = read(user_id, entry.file)
+        span = held.between(first, last)
+        mine = held.account_id[span] == account_id
+        amounts = held.amount[span][mine]
+        adds = (held.type[span][mine] == TYPES.index('income')) | (held.direction[span][mine] == DIRECTIONS.index('borrowed'))
+        total += int(np.where(adds, amounts, -amounts).sum())
+    return total
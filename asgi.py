@@ -0,0 +1,345 @@
+"""Optional ASGI entry point: async read routes in front of the Flask app.
+
+    uvicorn asgi:application
+
+The read-only pages (/, /transactions, /budgets GET, /analytics, the
+search API and the stored chart payloads under /api/analytics/) run as
+coroutines on an async engine (aiosqlite for SQLite), so a request waiting
+on the database does not hold a thread, and the dashboard's independent
+queries are issued concurrently. Each still runs inside a Flask request context, so sessions,
+before/after-request hooks and templates behave exactly as in WSGI mode.
+The parts that stay synchronous and may touch the database (the
+before/after-request hooks, reference data lookups and archived years
+while rendering) run on the thread pool below, not in the event loop.
+
+Everything else - every write route, and any read that would have to
+write (a first visit that creates the Main Account, a stale chart that
+must be recomputed) - is handed unchanged to the Flask WSGI app on a pool
+of ASGI_THREADS threads, so writes keep their transactional semantics.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from datetime import date
+from functools import wraps
+import io
+import os
+import sys
+from flask import jsonify, redirect, render_template, session
+from app import (
+    app, apology, chart_response, profiler, render_budgets, render_transactions, search_args, search_response,
+    transactions_args
+)
+from cache import dashboard_cache
+from database import close_db, make_async_engine
+import charts
+import pages
+
+# Returned by an async view to pass the request to the WSGI app instead
+DELEGATE = object()
+
+
+def wsgi_environ(scope, body=b""):
+    """PEP 3333 environ for an ASGI HTTP scope"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return bytes(body)
+
+
+class WsgiBridge:
+    """Run a WSGI app for ASGI requests on a thread pool.
+
+    The whole request, including iterating a streamed response, stays on
+    one thread so thread-local sessions and stream_with_context work as
+    they do under a WSGI server. Chunks are passed back through a small
+    queue, so large exports are streamed rather than buffered.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        environ = wsgi_environ(scope, await read_body(receive))
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=8)
+        started = {}
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+        def run():
+            try:
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    put(("start", None))
+                    for chunk in result:
+                        if chunk:
+                            put(("body", chunk))
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                put(("end", None))
+            except BaseException as e:
+                put(("error", e))
+
+        loop.run_in_executor(self.executor, run)
+        finished = False
+        # One chunk is held back so the last one goes out with more_body=False:
+        # the response is complete as soon as the client has all of its bytes
+        pending = b""
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "start":
+                    await send({"type": "http.response.start", "status": started["status"],
+                                "headers": started["headers"]})
+                elif kind == "body":
+                    if pending:
+                        await send({"type": "http.response.body", "body": pending, "more_body": True})
+                    pending = value
+                elif kind == "end":
+                    finished = True
+                    await send({"type": "http.response.body", "body": pending, "more_body": False})
+                    return
+                else:
+                    finished = True
+                    raise value
+        finally:
+            if not finished:
+                # Client went away mid-stream: let the worker thread run to completion
+                asyncio.ensure_future(self._drain(queue))
+
+    @staticmethod
+    async def _drain(queue):
+        while (await queue.get())[0] not in ("end", "error"):
+            pass
+
+
+async def send_response(response, environ, send):
+    """Send a Flask response; get_wsgi_response drops the body of 304s and HEAD requests"""
+    app_iter, status, headers = response.get_wsgi_response(environ)
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": b"".join(app_iter)})
+
+
+def login_required(view):
+    """helpers.login_required for coroutine views"""
+    @wraps(view)
+    async def decorated(*args, **kwargs):
+        if session.get("user_id") is None:
+            return redirect("/account")
+        return await view(*args, **kwargs)
+    return decorated
+
+
+class AsyncReads:
+    """ASGI application: coroutine views for reads, the Flask app for the rest"""
+
+    def __init__(self, flask_app, engine=None, threads=None):
+        self.app = flask_app
+        self.engine = engine
+        self.wsgi = WsgiBridge(flask_app.wsgi_app, threads or int(os.getenv("ASGI_THREADS", 16)))
+        self.routes = {
+            "/": self.home,
+            "/transactions": self.transactions,
+            "/budgets": self.budgets,
+            "/analytics": self.analytics,
+            "/api/transactions/search": self.search,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        view, args = None, ()
+        if scope["method"] == "GET":
+            path = scope["path"]
+            view = self.routes.get(path)
+            if view is None and path.startswith("/api/analytics/"):
+                view, args = self.chart, (path.rsplit("/", 1)[1],)
+        if view is None or not await self.dispatch(scope, send, view, args):
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start_engine()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.engine is not None:
+                    await self.engine.dispose()
+                self.wsgi.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def blocking(self, func, *args):
+        """Run sync code that may query the database on the thread pool, in this request's context.
+
+        The worker thread's scoped session is removed afterwards, and the
+        context variables the code set (the query profile) are carried back.
+        """
+        context = contextvars.copy_context()
+
+        def run():
+            try:
+                return context.run(func, *args)
+            finally:
+                close_db()
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.wsgi.executor, run)
+        finally:
+            for var, value in context.items():
+                if var.get(None) is not value:
+                    var.set(value)
+
+    def start_engine(self):
+        if self.engine is None:
+            self.engine = make_async_engine()
+            if profiler.sample_rate > 0:
+                profiler.instrument(self.engine.sync_engine)
+
+    async def dispatch(self, scope, send, view, args):
+        """Run a coroutine view the way Flask's full_dispatch_request runs a view.
+
+        Returns False, having sent nothing, when the view delegates.
+        """
+        self.start_engine()
+        app = self.app
+        environ = wsgi_environ(scope)
+        ctx = app.request_context(environ)
+        ctx.push()
+        try:
+            try:
+                try:
+                    rv = await self.blocking(app.preprocess_request)
+                    if rv is None:
+                        rv = await view(*args)
+                        if rv is DELEGATE:
+                            # The WSGI app profiles the request when it runs it
+                            profiler.discard()
+                            return False
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = await self.blocking(app.finalize_request, rv)
+            except Exception as e:
+                response = app.handle_exception(e)
+            await send_response(response, environ, send)
+            return True
+        finally:
+            ctx.pop()
+
+    # ====================
+    # Views
+    # ====================
+    async def home(self):
+        if "user_id" not in session:
+            return render_template('account.html')
+        if "account_id" not in session:
+            # The first visit may create the Main Account
+            return DELEGATE
+
+        cache_key = (session["user_id"], session["account_id"], date.today().strftime("%Y-%m"))
+        dashboard = dashboard_cache.get(cache_key, None)
+        if dashboard is None:
+            dashboard = pages.dashboard(await pages.fetch_async(self.engine, pages.dashboard_statements(*cache_key)))
+            if dashboard is None:
+                return apology("Account not found", 404)
+            dashboard_cache.set(cache_key, dashboard)
+
+        return render_template('home.html', **dashboard)
+
+    @login_required
+    async def transactions(self):
+        filters, cursor, page_size = transactions_args()
+        rows = await pages.fetch_async(
+            self.engine, pages.transactions_statements(session["user_id"], filters, cursor, page_size)
+        )
+        return await self.blocking(render_transactions, rows['rows'], filters, cursor, page_size)
+
+    @login_required
+    async def search(self):
+        query, filters, limit, offset = search_args()
+        if not query:
+            return jsonify(error="Missing search text (q)"), 400
+        rows = await pages.fetch_async(
+            self.engine, pages.search_statements(session["user_id"], query, filters, limit, offset)
+        )
+        return await self.blocking(search_response, rows['rows'], query, limit, offset)
+
+    @login_required
+    async def budgets(self):
+        current_month = date.today().strftime("%Y-%m")
+        rows = await pages.fetch_async(self.engine, pages.budgets_statements(session['user_id'], current_month))
+        return await self.blocking(render_budgets, rows, current_month)
+
+    @login_required
+    async def analytics(self):
+        return render_template('analytics.html')
+
+    @login_required
+    async def chart(self, chart):
+        if chart not in charts.CHARTS:
+            # Not a stored payload (/api/analytics/trends, or an unknown name the Flask route rejects)
+            return DELEGATE
+        rows = await pages.fetch_async(self.engine, {'payload': charts.stored(session["user_id"], chart)})
+        row = rows['payload'][0] if rows['payload'] else None
+        if not charts.is_current(row):
+            # Recomputing writes the new payload, which is the WSGI route's job
+            return DELEGATE
+        return chart_response(row.data, row.etag, row.updated_at)
+
+
+application = AsyncReads(app)
@@ -0,0 +1,255 @@
+"""Batch transaction entry for API clients.
+
+A batch is a JSON list of income, expense, personal and transfer entries
+(the fields /add_transaction takes, plus an optional date). Every entry is
+validated against account and category maps loaded once per batch; if any
+entry is invalid nothing is written and each entry's result says why.
+Otherwise all rows are inserted with executemany, and rollup and balance
+changes are accumulated and applied once per bucket and account-month,
+inside the caller's single database transaction.
+
+A transfer must be covered by its source account's balance at that point
+in the batch, so earlier entries in the same batch count. Amounts are in
+the currency of the entry's (source) account; a transfer between
+currencies credits the converted amount at the closing rate of its month.
+
+A client may send an Idempotency-Key with a batch. The response to the
+first successful request with that key is stored in the same transaction
+as the rows it created, and a retry with the same key and body gets that
+response back instead of posting the batch again.
+"""
+from datetime import date, datetime, timedelta
+import json
+import os
+from sqlalchemy import delete, insert, select
+from models import Account, IdempotencyKey, Transaction, Transfer
+from money import Money
+import budget_states
+import charts
+import fx
+import ledger
+import refdata
+import rollups
+import search
+
+ENTRY_TYPES = ('income', 'expense', 'personal', 'transfer')
+# Stored responses are replayed for this long after their batch committed
+IDEMPOTENCY_TTL = timedelta(hours=float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", 24)))
+MAX_KEY_LENGTH = 255
+
+keys = IdempotencyKey.__table__
+
+
+def _lookup_maps(db, user_id):
+    accounts = {account.id: account for account in refdata.accounts(db, user_id)}
+    # Presets come first so a user's custom category wins on a name clash
+    categories = {
+        (category.type, category.name.strip().lower()): category.id
+        for category in refdata.categories(db, user_id)
+    }
+    return accounts, categories
+
+
+def _text(entry, name):
+    value = entry.get(name)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f"{name} must be a string")
+    return value.strip() or None
+
+
+def _account(entry, name, accounts):
+    value = entry.get(name)
+    if value is None or value == "":
+        raise ValueError(f"{name} is required")
+    try:
+        account = accounts.get(int(value))
+    except (TypeError, ValueError):
+        account = None
+    if account is None:
+        raise ValueError(f"unknown {name} {value!r}")
+    return account
+
+
+def _amount(value, currency):
+    try:
+        amount = Money.parse(value, currency).minor
+    except ValueError as e:
+        raise ValueError(f"amount: {e}")
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+    return amount
+
+
+def _parse_entry(entry, user_id, accounts, categories, currency, rates, today):
+    """Rows one batch entry writes: (transfer values or None, [transaction values]), or raise ValueError"""
+    if not isinstance(entry, dict):
+        raise ValueError("entry must be an object")
+
+    trans_type = (_text(entry, 'type') or '').lower()
+    if trans_type not in ENTRY_TYPES:
+        raise ValueError(f"type must be one of {', '.join(ENTRY_TYPES)}")
+
+    amount = entry.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str)):
+        raise ValueError("amount is required")
+
+    day = _text(entry, 'date')
+    try:
+        day = date.fromisoformat(day) if day else today
+    except ValueError:
+        raise ValueError("date must be YYYY-MM-DD")
+
+    description = _text(entry, 'description')
+
+    if trans_type == 'transfer':
+        from_account = _account(entry, 'from_account_id', accounts)
+        to_account = _account(entry, 'to_account_id', accounts)
+        if from_account.id == to_account.id:
+            raise ValueError("cannot transfer to the same account")
+        amount = _amount(amount, from_account.currency or currency)
+        try:
+            received = rates.convert(amount, from_account.currency or currency, to_account.currency or currency,
+                                     day.strftime("%Y-%m"), closing=True)
+        except fx.MissingRate as e:
+            raise ValueError(str(e))
+        if received <= 0:
+            raise ValueError("amount is too small to convert")
+        suffix = f" - {description}" if description else ""
+        transfer = {
+            'user_id': user_id, 'from_account_id': from_account.id, 'to_account_id': to_account.id,
+            'amount': amount, 'date': day, 'description': description,
+        }
+        # The same pair of entries /add_transaction writes for a transfer
+        return transfer, [
+            {'user_id': user_id, 'account_id': from_account.id, 'category_id': None, 'amount': amount,
+             'description': f"Transfer to {to_account.name}{suffix}", 'date': day, 'type': 'expense',
+             'person_name': to_account.name, 'direction': None},
+            {'user_id': user_id, 'account_id': to_account.id, 'category_id': None, 'amount': received,
+             'description': f"Transfer from {from_account.name}{suffix}", 'date': day, 'type': 'income',
+             'person_name': from_account.name, 'direction': None},
+        ]
+
+    account = _account(entry, 'account_id', accounts)
+    amount = _amount(amount, account.currency or currency)
+    category_id = None
+    person_name = None
+    direction = None
+    if trans_type == 'personal':
+        person_name = _text(entry, 'person_name')
+        direction = (_text(entry, 'direction') or '').lower()
+        if not person_name or direction not in ('lent', 'borrowed'):
+            raise ValueError("personal entries need person_name and direction lent/borrowed")
+    else:
+        category_name = (_text(entry, 'category') or '').lower()
+        if not category_name:
+            raise ValueError("category is required")
+        category_id = categories.get((trans_type, category_name))
+        if category_id is None:
+            raise ValueError(f"unknown {trans_type} category {entry.get('category')!r}")
+
+    return None, [{
+        'user_id': user_id, 'account_id': account.id, 'category_id': category_id, 'amount': amount,
+        'description': description, 'date': day, 'type': trans_type,
+        'person_name': person_name, 'direction': direction,
+    }]
+
+
+def post_batch(db, user_id, entries, today=None):
+    """Validate and write a batch for a user; returns (ok, results).
+
+    results has one dict per entry, in order. When ok is False nothing has
+    been written and the failing entries carry an error; otherwise the rows
+    are written and the caller commits.
+    """
+    today = today or date.today()
+    accounts, categories = _lookup_maps(db, user_id)
+    rates = fx.rates(db)
+    # Balances (and the currency amounts are parsed in) are read once, under
+    # the write lock (row locks elsewhere), and moved along as the batch is
+    # validated
+    ledger.begin(db)
+    currency = refdata.currency(db, user_id, for_update=True)
+    balances = dict(db.execute(
+        select(Account.id, Account.balance).where(Account.user_id == user_id).with_for_update()
+    ).all())
+
+    parsed = []
+    results = []
+    for index, entry in enumerate(entries):
+        try:
+            transfer, rows = _parse_entry(entry, user_id, accounts, categories, currency, rates, today)
+            if transfer is not None and balances[transfer['from_account_id']] < transfer['amount']:
+                raise ValueError("insufficient balance in source account")
+        except ValueError as e:
+            results.append({'index': index, 'status': 'invalid', 'error': str(e)})
+            continue
+        for row in rows:
+            balances[row['account_id']] += ledger.balance_effect(row['type'], row['direction'], row['amount'])
+        parsed.append((transfer, rows))
+        results.append({'index': index, 'status': 'valid'})
+
+    if len(parsed) < len(results):
+        return False, results
+
+    transfers = [transfer for transfer, _ in parsed if transfer is not None]
+    transfer_ids = iter(db.execute(
+        insert(Transfer.__table__).returning(Transfer.__table__.c.id, sort_by_parameter_order=True), transfers
+    ).scalars().all() if transfers else ())
+
+    rows = [row for _, entry_rows in parsed for row in entry_rows]
+    table = Transaction.__table__
+    ids = db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows).scalars().all()
+    for row, id_ in zip(rows, ids):
+        row['id'] = id_
+    transaction_ids = iter(ids)
+
+    balance_deltas = {}
+    rollup_deltas = {}
+    for row in rows:
+        month = row['date'].strftime("%Y-%m")
+        balance_key = (row['account_id'], month)
+        balance_deltas[balance_key] = balance_deltas.get(balance_key, 0) + \
+            ledger.balance_effect(row['type'], row['direction'], row['amount'])
+        bucket = rollup_deltas.setdefault((row['account_id'], row['category_id'], row['type'], month), [0, 0])
+        bucket[0] += row['amount']
+        bucket[1] += 1
+
+    rollups.apply_many(db, user_id, rollup_deltas)
+    budget_states.apply_many(db, user_id, rollup_deltas)
+    ledger.post_many(db, user_id, balance_deltas)
+    charts.mark_stale(db, user_id, charts.charts_for(*{row['type'] for row in rows}))
+    search.record(db, user_id, rows)
+
+    for result, (transfer, entry_rows) in zip(results, parsed):
+        result['status'] = 'created'
+        result['transaction_ids'] = [next(transaction_ids) for _ in entry_rows]
+        if transfer is not None:
+            result['transfer_id'] = next(transfer_ids)
+    return True, results
+
+
+# ====================
+# Idempotency keys
+# ====================
+def replay(db, user_id, key):
+    """(request_hash, status, response) stored for a user's unexpired key, or None"""
+    return db.execute(
+        select(keys.c.request_hash, keys.c.status, keys.c.response)
+        .where(keys.c.user_id == user_id, keys.c.key == key,
+               keys.c.created_at >= datetime.now() - IDEMPOTENCY_TTL)
+    ).first()
+
+
+def remember(db, user_id, key, request_hash, status, response):
+    """Store the response to a key's batch; expired keys of the user are dropped first"""
+    db.execute(delete(keys).where(keys.c.user_id == user_id, keys.c.created_at < datetime.now() - IDEMPOTENCY_TTL))
+    db.execute(insert(keys).values(
+        user_id=user_id,
+        key=key,
+        request_hash=request_hash,
+        status=status,
+        response=json.dumps(response),
+        created_at=datetime.now()
+    ))
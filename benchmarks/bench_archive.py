@@ -0,0 +1,141 @@
+"""Cold storage: hot-table size and query latency before and after archiving closed years.
+
+Builds a synthetic database of --users users with --years of history each,
+times the queries that run on every visit for --samples of them (the first
+transaction page, the current month's dashboard and a search), then moves
+every year before archive.cutoff() into compressed files with archive.run()
+as `flask archive run` would, VACUUMs, and times the same queries again.
+Reads that reach into archived years (paging past the hot rows, a full
+export, loading trend columns) are timed after archiving too, and the
+rollups, ledger and archive are verified for the sampled users:
+
+    python -m benchmarks.bench_archive --users 200 --transactions 20000 --years 10
+"""
+import argparse
+import os
+from datetime import date
+from pathlib import Path
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from benchmarks.common import measure
+from benchmarks.synthetic import Profile, build
+from models import Account, Transaction
+import archive
+import export
+import ledger
+import pages
+import rollups
+import search
+import timeseries
+
+PAGE_SIZE = 50
+
+
+def first_page(db, user_id, filters=None, cursor=None):
+    filters = filters or {}
+    rows = pages.fetch(db, pages.transactions_statements(user_id, filters, cursor, PAGE_SIZE))['rows']
+    return archive.page(db, user_id, rows, filters, cursor, PAGE_SIZE)
+
+
+def dashboard(db, user_id, account_id):
+    return pages.fetch(db, pages.dashboard_statements(user_id, account_id, date.today().strftime("%Y-%m")))
+
+
+def time_queries(db, users, repeat):
+    """{label: median ms per user} for the queries every visit runs"""
+    accounts = dict(db.execute(
+        select(Account.user_id, func.min(Account.id)).where(Account.user_id.in_(users)).group_by(Account.user_id)
+    ).all())
+    queries = {
+        "first page": lambda user_id: first_page(db, user_id),
+        "dashboard": lambda user_id: dashboard(db, user_id, accounts[user_id]),
+        "search 'coffee'": lambda user_id: first_page(db, user_id, {'q': 'coffee'}),
+        "last 30 days": lambda user_id: first_page(db, user_id, {'start': date.fromordinal(date.today().toordinal() - 30)}),
+    }
+    if not search.enabled:
+        del queries["search 'coffee'"]
+    timings = {}
+    for label, query in queries.items():
+        median, _ = measure(lambda: [query(user_id) for user_id in users], repeat)
+        timings[label] = median / len(users)
+    return timings
+
+
+def table_stats(engine):
+    """(transactions rows, database file MiB) after a VACUUM"""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("VACUUM")
+        rows = conn.execute(select(func.count()).select_from(Transaction)).scalar()
+    return rows, os.path.getsize(engine.url.database) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=20_000, help="Transactions per user")
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=20, help="Users whose queries are timed")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    archive.ARCHIVE_DIR = Path(tempfile.mkdtemp(prefix="archive-"))
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions,
+                                     years=args.years, accounts_per_user=3))
+    print(f"Synthetic database: {counts['transactions']:,} transactions over {args.years} years "
+          f"for {counts['users']:,} users")
+    engine = create_engine(f"sqlite:///{database}")
+    rng = random.Random(5)
+    users = rng.sample(range(1, args.users + 1), min(args.samples, args.users))
+
+    hot_rows, hot_size = table_stats(engine)
+    with Session(engine) as db:
+        before = time_queries(db, users, args.repeat)
+
+        began = time.perf_counter()
+        moved = 0
+        for user_id in range(1, args.users + 1):
+            ledger.begin(db)
+            moved += sum(archive.run(db, user_id).values())
+            db.commit()
+        elapsed = time.perf_counter() - began
+    files = sum(path.stat().st_size for path in archive.ARCHIVE_DIR.rglob("*.npz"))
+    print(f"Archived {moved:,} transactions dated before {archive.cutoff()} in {elapsed:.1f} s "
+          f"({moved / elapsed:,.0f} rows/s) into {files / 2 ** 20:.1f} MiB of files")
+
+    cold_rows, cold_size = table_stats(engine)
+    with Session(engine) as db:
+        after = time_queries(db, users, args.repeat)
+
+        print(f"\n{'':<20}{'before':>12}{'after':>12}")
+        print(f"{'transactions rows':<20}{hot_rows:>12,}{cold_rows:>12,}")
+        print(f"{'database MiB':<20}{hot_size:>12.1f}{cold_size:>12.1f}")
+        print(f"\n{'ms per user':<20}{'before':>12}{'after':>12}{'ratio':>8}")
+        for label in before:
+            print(f"{label:<20}{before[label]:>12.3f}{after[label]:>12.3f}{after[label] / before[label]:>8.2f}")
+
+        user_id = users[0]
+        archive.year_cache.clear()
+        deep = (date(archive.cutoff() - 3, 6, 30), 10 ** 12)
+        median, _ = measure(lambda: first_page(db, user_id, cursor=deep), args.repeat)
+        print(f"\n{'page into archive':<20}{median:>12.3f} ms (files cached)")
+        began = time.perf_counter()
+        rows = sum(1 for _ in export.iter_rows(db, user_id, {}))
+        print(f"{'full export':<20}{(time.perf_counter() - began) * 1000:>12.1f} ms for {rows:,} rows")
+        timeseries.series_cache.clear()
+        began = time.perf_counter()
+        columns = timeseries.load(db, user_id)
+        print(f"{'trend columns':<20}{(time.perf_counter() - began) * 1000:>12.1f} ms for {len(columns):,} rows")
+
+        problems = sum(len(rollups.verify(db, user_id)) + len(ledger.verify(db, user_id)) for user_id in users)
+        problems += len(archive.verify(db))
+        print(f"\nRollups, ledger and archive of the sampled users: {problems} problem(s)")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""Read-route latency under many concurrent clients: WSGI vs ASGI serving.
+
+Both modes run under the same server (uvicorn, one process) on the same
+seeded database, so the only difference is the application interface:
+
+    wsgi  uvicorn --interface wsgi app:app   Flask on uvicorn's thread pool
+    asgi  uvicorn asgi:application           async read routes (asgi.py)
+
+Each of --clients keep-alive connections logs in as its own user, then
+requests a mix of /, /transactions, /budgets, /analytics and a chart
+payload back to back for --seconds. The clients share the machine with the
+server, so on a small box they compete with it for CPU:
+
+    python -m benchmarks.bench_asgi --clients 200 --seconds 20
+    python -m benchmarks.bench_asgi --mode asgi --rows 1000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+import h11
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from benchmarks.common import seed, temp_engine
+import ledger
+import rollups
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODES = {
+    "wsgi": ["--interface", "wsgi", "app:app"],
+    "asgi": ["asgi:application"],
+}
+
+# (path, weight): the mix each client draws from
+ROUTES = [
+    ("/", 3),
+    ("/transactions", 3),
+    ("/budgets", 1),
+    ("/analytics", 1),
+    ("/api/analytics/monthly", 2),
+]
+
+# uvicorn's WSGI middleware runs requests on 10 threads; give the ASGI
+# bridge the same number so non-async routes are not favoured either way
+THREADS = 10
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prepare(rows, users):
+    """Seed a throwaway database whose users all have the password 'pw'"""
+    engine = temp_engine()
+    seed(engine, rows, users=users)
+    with Session(engine) as db:
+        db.execute(text("UPDATE users SET hash = :hash"), {"hash": generate_password_hash("pw")})
+        db.commit()
+        rollups.rebuild(db)
+        ledger.rebuild(db)
+    engine.dispose()
+    return engine.url.database
+
+
+class Client:
+    """One keep-alive HTTP/1.1 connection that keeps its session cookie"""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.conn = h11.Connection(h11.CLIENT)
+
+    async def request(self, method, path, form=None):
+        """(status, body) for one request, following nothing"""
+        body = urlencode(form).encode() if form else b""
+        headers = [("Host", "localhost"), ("Content-Length", str(len(body)))]
+        if form:
+            headers.append(("Content-Type", "application/x-www-form-urlencoded"))
+        if self.cookie:
+            headers.append(("Cookie", self.cookie))
+
+        if self.conn.our_state is h11.DONE:
+            self.conn.start_next_cycle()
+        self.writer.write(self.conn.send(h11.Request(method=method, target=path, headers=headers)))
+        self.writer.write(self.conn.send(h11.Data(data=body)) + self.conn.send(h11.EndOfMessage()))
+
+        status, chunks = None, []
+        while True:
+            event = self.conn.next_event()
+            if event is h11.NEED_DATA:
+                data = await self.reader.read(65536)
+                if not data:
+                    raise ConnectionError("server closed the connection")
+                self.conn.receive_data(data)
+            elif isinstance(event, h11.Response):
+                status = event.status_code
+                for name, value in event.headers:
+                    if name == b"set-cookie":
+                        self.cookie = value.decode().split(";", 1)[0]
+            elif isinstance(event, h11.Data):
+                chunks.append(event.data)
+            elif isinstance(event, h11.EndOfMessage):
+                return status, b"".join(chunks)
+
+    def close(self):
+        self.writer.close()
+
+
+async def login(client, user):
+    await client.connect()
+    status, _ = await client.request("POST", "/login", {"username": f"user{user}", "password": "pw"})
+    if status != 302:
+        raise RuntimeError(f"login for user{user} returned {status}")
+    # The first dashboard visit picks the user's account
+    await client.request("GET", "/")
+
+
+async def load(port, clients, seconds, seed_value):
+    """Run the clients for `seconds`; return {path: latencies (ms)}, error count and elapsed time"""
+    pool = [Client(port) for _ in range(clients)]
+    await asyncio.gather(*(login(client, n + 1) for n, client in enumerate(pool)))
+
+    paths = [path for path, _ in ROUTES]
+    weights = [weight for _, weight in ROUTES]
+    latencies, errors = {path: [] for path in paths}, 0
+    deadline = time.perf_counter() + seconds
+
+    async def run(client, rng):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            path = rng.choices(paths, weights)[0]
+            start = time.perf_counter()
+            status, _ = await client.request("GET", path)
+            latencies[path].append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(client, random.Random(seed_value + n)) for n, client in enumerate(pool)))
+    elapsed = time.perf_counter() - start
+    for client in pool:
+        client.close()
+    return latencies, errors, elapsed
+
+
+def wait_for(port, server, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run(mode, database, clients, seconds):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            SECRET_KEY=os.getenv("SECRET_KEY", "bench"),
+            DATABASE_URL=f"sqlite:///{database}",
+            ASGI_THREADS=str(THREADS),
+            PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.getenv("PYTHONPATH")])),
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", *MODES[mode], "--port", str(port),
+             "--log-level", "warning", "--no-access-log", "--backlog", str(clients * 2),
+             # Early clients sit idle while the rest log in; keep their connections open
+             "--timeout-keep-alive", "120"],
+            cwd=workdir, env=env
+        )
+        try:
+            wait_for(port, server)
+            latencies, errors, elapsed = asyncio.run(load(port, clients, seconds, seed_value=1))
+        finally:
+            server.terminate()
+            server.wait(10)
+
+    overall = sorted(ms for samples in latencies.values() for ms in samples)
+    return {
+        "mode": mode,
+        "clients": clients,
+        "requests": len(overall),
+        "errors": errors,
+        "rps": round(len(overall) / elapsed, 1),
+        "p50_ms": round(percentile(overall, 0.50), 1),
+        "p99_ms": round(percentile(overall, 0.99), 1),
+        "routes": {
+            path: {"p50_ms": round(percentile(samples, 0.50), 1), "p99_ms": round(percentile(samples, 0.99), 1)}
+            for path, samples in ((path, sorted(samples)) for path, samples in latencies.items()) if samples
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--mode", action="append", choices=list(MODES), help="Mode(s) to measure (default: both)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    database = prepare(args.rows, users=args.clients)
+    print(f"Seeded {args.rows:,} transactions for {args.clients} users", file=sys.stderr)
+
+    if not args.json:
+        print(f"{'mode':<6}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for mode in args.mode or list(MODES):
+        result = run(mode, database, args.clients, args.seconds)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{mode:<6}{result['rps']:>10.1f}{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Syncing offline-entered transactions: one request each vs /api/transactions/batch.
+
+A client with --entries queued expenses, income and transfers posts them
+to a synthetic database through the Flask test client, either one
+/add_transaction form post (and commit) per entry or in JSON batches of
+--batch-size, and the wall time, entries per second and SQL statements
+per entry are compared. A second batch run with an Idempotency-Key then
+replays every batch to show a retry costs a single lookup:
+
+    python -m benchmarks.bench_batch --entries 1000 --batch-size 200
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from benchmarks.synthetic import Profile, build
+from models import Account
+
+PASSWORD = "pw"
+
+
+def make_entries(accounts, count, seed_value=7):
+    """Form-style entries for user 1: mostly expenses, some income and transfers"""
+    rng = random.Random(seed_value)
+    entries = []
+    for n in range(count):
+        kind = rng.random()
+        if kind < 0.05:
+            entries.append(dict(type="transfer", amount="1.00", from_account_id=accounts[0],
+                                to_account_id=accounts[1], description=f"sync {n}"))
+        elif kind < 0.2:
+            entries.append(dict(type="income", amount=f"{rng.randint(100, 3000)}.00", account_id=accounts[0],
+                                category="Salary", description=f"sync {n}"))
+        else:
+            entries.append(dict(type="expense", amount=f"{rng.randint(1, 200)}.{rng.randint(0, 99):02d}",
+                                account_id=rng.choice(accounts), category="Groceries", description=f"sync {n}"))
+    return entries
+
+
+def statements(profiler, method, rule):
+    stats = profiler.snapshot().get((method, rule))
+    return stats.queries if stats else 0
+
+
+def timed(profiler, method, rule, send):
+    before = statements(profiler, method, rule)
+    start = time.perf_counter()
+    send()
+    return time.perf_counter() - start, statements(profiler, method, rule) - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--transactions", type=int, default=1000, help="Existing transactions per user")
+    args = parser.parse_args()
+
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions),
+                             password_hash=generate_password_hash(PASSWORD))
+    print(f"Synthetic database: {counts['transactions']:,} transactions for {counts['users']:,} users")
+
+    os.chdir(tempfile.mkdtemp(prefix="fortuna-batch-"))
+    os.environ.update(DATABASE_URL=f"sqlite:///{database}", SECRET_KEY=os.getenv("SECRET_KEY", "bench"),
+                      JOBS_WORKERS="0", QUERY_PROFILE_SAMPLE_RATE="1")
+    os.environ.pop("QUERY_PROFILE_LOG", None)
+    from app import app, profiler
+
+    engine = create_engine(f"sqlite:///{database}")
+    with Session(engine) as db:
+        accounts = db.scalars(select(Account.id).where(Account.user_id == 1).order_by(Account.id)).all()
+        # Enough in the source account for every transfer
+        db.execute(text("UPDATE accounts SET balance = balance + 100000000, "
+                        "opening_balance = opening_balance + 100000000 WHERE id = :id"), {"id": accounts[0]})
+        db.commit()
+    entries = make_entries(accounts, args.entries)
+    batches = [entries[i:i + args.batch_size] for i in range(0, len(entries), args.batch_size)]
+
+    client = app.test_client()
+    client.post("/login", data={"username": "user1", "password": PASSWORD})
+
+    def one_by_one():
+        for entry in entries:
+            assert client.post("/add_transaction", data=entry).status_code == 302
+
+    def batched(keyed):
+        for n, chunk in enumerate(batches):
+            headers = {"Idempotency-Key": f"bench-{n}"} if keyed else {}
+            response = client.post("/api/transactions/batch", json=chunk, headers=headers)
+            assert response.status_code == 201, response.get_json()
+
+    runs = [
+        ("one request each", "/add_transaction", one_by_one),
+        (f"batches of {args.batch_size}", "/api/transactions/batch", lambda: batched(False)),
+        ("batches with keys", "/api/transactions/batch", lambda: batched(True)),
+        ("retried batches", "/api/transactions/batch", lambda: batched(True)),
+    ]
+    print(f"{'mode':<22}{'requests':>10}{'seconds':>10}{'entries/s':>12}{'SQL/entry':>11}")
+    for label, rule, send in runs:
+        elapsed, queries = timed(profiler, "POST", rule, send)
+        requests = len(entries) if rule == "/add_transaction" else len(batches)
+        print(f"{label:<22}{requests:>10}{elapsed:>10.2f}{len(entries) / elapsed:>12,.0f}{queries / len(entries):>11.2f}")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Budget alerts: a join over the rollups on every dashboard load vs. budget_states.
+
+Builds a synthetic database and, for --samples users, times the dashboard's
+budget alert query both ways: the old read-time query (budgets joined to
+the month's expense rollups, grouped, filtered with HAVING on percent)
+and the indexed lookup of budget_states at or above the lowest threshold.
+Both must return the same alerts. Then it times what the states cost on
+the write side, one budget_states.spend() per expense, and a full
+rebuild() and verify() against the raw transactions:
+
+    python -m benchmarks.bench_budgets --users 1000 --transactions 1000
+"""
+import argparse
+import random
+import time
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from benchmarks.common import EXPENSE_CATEGORY_IDS, explain, measure
+from benchmarks.synthetic import Profile, build
+from models import Budget, BudgetState, Category, MonthlyRollup
+from queries import current_month
+import budget_states
+import pages
+
+
+def rollup_alerts(user_id, month):
+    """The alert query as the dashboard used to run it"""
+    spent = func.coalesce(func.sum(MonthlyRollup.total), 0)
+    percent = spent * 100.0 / Budget.monthly_limit
+    return select(
+        Category.name.label('category_name'),
+        Budget.monthly_limit.label('budget_limit'),
+        spent.label('spent'),
+        percent.label('percent')
+    ).select_from(Budget)\
+        .join(Category, Budget.category_id == Category.id)\
+        .outerjoin(
+            MonthlyRollup,
+            (MonthlyRollup.user_id == user_id) &
+            (MonthlyRollup.month == month) &
+            (MonthlyRollup.type == 'expense') &
+            (MonthlyRollup.category_id == Category.id)
+        )\
+        .where(Budget.user_id == user_id, Budget.month == month)\
+        .group_by(Budget.id, Category.name, Budget.monthly_limit)\
+        .having(percent >= budget_states.THRESHOLDS[0])\
+        .order_by(percent.desc())\
+        .limit(5)
+
+
+def state_alerts(user_id, month):
+    return pages.dashboard_statements(user_id, None, month)['budget_alerts']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=1000, help="Transactions per user")
+    parser.add_argument("--samples", type=int, default=200, help="Users whose dashboard alerts are timed")
+    parser.add_argument("--writes", type=int, default=2000, help="Expenses posted to time spend()")
+    args = parser.parse_args()
+
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions))
+    print(f"Synthetic database: {counts['transactions']:,} transactions, {counts['budgets']:,} budgets "
+          f"for {counts['users']:,} users")
+    engine = create_engine(f"sqlite:///{database}")
+    month = current_month()
+    rng = random.Random(7)
+    users = rng.sample(range(1, args.users + 1), min(args.samples, args.users))
+
+    print(f"\n{'alerts':<16}{'median ms':>11}{'p95 ms':>9}   plan")
+    with engine.connect() as conn:
+        for label, statement in (("rollup join", rollup_alerts), ("budget_states", state_alerts)):
+            statements = [statement(user_id, month) for user_id in users]
+            median, p95 = measure(lambda: [conn.execute(stmt).all() for stmt in statements], 5)
+            plan = "; ".join(explain(conn, statement(users[0], month)))
+            print(f"{label:<16}{median / len(users):>11.3f}{p95 / len(users):>9.3f}   {plan}")
+        alerting = 0
+        for user_id in users:
+            old = sorted((r.category_name, r.spent) for r in conn.execute(rollup_alerts(user_id, month)))
+            new = sorted((r.category_name, r.spent) for r in conn.execute(state_alerts(user_id, month)))
+            assert old == new, (user_id, old, new)
+            alerting += bool(new)
+    print(f"Same alerts both ways; {alerting} of {len(users)} users have some")
+
+    with Session(engine) as db:
+        budgeted = db.execute(select(BudgetState.user_id, BudgetState.category_id)
+                              .where(BudgetState.month == month)).all()
+        writes = [rng.choice(budgeted) if rng.random() < 0.5 else (rng.randint(1, args.users), rng.choice(EXPENSE_CATEGORY_IDS))
+                  for _ in range(args.writes)]
+        began = time.perf_counter()
+        for user_id, category_id in writes:
+            budget_states.spend(db, user_id, category_id, month, rng.randint(100, 20_000))
+        elapsed = (time.perf_counter() - began) / len(writes) * 1000
+        events = db.query(func.count()).select_from(budget_states.events).scalar()
+        db.commit()
+        print(f"\nspend() per expense: {elapsed:.3f} ms ({events:,} threshold events logged)")
+
+        began = time.perf_counter()
+        budget_states.rebuild(db)
+        rebuilt = time.perf_counter() - began
+        began = time.perf_counter()
+        problems = budget_states.verify(db)
+        print(f"rebuild(): {rebuilt:.2f} s, verify(): {time.perf_counter() - began:.2f} s, {len(problems)} problem(s)")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Export memory: streamed yield_per batches vs. loading every row first.
+
+Peak Python heap (tracemalloc) should stay flat for the streamed export as
+the row count grows, while the .all() baseline grows linearly:
+
+    python -m benchmarks.bench_export --rows 1000000
+"""
+import argparse
+import time
+import tracemalloc
+
+from sqlalchemy.orm import Session
+
+import export
+from benchmarks.common import seed, temp_engine
+
+
+def drain(chunks):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+    return size
+
+
+def streamed(db, user_id, batch_size):
+    return drain(export.stream_export(db, user_id, {}, "csv", False, batch_size))
+
+
+def buffered(db, user_id, batch_size):
+    rows = db.execute(export.export_query(user_id, {})).all()
+    return drain(export.csv_chunks(rows, batch_size))
+
+
+def profile(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    engine = temp_engine()
+    print(f"Seeding {args.rows:,} transactions for a single user...")
+    seed(engine, args.rows, users=1)
+
+    with Session(engine) as db:
+        for label, fn in (("streamed", streamed), ("buffered .all()", buffered)):
+            size, elapsed, peak = profile(fn, db, 1, args.batch_size)
+            print(f"{label:<16} {size / 1e6:8.1f} MB written in {elapsed:6.2f}s, "
+                  f"peak heap {peak / 1e6:8.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
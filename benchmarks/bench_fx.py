@@ -0,0 +1,130 @@
+"""Multi-currency analytics: the same charts and net worth with and without foreign accounts.
+
+Builds a synthetic database and --years of daily exchange rates for every
+supported currency, loaded through fx.import_rates() as `flask fx import`
+would. For --samples users each analytics chart is computed from scratch
+(as on a stale read) and fx.net_worth() is timed while all accounts follow
+their user's currency; then every user's accounts after the first are
+moved to EUR, GBP or JPY and the same users are timed again. A full
+budget_states.rebuild() and verify() are timed both ways too, since that
+is where spending is converted per currency and month in bulk:
+
+    python -m benchmarks.bench_fx --users 1000 --transactions 1000
+"""
+import argparse
+import io
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import Session
+
+from benchmarks.common import measure
+from benchmarks.synthetic import Profile, build
+from models import Account
+from money import MINOR_DIGITS
+import budget_states
+import charts
+import fx
+import refdata
+
+# Rough units per EUR to start each currency's random walk from
+START = {'USD': 1.1, 'GBP': 0.85, 'INR': 90.0, 'JPY': 160.0}
+FOREIGN = ('EUR', 'GBP', 'JPY')
+
+
+def rate_file(years, seed=11):
+    """A wide CSV of daily rates against EUR, ECB style"""
+    rng = random.Random(seed)
+    codes = [code for code in MINOR_DIGITS if code != 'EUR']
+    rates = {code: START.get(code, 1.0) for code in codes}
+    lines = [",".join(["Date"] + codes)]
+    day = date.today() - timedelta(days=365 * years + 31)
+    while day <= date.today():
+        if day.weekday() < 5:
+            for code in codes:
+                rates[code] *= 1 + rng.gauss(0, 0.004)
+            lines.append(",".join([day.isoformat()] + [f"{rates[code]:.4f}" for code in codes]))
+        day += timedelta(days=1)
+    return ("\n".join(lines) + "\n").encode()
+
+
+def time_users(db, users, repeat):
+    """{label: ms per user} for every chart and net worth"""
+    months = charts._months(date.today())
+    timings = {}
+    for chart, compute in charts.COMPUTE.items():
+        median, _ = measure(lambda: [compute(db, user_id, 'USD', months) for user_id in users], repeat)
+        timings[chart] = median / len(users)
+    median, _ = measure(lambda: [fx.net_worth(db, user_id) for user_id in users], repeat)
+    timings['net worth'] = median / len(users)
+    return timings
+
+
+def time_budgets(db):
+    began = time.perf_counter()
+    budget_states.rebuild(db)
+    rebuilt = time.perf_counter() - began
+    began = time.perf_counter()
+    problems = budget_states.verify(db)
+    return rebuilt, time.perf_counter() - began, len(problems)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=1000, help="Transactions per user")
+    parser.add_argument("--accounts", type=int, default=3, help="Accounts per user")
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=100, help="Users whose charts are timed")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions,
+                                     accounts_per_user=args.accounts, years=args.years))
+    print(f"Synthetic database: {counts['transactions']:,} transactions in {counts['accounts']:,} accounts "
+          f"for {counts['users']:,} users")
+    engine = create_engine(f"sqlite:///{database}")
+    rng = random.Random(5)
+    users = rng.sample(range(1, args.users + 1), min(args.samples, args.users))
+
+    with Session(engine) as db:
+        began = time.perf_counter()
+        result = fx.import_rates(db, io.BytesIO(rate_file(args.years)))
+        db.commit()
+        print(f"Imported {result['rates']:,} rates for {result['days']:,} days "
+              f"in {time.perf_counter() - began:.2f} s")
+
+        single = time_users(db, users, args.repeat)
+        single_budgets = time_budgets(db)
+
+        # Every account but each user's first moves to another currency
+        first_ids = {user_id: account_id for account_id, user_id in db.execute(
+            select(Account.id, Account.user_id).order_by(Account.id.desc())
+        )}
+        for n, code in enumerate(FOREIGN):
+            db.execute(
+                update(Account)
+                .where(Account.id.not_in(first_ids.values()), Account.id % len(FOREIGN) == n)
+                .values(currency=code)
+            )
+        db.commit()
+        refdata.user_cache.clear()
+        foreign = db.query(Account.id).filter(Account.currency.is_not(None)).count()
+        print(f"{foreign:,} accounts moved to {', '.join(FOREIGN)}")
+
+        multi = time_users(db, users, args.repeat)
+        multi_budgets = time_budgets(db)
+    engine.dispose()
+
+    print(f"\n{'ms per user':<20}{'one currency':>14}{'multi':>10}{'ratio':>8}")
+    for label in single:
+        print(f"{label:<20}{single[label]:>14.3f}{multi[label]:>10.3f}{multi[label] / single[label]:>8.2f}")
+    print(f"\n{'budget states':<20}{'rebuild s':>10}{'verify s':>10}{'problems':>10}")
+    for label, (rebuilt, verified, problems) in (("one currency", single_budgets), ("multi", multi_budgets)):
+        print(f"{label:<20}{rebuilt:>10.2f}{verified:>10.2f}{problems:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Bulk CSV import throughput.
+
+Generates a CSV of random rows in memory and times importer.import_csv
+against a fresh database, first as a dry run and then for real:
+
+    python -m benchmarks.bench_import --rows 100000
+"""
+import argparse
+import io
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy.orm import Session
+
+import importer
+from benchmarks.common import seed, temp_engine
+from models import PRESET_CATEGORIES
+
+
+def make_csv(rows, seed_value=7):
+    rng = random.Random(seed_value)
+    start = date.today() - timedelta(days=3 * 365)
+    expense = [name for name, t in PRESET_CATEGORIES if t == 'expense']
+    income = [name for name, t in PRESET_CATEGORIES if t == 'income']
+    out = io.StringIO()
+    out.write("date,type,amount,category,account,description,person_name,direction\n")
+    for i in range(rows):
+        day = (start + timedelta(days=rng.randint(0, 3 * 365))).isoformat()
+        if rng.random() < 0.8:
+            out.write(f"{day},expense,{rng.uniform(1, 200):.2f},{rng.choice(expense)},Account 1,row {i},,\n")
+        else:
+            out.write(f"{day},income,{rng.uniform(100, 3000):.2f},{rng.choice(income)},Account 2,row {i},,\n")
+    return out.getvalue().encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = temp_engine()
+    seed(engine, 0, users=1)
+    payload = make_csv(args.rows)
+    print(f"CSV with {args.rows:,} rows ({len(payload) / 1e6:.1f} MB)")
+
+    for dry_run in (True, False):
+        with Session(engine) as db:
+            start = time.perf_counter()
+            result = importer.import_csv(db, 1, 1, io.BytesIO(payload), dry_run, args.batch_size)
+            db.commit()
+            elapsed = time.perf_counter() - start
+        label = "dry run" if dry_run else "import"
+        print(f"{label:<8} {result['rows']:,} rows, {result['imported']:,} imported, "
+              f"{len(result['errors'])} errors in {elapsed:.2f}s "
+              f"({result['rows'] / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
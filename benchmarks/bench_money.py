@@ -0,0 +1,130 @@
+"""Random add/delete cycles must leave balances and rollups bit-exact.
+
+Each cycle either adds a random income/expense/personal transaction or
+deletes a random existing one, issuing the same statements as
+add_transaction and delete_transaction (insert/delete, rollups
+record/unrecord, ledger record/unrecord). At the end every account balance
+must equal the exact integer sum of its remaining transactions, the rollups
+and ledger snapshots must verify, and the Python-side Money totals must
+match too. The same sequence is replayed with floats to show the
+drift integer minor units avoid:
+
+    python -m benchmarks.bench_money --cycles 1000000
+"""
+import argparse
+from collections import namedtuple
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from benchmarks.common import EXPENSE_CATEGORY_IDS, INCOME_CATEGORY_IDS, seed, temp_engine
+from ledger import balance_effect
+from models import Account, Transaction
+from money import Money
+import ledger
+import rollups
+
+# What the delete path needs to know about a transaction, without keeping ORM objects alive
+Live = namedtuple("Live", "id user_id account_id category_id type direction amount date")
+
+
+def run(args):
+    engine = temp_engine()
+    seed(engine, 0, users=args.users, accounts_per_user=2)
+    rng = random.Random(args.seed)
+    account_ids = list(range(1, args.users * 2 + 1))
+    today = date.today()
+
+    expected = {account_id: Money(0) for account_id in account_ids}
+    floats = {account_id: 0.0 for account_id in account_ids}
+    live = []
+
+    db = Session(engine)
+    start = time.perf_counter()
+    for cycle in range(1, args.cycles + 1):
+        if live and rng.random() < 0.45:
+            # delete_transaction
+            transaction = live.pop(rng.randrange(len(live)))
+            delta = balance_effect(transaction.type, transaction.direction, transaction.amount)
+            ledger.unrecord(db, transaction)
+            rollups.unrecord(db, transaction)
+            db.query(Transaction).filter_by(id=transaction.id).delete()
+            account_id, delta = transaction.account_id, -delta
+        else:
+            # add_transaction, with the amount typed as a decimal string
+            account_id = rng.choice(account_ids)
+            amount = Money.parse(f"{rng.randint(1, 500000) / 100:.2f}")
+            kind = rng.random()
+            if kind < 0.6:
+                fields = dict(type='expense', category_id=rng.choice(EXPENSE_CATEGORY_IDS))
+            elif kind < 0.9:
+                fields = dict(type='income', category_id=rng.choice(INCOME_CATEGORY_IDS))
+            else:
+                fields = dict(type='personal', person_name="Sam", direction=rng.choice(('lent', 'borrowed')))
+            transaction = Transaction(
+                user_id=(account_id + 1) // 2, account_id=account_id, amount=amount.minor,
+                date=today - timedelta(days=rng.randint(0, 730)), **fields
+            )
+            db.add(transaction)
+            rollups.record(db, transaction)
+            ledger.record(db, transaction)
+            delta = balance_effect(transaction.type, transaction.direction, amount.minor)
+            db.flush()
+            live.append(Live(
+                transaction.id, transaction.user_id, account_id, transaction.category_id,
+                transaction.type, transaction.direction, transaction.amount, transaction.date
+            ))
+            db.expunge(transaction)
+
+        expected[account_id] += Money(delta)
+        floats[account_id] += delta / 100
+
+        if cycle % args.commit_every == 0:
+            db.commit()
+    db.commit()
+    elapsed = time.perf_counter() - start
+
+    balances = dict(db.query(Account.id, Account.balance))
+    sums = dict(
+        db.query(Transaction.account_id, func.sum(
+            func.iif(
+                (Transaction.type == 'income') | (Transaction.direction == 'borrowed'),
+                Transaction.amount, -Transaction.amount
+            )
+        )).group_by(Transaction.account_id)
+    )
+    mismatched = [
+        account_id for account_id in account_ids
+        if balances[account_id] != expected[account_id].minor
+        or balances[account_id] != (sums.get(account_id) or 0)
+        or type(balances[account_id]) is not int
+    ]
+    problems = rollups.verify(db)
+    snapshot_problems = ledger.verify(db)
+    drift = max(abs(floats[a] - float(expected[a].decimal)) for a in account_ids)
+
+    print(f"cycles:               {args.cycles:,} in {elapsed:.1f}s ({args.cycles / elapsed:,.0f}/s)")
+    print(f"transactions left:    {db.query(Transaction).count():,}")
+    print(f"balance mismatches:   {len(mismatched)}")
+    print(f"rollup mismatches:    {len(problems)}")
+    print(f"ledger mismatches:    {len(snapshot_problems)}")
+    print(f"max float drift:      {drift:.3e} (same sequence with Float balances)")
+    db.close()
+    if mismatched or problems or snapshot_problems:
+        raise SystemExit("Balances are not exact")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--commit-every", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
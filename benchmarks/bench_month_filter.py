@@ -0,0 +1,91 @@
+"""Month filtering: strftime() predicates vs. sargable date ranges.
+
+Seeds a throwaway database (1M transactions by default) and reports the
+EXPLAIN QUERY PLAN and latency of the dashboard queries in both forms:
+
+    python -m benchmarks.bench_month_filter --rows 1000000
+"""
+import argparse
+
+from sqlalchemy import func, select
+
+from benchmarks.common import explain, measure, seed, temp_engine
+from models import Transaction
+from queries import current_month, in_month
+
+NEW_INDEXES = (
+    'idx_transactions_user_account_type_date',
+    'idx_transactions_user_category_type_date',
+    'idx_transactions_user_type_date',
+)
+
+
+def dashboard_queries(month_filter, user_id, account_id):
+    income = select(func.coalesce(func.sum(Transaction.amount), 0)).where(
+        Transaction.user_id == user_id,
+        Transaction.account_id == account_id,
+        Transaction.type == 'income',
+        month_filter,
+    )
+    expense = select(func.coalesce(func.sum(Transaction.amount), 0)).where(
+        Transaction.user_id == user_id,
+        Transaction.account_id == account_id,
+        Transaction.type == 'expense',
+        month_filter,
+    )
+    spent = select(Transaction.category_id, func.sum(Transaction.amount)).where(
+        Transaction.user_id == user_id,
+        Transaction.type == 'expense',
+        month_filter,
+    ).group_by(Transaction.category_id)
+    groceries = select(func.coalesce(func.sum(Transaction.amount), 0)).where(
+        Transaction.user_id == user_id,
+        Transaction.category_id == 1,
+        Transaction.type == 'expense',
+        month_filter,
+    )
+    return {"monthly income": income, "monthly expense": expense,
+            "spent by category": spent, "budget category": groceries}
+
+
+def report(engine, label, queries):
+    print(f"\n=== {label} ===")
+    with engine.connect() as conn:
+        for name, statement in queries.items():
+            median, p95 = measure(lambda: conn.execute(statement).all())
+            print(f"{name:<20} median {median:8.3f} ms   p95 {p95:8.3f} ms")
+            for line in explain(conn, statement):
+                print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    engine = temp_engine()
+    print(f"Seeding {args.rows:,} transactions for {args.users} users...")
+    seed(engine, args.rows, users=args.users)
+
+    month = current_month()
+    user_id, account_id = 1, 1
+
+    with engine.begin() as conn:
+        for name in NEW_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX {name}")
+        conn.exec_driver_sql("ANALYZE")
+    strftime_filter = func.strftime('%Y-%m', Transaction.date) == month
+    report(engine, "before: strftime() filter, single-column indexes",
+           dashboard_queries(strftime_filter, user_id, account_id))
+
+    for index in Transaction.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    report(engine, "after: date range filter, composite indexes",
+           dashboard_queries(in_month(Transaction.date, month), user_id, account_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Transaction list paging: OFFSET vs. keyset cursor at increasing depth.
+
+    python -m benchmarks.bench_pagination --rows 1000000
+"""
+import argparse
+
+from sqlalchemy import select
+
+from benchmarks.common import measure, seed, temp_engine
+from models import Transaction
+from queries import older_than, transaction_conditions
+
+PAGE_SIZE = 50
+
+
+def page_query(user_id):
+    return select(Transaction.id, Transaction.date, Transaction.amount)\
+        .where(*transaction_conditions(user_id, {}))\
+        .order_by(Transaction.date.desc(), Transaction.id.desc())\
+        .limit(PAGE_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10)
+    args = parser.parse_args()
+
+    engine = temp_engine()
+    print(f"Seeding {args.rows:,} transactions for {args.users} users...")
+    seed(engine, args.rows, users=args.users)
+
+    user_id = 1
+    with engine.connect() as conn:
+        ordered = conn.execute(
+            select(Transaction.id, Transaction.date)
+            .where(Transaction.user_id == user_id)
+            .order_by(Transaction.date.desc(), Transaction.id.desc())
+        ).all()
+        print(f"user {user_id} has {len(ordered):,} transactions\n")
+        print(f"{'page':>8} {'offset median':>15} {'keyset median':>15}")
+
+        page = 1
+        while (page - 1) * PAGE_SIZE < len(ordered):
+            offset = (page - 1) * PAGE_SIZE
+            by_offset = page_query(user_id).offset(offset)
+            by_keyset = page_query(user_id)
+            if offset:
+                last = ordered[offset - 1]
+                by_keyset = by_keyset.where(older_than((last.date, last.id)))
+            offset_ms, _ = measure(lambda: conn.execute(by_offset).all(), repeat=10)
+            keyset_ms, _ = measure(lambda: conn.execute(by_keyset).all(), repeat=10)
+            print(f"{page:>8} {offset_ms:>12.3f} ms {keyset_ms:>12.3f} ms")
+            page *= 4
+
+
+if __name__ == "__main__":
+    main()
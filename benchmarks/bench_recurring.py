@@ -0,0 +1,107 @@
+"""Recurring transactions: catching up after downtime, and idle scheduler ticks.
+
+Builds a synthetic database and gives every user --rules recurring rules
+(a daily, weekly or monthly expense or income) that started --days ago and
+have never run, as after a long outage. A copy of the database is then
+caught up twice: with one run_due() call, which writes each user's missed
+occurrences in a single batched insert, and with one run_due() per missed
+day, as a scheduler that only ever looks at today would. Finally a tick
+with nothing due is timed to show it only reads the next_due index:
+
+    python -m benchmarks.bench_recurring --users 1000 --rules 5 --days 90
+"""
+import argparse
+import random
+import shutil
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, event, insert, select, text
+from sqlalchemy.orm import Session
+
+from benchmarks.common import EXPENSE_CATEGORY_IDS, INCOME_CATEGORY_IDS
+from benchmarks.synthetic import Profile, build
+from models import Account
+import ledger
+import recurring
+import rollups
+
+
+def add_rules(engine, users, per_user, start):
+    rng = random.Random(3)
+    with Session(engine) as db:
+        accounts = dict(db.execute(select(Account.user_id, Account.id).order_by(Account.id.desc())).all())
+        rows = []
+        for user_id in range(1, users + 1):
+            for _ in range(per_user):
+                frequency = rng.choice(list(recurring.FREQUENCIES))
+                income = rng.random() < 0.2
+                rows.append({
+                    'user_id': user_id, 'account_id': accounts[user_id],
+                    'category_id': rng.choice(INCOME_CATEGORY_IDS if income else EXPENSE_CATEGORY_IDS),
+                    'type': 'income' if income else 'expense', 'amount': rng.randint(100, 100_000),
+                    'description': f"Recurring {frequency}", 'frequency': frequency, 'interval': 1,
+                    'start_date': start, 'end_date': None, 'occurrences': 0, 'next_due': start,
+                })
+        db.execute(insert(recurring.rules), rows)
+        db.commit()
+    return len(rows)
+
+
+def counted(engine):
+    """A list that grows by one for every SQL statement the engine runs"""
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(1))
+    return statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=200, help="Existing transactions per user")
+    parser.add_argument("--rules", type=int, default=5, help="Recurring rules per user")
+    parser.add_argument("--days", type=int, default=90, help="Days since the rules were last run")
+    parser.add_argument("--ticks", type=int, default=200, help="Idle ticks to time")
+    args = parser.parse_args()
+
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions))
+    today = date.today()
+    start = today - timedelta(days=args.days)
+    rules = add_rules(create_engine(f"sqlite:///{database}"), args.users, args.rules, start)
+    print(f"Synthetic database: {counts['transactions']:,} transactions, {rules:,} rules "
+          f"for {counts['users']:,} users, {args.days} days behind")
+
+    copy = database.replace(".db", "-daily.db")
+    shutil.copy(database, copy)
+
+    print(f"{'catch-up':<20}{'seconds':>10}{'written':>10}{'rows/s':>10}{'SQL':>10}")
+    runs = [
+        ("one run", database, lambda db: [recurring.run_due(db, today)]),
+        ("one run per day", copy,
+         lambda db: [recurring.run_due(db, start + timedelta(days=n)) for n in range(args.days + 1)]),
+    ]
+    for label, path, catch_up in runs:
+        engine = create_engine(f"sqlite:///{path}")
+        statements = counted(engine)
+        with Session(engine) as db:
+            began = time.perf_counter()
+            written = sum(result['transactions'] for result in catch_up(db))
+            elapsed = time.perf_counter() - began
+            print(f"{label:<20}{elapsed:>10.2f}{written:>10,}{written / elapsed:>10,.0f}{len(statements):>10,}")
+            assert not rollups.verify(db, 1) and not ledger.verify(db, 1)
+        engine.dispose()
+
+    engine = create_engine(f"sqlite:///{database}")
+    with Session(engine) as db:
+        plan = db.execute(text("EXPLAIN QUERY PLAN SELECT * FROM recurring_rules WHERE next_due <= :today "
+                               "ORDER BY next_due LIMIT 1000"), {"today": today}).all()
+        began = time.perf_counter()
+        for _ in range(args.ticks):
+            recurring.run_due(db, today)
+        elapsed = (time.perf_counter() - began) / args.ticks * 1000
+    print(f"\nIdle tick (nothing due): {elapsed:.3f} ms; plan: {'; '.join(row[-1] for row in plan)}")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+"""Latency, query count and memory for every route, saved as JSON per commit.
+
+Builds a synthetic database (benchmarks/synthetic.py) at the chosen scale,
+then drives every route in app.py through the Flask test client as one
+logged-in user. Each scenario gets a warm-up request (reported as
+cold_ms), --requests timed requests for the percentiles, and a few more
+under tracemalloc for the peak memory a single request allocates. Query
+counts and DB time come from the app's own profiler (profiling.py).
+
+    python -m benchmarks.bench_routes --scale smoke                # 1k transactions
+    python -m benchmarks.bench_routes --scale stress --db /tmp/stress.db --requests 20
+    python -m benchmarks.bench_routes --compare benchmarks/results/routes-smoke-abc1234.json
+
+Results go to benchmarks/results/routes-<scale>-<commit>.json unless
+--output says otherwise. --compare prints each scenario's change against
+an earlier result file and flags slowdowns beyond --threshold percent or
+any increase in queries per request.
+"""
+import argparse
+from dataclasses import asdict, dataclass, field
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timezone
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from benchmarks.synthetic import Profile, build
+from models import Account, Category, Transaction
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+# users x transactions per user
+SCALES = {
+    "smoke": dict(users=10, transactions_per_user=100),
+    "small": dict(users=100, transactions_per_user=1_000),
+    "medium": dict(users=1_000, transactions_per_user=1_000),
+    "stress": dict(users=10_000, transactions_per_user=1_000),
+}
+
+PASSWORD = "pw"
+METRICS_TOKEN = "bench"
+METRICS_HEADERS = {"Authorization": f"Bearer {METRICS_TOKEN}"}
+OK = (200,)
+REDIRECT = (302,)
+
+
+@dataclass
+class Scenario:
+    """One request shape; path and data may be callables of (state, i)"""
+    name: str
+    method: str
+    path: object
+    data: object = None
+    expect: tuple = OK
+    # Untimed, before the scenario / before each request
+    setup: object = None
+    prepare: object = None
+    # Cap on timed requests for deliberately slow routes (password hashing)
+    max_requests: int = None
+    files: bool = False
+    # Send data as a JSON body
+    as_json: bool = False
+    headers: dict = None
+
+
+@dataclass
+class State:
+    """What the scenarios know about the benchmark user"""
+    db: Session
+    user_id: int = 1
+    ids: dict = field(default_factory=dict)
+
+    def take(self, kind):
+        return self.ids[kind].pop()
+
+
+def _accounts(state):
+    return state.db.scalars(
+        select(Account.id).where(Account.user_id == state.user_id).order_by(Account.id)
+    ).all()
+
+
+def _transaction_ids(state):
+    state.ids["transactions"] = state.db.scalars(
+        select(Transaction.id).where(Transaction.user_id == state.user_id, Transaction.type != 'personal')
+        .order_by(Transaction.id.desc()).limit(500)
+    ).all()
+
+
+def _bench_categories(state):
+    state.ids["categories"] = state.db.scalars(
+        select(Category.id).where(Category.user_id == state.user_id, Category.name.like("Bench %"))
+    ).all()
+
+
+def _bench_accounts(state):
+    state.ids["accounts"] = state.db.scalars(
+        select(Account.id).where(Account.user_id == state.user_id, Account.name.like("Bench %"))
+    ).all()
+
+
+def _finish_jobs(state):
+    """Run every queued job, then remember the newest finished export and any job"""
+    from app import job_queue
+    while job_queue.run_next():
+        pass
+    jobs = job_queue.recent(state.user_id, limit=100)
+    state.ids["job"] = jobs[0]["id"]
+    state.ids["export_job"] = next(j["id"] for j in jobs if j["kind"] == "export" and j["status"] == "done")
+
+
+def _csv(state, i):
+    rows = "\n".join(f"{date.today().isoformat()},expense,Groceries,{i + n}.25,bench import"
+                     for n in range(20))
+    return {"file": (io.BytesIO(f"date,type,category,amount,description\n{rows}\n".encode()), "bench.csv")}
+
+
+def _batch(state, i):
+    accounts = _accounts(state)
+    return [dict(type="expense", amount=f"{n + 1}.50", account_id=accounts[n % 2], category="Groceries",
+                 description="bench batch") for n in range(50)]
+
+
+def _login(client, state):
+    client.post("/login", data={"username": f"user{state.user_id}", "password": PASSWORD})
+
+
+SCENARIOS = [
+    # Reads
+    Scenario("home", "GET", "/"),
+    Scenario("transactions", "GET", "/transactions"),
+    Scenario("transactions filtered", "GET", "/transactions?type=expense&category=Groceries"),
+    Scenario("transactions page 2", "GET",
+             lambda s, i: "/transactions?after=" + s.ids["cursor"], setup=lambda s: s.ids.update(cursor=_cursor(s))),
+    Scenario("budgets", "GET", "/budgets"),
+    Scenario("settings", "GET", "/settings"),
+    Scenario("analytics page", "GET", "/analytics"),
+    *[Scenario(f"chart {chart}", "GET", f"/api/analytics/{chart}")
+      for chart in ("monthly", "budget", "balances", "income_sources", "expense_breakdown")],
+    Scenario("balance on date", "GET",
+             lambda s, i: f"/balance?account_id={_accounts(s)[0]}&date={date.today().replace(day=1).isoformat()}"),
+    Scenario("add transaction form", "GET", "/add_transaction"),
+    Scenario("import form", "GET", "/import"),
+    Scenario("export csv", "GET", "/export?format=csv"),
+    Scenario("export ndjson gzip", "GET", "/export?format=ndjson&gzip=1"),
+    Scenario("metrics cache", "GET", "/metrics/cache", headers=METRICS_HEADERS),
+    Scenario("metrics pool", "GET", "/metrics/pool", headers=METRICS_HEADERS),
+    Scenario("metrics prometheus", "GET", "/metrics", headers=METRICS_HEADERS),
+    Scenario("account page", "GET", "/account"),
+
+    # Writes
+    Scenario("add income", "POST", "/add_transaction", expect=REDIRECT,
+             data=lambda s, i: dict(type="income", amount="250.00", account_id=_accounts(s)[0], category="Salary")),
+    Scenario("add expense", "POST", "/add_transaction", expect=REDIRECT,
+             data=lambda s, i: dict(type="expense", amount="12.50", account_id=_accounts(s)[0],
+                                    category="Groceries", description="bench")),
+    Scenario("add personal", "POST", "/add_transaction", expect=REDIRECT,
+             data=lambda s, i: dict(type="personal", amount="5", account_id=_accounts(s)[0],
+                                    person_name="Bob", direction="lent")),
+    Scenario("add transfer", "POST", "/add_transaction", expect=REDIRECT,
+             data=lambda s, i: dict(type="transfer", amount="1", from_account_id=_accounts(s)[0],
+                                    to_account_id=_accounts(s)[1])),
+    Scenario("add batch", "POST", "/api/transactions/batch", expect=(201,), as_json=True, data=_batch),
+    Scenario("delete transaction", "POST", "/delete_transaction", expect=REDIRECT, setup=_transaction_ids,
+             data=lambda s, i: dict(transaction_id=s.take("transactions"))),
+    Scenario("set budget", "POST", "/budgets", expect=REDIRECT,
+             data=lambda s, i: dict(category_id="1", monthly_limit=str(500 + i))),
+    Scenario("switch account", "POST", "/switch_account", expect=REDIRECT,
+             data=lambda s, i: dict(account_id=_accounts(s)[i % 2])),
+    Scenario("create account", "POST", "/create_account", expect=REDIRECT,
+             data=lambda s, i: dict(account_name=f"Bench {i}", account_type="savings", initial_balance="10")),
+    Scenario("rename account", "POST", "/rename_account", expect=REDIRECT,
+             data=lambda s, i: dict(account_id=_accounts(s)[1], new_account_name=f"Renamed {i}")),
+    Scenario("delete account", "POST", "/delete_account", expect=REDIRECT, setup=_bench_accounts,
+             data=lambda s, i: dict(account_id=s.take("accounts"))),
+    Scenario("create category", "POST", "/create_category", expect=REDIRECT,
+             data=lambda s, i: dict(category_name=f"Bench {i}", category_type="expense")),
+    Scenario("delete category", "POST", "/delete_category", expect=REDIRECT, setup=_bench_categories,
+             data=lambda s, i: dict(category_id=s.take("categories"))),
+    Scenario("toggle theme", "POST", "/toggle_theme", expect=REDIRECT),
+    Scenario("change currency", "POST", "/change_currency", expect=REDIRECT,
+             data=lambda s, i: dict(currency=("EUR", "USD")[i % 2])),
+    Scenario("change password", "POST", "/change_password", expect=REDIRECT, max_requests=5,
+             data=lambda s, i: dict(current_password=PASSWORD, new_password=PASSWORD, confirm_password=PASSWORD)),
+
+    # Background jobs (the requests only enqueue; jobs run untimed before the status routes)
+    Scenario("import upload", "POST", "/import", expect=REDIRECT, data=_csv, files=True),
+    Scenario("export in background", "GET", "/export?format=csv&background=1", expect=REDIRECT),
+    Scenario("recalculate", "POST", "/jobs/rebuild", expect=REDIRECT),
+    Scenario("job page", "GET", lambda s, i: f"/jobs/{s.ids['job']}", setup=_finish_jobs),
+    Scenario("job status", "GET", lambda s, i: f"/api/jobs/{s.ids['job']}"),
+    Scenario("job list", "GET", "/api/jobs"),
+    Scenario("job download", "GET", lambda s, i: f"/jobs/{s.ids['export_job']}/download"),
+
+    # Authentication last: these replace the session
+    Scenario("login form", "GET", "/login"),
+    Scenario("register form", "GET", "/register"),
+    Scenario("register", "POST", "/register", expect=REDIRECT, max_requests=5,
+             data=lambda s, i: dict(username=f"bench{time.time_ns()}", password=PASSWORD,
+                                    confirmation=PASSWORD, currency="USD")),
+    Scenario("logout", "GET", "/logout", expect=REDIRECT, prepare=_login),
+    Scenario("login", "POST", "/login", expect=REDIRECT, max_requests=5,
+             data=lambda s, i: dict(username=f"user{s.user_id}", password=PASSWORD)),
+]
+
+
+def _cursor(state):
+    from queries import encode_cursor
+    row = state.db.execute(
+        select(Transaction.id, Transaction.date).where(Transaction.user_id == state.user_id)
+        .order_by(Transaction.date.desc(), Transaction.id.desc()).offset(49).limit(1)
+    ).first()
+    return encode_cursor(row)
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _resolve(value, state, i):
+    return value(state, i) if callable(value) else value
+
+
+def run_scenario(app, client, profiler, state, scenario, requests, memory_requests):
+    if scenario.setup:
+        scenario.setup(state)
+
+    def call(i):
+        if scenario.prepare:
+            scenario.prepare(client, state)
+        path = _resolve(scenario.path, state, i)
+        data = _resolve(scenario.data, state, i)
+        start = time.perf_counter()
+        if scenario.as_json:
+            response = client.open(path, method=scenario.method, json=data, headers=scenario.headers)
+        else:
+            response = client.open(path, method=scenario.method, data=data, headers=scenario.headers,
+                                   content_type="multipart/form-data" if scenario.files else None)
+        response.get_data()
+        elapsed = (time.perf_counter() - start) * 1000
+        response.close()
+        # login_required bounced us: the scenario did not run as the user
+        if response.status_code == 302 and urlsplit(response.location).path == "/account":
+            return path, None, elapsed
+        return path, response.status_code, elapsed
+
+    path, status, cold = call(0)
+    rule, _ = app.url_map.bind("localhost").match(urlsplit(path).path, scenario.method, return_rule=True)
+    key = (scenario.method, rule.rule)
+    before = profiler.snapshot().get(key)
+    before_queries, before_db, before_requests = (
+        (before.queries, before.db_time, before.requests) if before else (0, 0.0, 0)
+    )
+
+    count = min(requests, scenario.max_requests or requests)
+    latencies, errors = [], int(status not in scenario.expect)
+    for i in range(1, count + 1):
+        _, status, elapsed = call(i)
+        latencies.append(elapsed)
+        errors += status not in scenario.expect
+
+    after = profiler.snapshot()[key]
+    profiled = after.requests - before_requests
+
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(count + 1, count + 1 + min(memory_requests, count)):
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            call(i)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "method": scenario.method,
+        "route": rule.rule,
+        "requests": count,
+        "errors": errors,
+        "cold_ms": round(cold, 3),
+        "mean_ms": round(sum(latencies) / count, 3),
+        "p50_ms": round(_percentile(latencies, 0.50), 3),
+        "p90_ms": round(_percentile(latencies, 0.90), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+        "max_ms": round(latencies[-1], 3),
+        "queries_per_request": round((after.queries - before_queries) / profiled, 2) if profiled else None,
+        "db_ms_per_request": round((after.db_time - before_db) * 1000 / profiled, 3) if profiled else None,
+        "peak_alloc_kb": round(peak / 1024, 1),
+    }
+
+
+def commit_id():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(database, requests, memory_requests, only=None):
+    """Benchmark every scenario against `database` in this process"""
+    workdir = tempfile.mkdtemp(prefix="fortuna-routes-")
+    os.chdir(workdir)
+    os.environ.update(
+        DATABASE_URL=f"sqlite:///{database}",
+        SECRET_KEY=os.getenv("SECRET_KEY", "bench"),
+        JOBS_WORKERS="0",
+        QUERY_PROFILE_SAMPLE_RATE="1",
+        METRICS_TOKEN=METRICS_TOKEN,
+    )
+    os.environ.pop("QUERY_PROFILE_LOG", None)
+    from app import app, profiler
+
+    app.config["TESTING"] = True
+    client = app.test_client()
+    engine = create_engine(f"sqlite:///{database}")
+    results = {}
+    with Session(engine) as db:
+        state = State(db)
+        _login(client, state)
+        for scenario in SCENARIOS:
+            if only and not any(word in scenario.name for word in only):
+                continue
+            results[scenario.name] = run_scenario(app, client, profiler, state, scenario, requests, memory_requests)
+            db.rollback()
+            print(f"{scenario.name:<28}{results[scenario.name]['p50_ms']:>10.2f} ms", file=sys.stderr)
+    engine.dispose()
+    return results
+
+
+def compare(baseline, current, threshold):
+    """Print per-scenario changes against a baseline result; returns the regressed names"""
+    regressed = []
+    print(f"{'scenario':<28}{'base p50':>10}{'p50':>10}{'change':>9}{'queries':>12}")
+    for name, now in current["routes"].items():
+        before = baseline["routes"].get(name)
+        if before is None:
+            print(f"{name:<28}{'-':>10}{now['p50_ms']:>10.2f}{'new':>9}")
+            continue
+        change = (now["p50_ms"] - before["p50_ms"]) * 100 / before["p50_ms"] if before["p50_ms"] else 0.0
+        queries = f"{before['queries_per_request']}->{now['queries_per_request']}"
+        worse = change > threshold or (now["queries_per_request"] or 0) > (before["queries_per_request"] or 0)
+        if worse:
+            regressed.append(name)
+        print(f"{name:<28}{before['p50_ms']:>10.2f}{now['p50_ms']:>10.2f}{change:>8.1f}%{queries:>12}"
+              + ("  <- regression" if worse else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=list(SCALES), default="smoke")
+    parser.add_argument("--users", type=int, help="Override the scale's user count")
+    parser.add_argument("--transactions", type=int, help="Override the scale's transactions per user")
+    parser.add_argument("--accounts", type=int, default=Profile.accounts_per_user)
+    parser.add_argument("--years", type=int, default=Profile.years)
+    parser.add_argument("--requests", type=int, default=50, help="Timed requests per scenario")
+    parser.add_argument("--memory-requests", type=int, default=3, help="Requests per scenario under tracemalloc")
+    parser.add_argument("--db", help="Reuse (or create, if missing) this database instead of a temporary one")
+    parser.add_argument("--only", action="append", help="Only scenarios whose name contains this text")
+    parser.add_argument("--output", help="Result file (default benchmarks/results/routes-<scale>-<commit>.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=20.0, help="p50 slowdown (percent) counted as a regression")
+    args = parser.parse_args()
+
+    profile = Profile(
+        **dict(SCALES[args.scale], accounts_per_user=max(args.accounts, 2), years=args.years),
+    )
+    if args.users:
+        profile.users = args.users
+    if args.transactions:
+        profile.transactions_per_user = args.transactions
+
+    hash_ = generate_password_hash(PASSWORD)
+    if args.db and Path(args.db).exists():
+        database, counts = str(Path(args.db).resolve()), {"reused": True}
+        with sqlite3.connect(database) as conn:
+            conn.execute("UPDATE users SET hash = ? WHERE id = 1", (hash_,))
+    else:
+        database, counts = build(profile, args.db and str(Path(args.db).resolve()), hash_)
+    print(f"Database {database}: {counts}", file=sys.stderr)
+
+    commit = commit_id()
+    # run() works from a temporary directory, so fix relative paths first
+    output = Path(args.output).resolve() if args.output else RESULTS_DIR / f"routes-{args.scale}-{commit}.json"
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    routes = run(database, args.requests, args.memory_requests, args.only)
+    result = {
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "scale": args.scale,
+        "profile": asdict(profile),
+        "dataset": counts,
+        "requests": args.requests,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "routes": routes,
+    }
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+
+    print(f"{'scenario':<28}{'p50 ms':>10}{'p99 ms':>10}{'queries':>9}{'peak KB':>10}{'errors':>8}")
+    for name, r in routes.items():
+        print(f"{name:<28}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['queries_per_request'] or 0:>9}"
+              f"{r['peak_alloc_kb']:>10.1f}{r['errors']:>8}")
+    print(f"Peak RSS {result['max_rss_mb']} MB; results in {output}")
+
+    if baseline is not None:
+        regressed = compare(baseline, result, args.threshold)
+        if regressed:
+            raise SystemExit(f"{len(regressed)} scenario(s) regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Full-text transaction search latency over a large synthetic ledger.
+
+Builds a synthetic database (--users x --transactions rows), times
+rebuilding the FTS5 index over it, then runs the search API's ranked query
+and the /transactions search filter for random users and query shapes:
+short prefixes, whole words, several words, words combined with date,
+type and account filters, and a name. The same /transactions filter is
+then timed with FTS5 turned off (a LIKE on the description) for
+comparison:
+
+    python -m benchmarks.bench_search --users 1000 --transactions 1000
+    python -m benchmarks.bench_search --users 10000 --transactions 1000 --queries 200
+"""
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from benchmarks.synthetic import Profile, build
+from models import Account
+import pages
+import search
+
+# (name, make(rng, account_id) -> (search text, other filters))
+SHAPES = [
+    ("prefix", lambda rng, account_id: (rng.choice(["co", "tr", "sh", "re"]), {})),
+    ("word", lambda rng, account_id: (rng.choice(["coffee", "ticket", "dinner", "refund"]), {})),
+    ("two words", lambda rng, account_id: (rng.choice(["weekly shop", "train ticket", "online order"]), {})),
+    ("word + last 90 days", lambda rng, account_id: ("lunch", {"start": date.today() - timedelta(days=90)})),
+    ("prefix + type + account", lambda rng, account_id: ("gro", {"type": "expense", "account_id": account_id})),
+    ("person", lambda rng, account_id: (rng.choice(["alice", "bob", "carol"]), {})),
+]
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def time_queries(db, users, queries, build_statements, seed_value=1):
+    """{shape: sorted latencies (ms)} for `queries` random users per shape"""
+    rng = random.Random(seed_value)
+    results = {}
+    for name, make in SHAPES:
+        samples = []
+        for _ in range(queries):
+            user_id = rng.randint(1, users)
+            account_id = db.scalars(select(Account.id).where(Account.user_id == user_id).limit(1)).first()
+            query, filters = make(rng, account_id)
+            statements = build_statements(user_id, query, dict(filters, q=query))
+            start = time.perf_counter()
+            pages.fetch(db, statements)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = sorted(samples)
+    return results
+
+
+def report(title, results):
+    print(f"\n{title}")
+    print(f"{'query':<26}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, samples in results.items():
+        print(f"{name:<26}{percentile(samples, 0.50):>10.2f}{percentile(samples, 0.95):>10.2f}{samples[-1]:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=1000, help="Transactions per user")
+    parser.add_argument("--queries", type=int, default=100, help="Queries per shape")
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions))
+    print(f"Synthetic database: {counts['transactions']:,} transactions for {counts['users']:,} users")
+    engine = create_engine(f"sqlite:///{database}")
+
+    search.install(engine)
+
+    page = args.page_size
+    with Session(engine) as db:
+        start = time.perf_counter()
+        search.rebuild(db)
+        print(f"FTS5 index rebuilt in {time.perf_counter() - start:.1f}s")
+
+        report("Search API (ranked by bm25)", time_queries(
+            db, args.users, args.queries,
+            lambda user_id, query, filters: pages.search_statements(user_id, query, filters, page, 0)))
+        report("/transactions?q= (newest first)", time_queries(
+            db, args.users, args.queries,
+            lambda user_id, query, filters: pages.transactions_statements(user_id, filters, None, page)))
+
+        search.enabled = False
+        report("/transactions?q= without FTS5 (LIKE on description)", time_queries(
+            db, args.users, args.queries,
+            lambda user_id, query, filters: pages.transactions_statements(user_id, filters, None, page)))
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
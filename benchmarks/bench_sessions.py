@@ -0,0 +1,83 @@
+"""Requests/sec on the dashboard (/) under each SESSION_BACKEND.
+
+The app picks its session backend at import time, so every backend is
+measured in a fresh interpreter with its own temporary database and
+working directory. A registered user requests / repeatedly through the
+Flask test client; the dashboard cache is warm after the first request,
+so the difference between backends is mostly session load/save cost:
+
+    python -m benchmarks.bench_sessions --requests 2000
+    python -m benchmarks.bench_sessions --backend cookie --backend sqlite
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def worker(requests):
+    """Runs inside the child process; prints one JSON result line"""
+    from app import app
+    app.config["TESTING"] = True
+    client = app.test_client()
+    client.post("/register", data=dict(username="bench", password="pw", confirmation="pw", currency="USD"))
+
+    client.get("/")
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get("/")
+        assert response.status_code == 200, response.status_code
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "backend": app.config["SESSION_BACKEND"],
+        "requests": requests,
+        "seconds": round(elapsed, 3),
+        "rps": round(requests / elapsed, 1),
+        "ms_per_request": round(elapsed * 1000 / requests, 3),
+    }))
+
+
+def run(backend, requests):
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            SESSION_BACKEND=backend,
+            SECRET_KEY=os.getenv("SECRET_KEY", "bench"),
+            DATABASE_URL=f"sqlite:///{workdir}/bench.db",
+            PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.getenv("PYTHONPATH")])),
+        )
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_sessions", "--worker", "--requests", str(requests)],
+            cwd=workdir, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--backend", action="append", help="Backend(s) to measure (default: all but redis)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.requests)
+        return
+
+    backends = args.backend or ["filesystem", "sqlite", "cookie"]
+    print(f"{'backend':<12}{'req/s':>10}{'ms/req':>10}")
+    for backend in backends:
+        result = run(backend, args.requests)
+        label = backend if result["backend"] == backend else f"{backend}->{result['backend']}"
+        print(f"{label:<12}{result['rps']:>10.1f}{result['ms_per_request']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
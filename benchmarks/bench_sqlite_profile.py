@@ -0,0 +1,98 @@
+"""Concurrent read/write throughput under each SQLITE_PROFILE.
+
+Reader threads run the dashboard month aggregate while writer threads
+insert a transaction and adjust the account balance, committing each time,
+like add_transaction does:
+
+    python -m benchmarks.bench_sqlite_profile --readers 8 --writers 2 --seconds 5
+"""
+import argparse
+import random
+import threading
+import time
+from datetime import date
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import seed, temp_engine
+from database import SQLITE_PROFILES, make_engine
+from models import Account, Transaction
+from queries import current_month, in_month
+
+
+def reader(engine, stop, counts, users):
+    rng = random.Random()
+    month = current_month()
+    while not stop.is_set():
+        user_id = rng.randint(1, users)
+        try:
+            with engine.connect() as conn:
+                conn.execute(select(func.sum(Transaction.amount)).where(
+                    Transaction.user_id == user_id,
+                    Transaction.type == 'expense',
+                    in_month(Transaction.date, month)
+                )).scalar()
+            counts["reads"] += 1
+        except OperationalError:
+            counts["read_errors"] += 1
+
+
+def writer(engine, stop, counts, users):
+    rng = random.Random()
+    while not stop.is_set():
+        user_id = rng.randint(1, users)
+        account_id = (user_id - 1) * 2 + 1
+        amount = rng.randint(100, 10000)
+        try:
+            with engine.begin() as conn:
+                conn.execute(Transaction.__table__.insert().values(
+                    user_id=user_id, account_id=account_id, category_id=1,
+                    amount=amount, date=date.today(), type='expense'
+                ))
+                conn.execute(update(Account).where(Account.id == account_id)
+                             .values(balance=Account.balance - amount))
+            counts["writes"] += 1
+        except OperationalError:
+            counts["write_errors"] += 1
+
+
+def run(profile, args):
+    path = temp_engine().url.database
+    seed_engine = make_engine(f"sqlite:///{path}", profile)
+    seed(seed_engine, args.rows, users=args.users)
+    seed_engine.dispose()
+
+    engine = make_engine(f"sqlite:///{path}", profile)
+    stop = threading.Event()
+    counts = {"reads": 0, "writes": 0, "read_errors": 0, "write_errors": 0}
+    threads = [threading.Thread(target=reader, args=(engine, stop, counts, args.users)) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(engine, stop, counts, args.users)) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    print(f"{profile:<8} reads/s {counts['reads'] / args.seconds:9.0f}   "
+          f"writes/s {counts['writes'] / args.seconds:7.0f}   "
+          f"errors {counts['read_errors'] + counts['write_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    for profile in SQLITE_PROFILES:
+        run(profile, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Trend analytics: NumPy over cached per-user columns vs. SQL GROUP BY.
+
+Builds a synthetic database for --users users (default one user with a
+million transactions over ten years), loads the heaviest user's columns
+once through timeseries.load() and times every metric behind
+/api/analytics/trends on them, then the whole trends() payload. For
+comparison it times the GROUP BY that monthly totals would need on every
+request without the columns, and checks both give the same totals:
+
+    python -m benchmarks.bench_timeseries --users 1 --transactions 1000000
+"""
+import argparse
+import time
+from datetime import date
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from benchmarks.common import measure
+from benchmarks.synthetic import Profile, build
+from queries import month_bucket
+import timeseries
+from timeseries import EXPENSE, INCOME, SEASON
+
+
+def sql_monthly(db, user_id, first, last):
+    """{month number: (income, expense)} with one GROUP BY over the raw transactions"""
+    table = timeseries.transactions
+    month = month_bucket(table.c.date)
+    rows = db.execute(
+        select(month, table.c.type, func.sum(table.c.amount))
+        .where(table.c.user_id == user_id, table.c.date >= timeseries.month_start(first),
+               table.c.date < timeseries.month_start(last + 1), table.c.type.in_(('income', 'expense')))
+        .group_by(month, table.c.type)
+    ).all()
+    totals = {}
+    for label, trans_type, total in rows:
+        year, mon = (int(part) for part in label.split("-"))
+        number = (year - 1970) * 12 + mon - 1
+        totals.setdefault(number, [0, 0])[trans_type == 'expense'] = total
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--transactions", type=int, default=1_000_000, help="Transactions per user")
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    database, counts = build(Profile(users=args.users, transactions_per_user=args.transactions,
+                                     years=args.years, accounts_per_user=3))
+    print(f"Synthetic database: {counts['transactions']:,} transactions for {counts['users']:,} users")
+    engine = create_engine(f"sqlite:///{database}")
+    user_id = 1
+    today = date.today()
+    last = timeseries.month_number(today)
+    first = last - 24 + 1
+    end_day = timeseries.day_number(today)
+
+    with Session(engine) as db:
+        began = time.perf_counter()
+        columns = timeseries.load(db, user_id)
+        loaded = time.perf_counter() - began
+        size = sum(getattr(columns, name).nbytes for name in ('days', 'months', 'amounts', 'kinds', 'codes', 'accounts'))
+        print(f"Loaded {len(columns):,} transactions in {loaded:.2f} s ({size / 2 ** 20:.1f} MiB of columns)")
+
+        history = timeseries.monthly(columns, EXPENSE, last - 36, last - 1)
+        metrics = {
+            "monthly totals": lambda: timeseries.monthly(columns, EXPENSE, first - SEASON, last),
+            "daily totals": lambda: timeseries.daily(columns, EXPENSE, end_day - 119, end_day),
+            "rolling 30 days": lambda: timeseries.rolling_mean(
+                timeseries.daily(columns, EXPENSE, end_day - 364, end_day), 30),
+            "year over year": lambda: timeseries.change(
+                timeseries.monthly(columns, INCOME, first - SEASON, last), SEASON),
+            "category x month": lambda: timeseries.by_category(columns, EXPENSE, first - SEASON, last),
+            "percentiles": lambda: timeseries.percentiles(
+                columns, EXPENSE, (50, 90), timeseries.day_number(timeseries.month_start(first)), end_day),
+            "forecast": lambda: timeseries.forecast(history, 4),
+            "trends() payload": lambda: timeseries.trends(db, user_id, today),
+        }
+        print(f"\n{'metric':<20}{'median ms':>11}{'p95 ms':>9}")
+        for label, metric in metrics.items():
+            median, p95 = measure(metric, args.repeat)
+            print(f"{label:<20}{median:>11.3f}{p95:>9.3f}")
+
+        median, p95 = measure(lambda: sql_monthly(db, user_id, first - SEASON, last), 5)
+        print(f"{'SQL GROUP BY month':<20}{median:>11.3f}{p95:>9.3f}")
+
+        grouped = sql_monthly(db, user_id, first - SEASON, last)
+        income = timeseries.monthly(columns, INCOME, first - SEASON, last)
+        expense = timeseries.monthly(columns, EXPENSE, first - SEASON, last)
+        for offset, number in enumerate(range(first - SEASON, last + 1)):
+            assert grouped.get(number, [0, 0]) == [income[offset], expense[offset]], number
+        print("Monthly totals match the SQL GROUP BY")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
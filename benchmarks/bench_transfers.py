@@ -0,0 +1,188 @@
+"""Concurrency stress test: many parallel transfers between the same two accounts.
+
+--threads workers each send --transfers transfers of random amounts back
+and forth between two accounts holding --funds in total, so the accounts
+keep running dry and many transfers must be refused. Two ways of writing
+them are compared on a synthetic database:
+
+- read-check-write: read the source balance, check it in Python, then
+  write the new balances back (what the routes used to do);
+- /add_transaction: the app's transfer route through the Flask test
+  client (ledger.begin() plus a conditional debit).
+
+For each the transfers made, refused and failed, throughput and latency
+are reported, and the money is checked: the two balances must still add
+up to --funds, neither may be negative, and the ledger must verify:
+
+    python -m benchmarks.bench_transfers --threads 16 --transfers 200
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from benchmarks.synthetic import Profile, build
+from models import Account, Transaction
+
+PASSWORD = "pw"
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def prepare(users, funds):
+    """A synthetic database whose user 1 has two accounts holding `funds` (minor units) between them"""
+    database, _ = build(Profile(users=users, transactions_per_user=100), password_hash=generate_password_hash(PASSWORD))
+    engine = create_engine(f"sqlite:///{database}")
+    with Session(engine) as db:
+        accounts = db.scalars(select(Account.id).where(Account.user_id == 1).order_by(Account.id).limit(2)).all()
+        for account_id, share in zip(accounts, (funds // 2, funds - funds // 2)):
+            # Shift the opening balance and snapshots too, so the ledger still explains the balance
+            shift = {"shift": share - db.get(Account, account_id).balance, "id": account_id}
+            db.execute(text("UPDATE accounts SET opening_balance = opening_balance + :shift, "
+                            "balance = balance + :shift WHERE id = :id"), shift)
+            db.execute(text("UPDATE balance_snapshots SET balance = balance + :shift WHERE account_id = :id"), shift)
+        db.commit()
+    engine.dispose()
+    return database, accounts
+
+
+def stress(threads, transfers, send):
+    """Run `send(rng, worker)` transfers on each thread; returns (outcome counts, sorted latencies, seconds)"""
+    counts = {"made": 0, "refused": 0, "failed": 0}
+    latencies = []
+    lock = threading.Lock()
+
+    def work(worker):
+        rng = random.Random(worker)
+        for _ in range(transfers):
+            start = time.perf_counter()
+            outcome = send(rng, worker)
+            elapsed = time.perf_counter() - start
+            with lock:
+                counts[outcome] += 1
+                latencies.append(elapsed * 1000)
+
+    began = time.perf_counter()
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return counts, sorted(latencies), time.perf_counter() - began
+
+
+def read_check_write(engine, accounts, max_amount):
+    """The old pattern: Python balance check, then absolute balances written back"""
+    def send(rng, worker):
+        source, target = rng.sample(accounts, 2)
+        amount = rng.randint(1, max_amount)
+        try:
+            with engine.connect() as conn:
+                balances = dict(conn.execute(
+                    select(Account.id, Account.balance).where(Account.id.in_(accounts))
+                ).all())
+                if balances[source] < amount:
+                    return "refused"
+                for account_id, sign, kind in ((source, -1, 'expense'), (target, 1, 'income')):
+                    conn.execute(Transaction.__table__.insert().values(
+                        user_id=1, account_id=account_id, amount=amount, date=date.today(), type=kind,
+                        description="stress"
+                    ))
+                    conn.execute(Account.__table__.update().where(Account.id == account_id)
+                                 .values(balance=balances[account_id] + sign * amount))
+                conn.commit()
+            return "made"
+        except OperationalError:
+            return "failed"
+    return send
+
+
+def app_transfers(accounts, max_amount):
+    """/add_transaction through a logged-in test client per thread"""
+    from app import app
+
+    clients = {}
+
+    def send(rng, worker):
+        client = clients.get(worker)
+        if client is None:
+            client = clients[worker] = app.test_client()
+            client.post("/login", data={"username": "user1", "password": PASSWORD})
+        source, target = rng.sample(accounts, 2)
+        amount = rng.randint(1, max_amount)
+        response = client.post("/add_transaction", data={
+            "type": "transfer", "amount": f"{amount // 100}.{amount % 100:02d}",
+            "from_account_id": source, "to_account_id": target, "description": "stress",
+        })
+        if response.status_code == 302:
+            return "made"
+        if b"Insufficient" in response.data:
+            return "refused"
+        return "failed"
+    return send
+
+
+def check(database, accounts, funds):
+    import ledger
+
+    engine = create_engine(f"sqlite:///{database}")
+    with Session(engine) as db:
+        balances = db.scalars(select(Account.balance).where(Account.id.in_(accounts))).all()
+        problems = ledger.verify(db, 1)
+    engine.dispose()
+    return {
+        "conserved": sum(balances) == funds,
+        "negative": any(balance < 0 for balance in balances),
+        "ledger_ok": not problems,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--transfers", type=int, default=200, help="Transfers per thread")
+    parser.add_argument("--funds", type=int, default=100_000, help="Total in the two accounts (minor units)")
+    parser.add_argument("--users", type=int, default=10)
+    args = parser.parse_args()
+    max_amount = args.funds // 4
+
+    os.chdir(tempfile.mkdtemp(prefix="fortuna-transfers-"))
+    os.environ.update(SECRET_KEY=os.getenv("SECRET_KEY", "bench"), JOBS_WORKERS="0", RECURRING_INTERVAL="0",
+                      DB_POOL_SIZE=str(args.threads))
+
+    print(f"{args.threads} threads x {args.transfers} transfers between two accounts holding {args.funds:,}")
+    print(f"{'mode':<20}{'made':>7}{'refused':>9}{'failed':>8}{'per s':>8}{'p50 ms':>8}{'p99 ms':>8}"
+          f"{'conserved':>11}{'negative':>10}{'ledger':>8}")
+    databases = {mode: prepare(args.users, args.funds) for mode in ("read-check-write", "/add_transaction")}
+    # The app's engine is created on import, so point it at its database first
+    os.environ["DATABASE_URL"] = f"sqlite:///{databases['/add_transaction'][0]}"
+    from database import make_engine
+
+    for mode, (database, accounts) in databases.items():
+        if mode == "read-check-write":
+            engine = make_engine(f"sqlite:///{database}")
+            send = read_check_write(engine, accounts, max_amount)
+        else:
+            send = app_transfers(accounts, max_amount)
+        counts, latencies, seconds = stress(args.threads, args.transfers, send)
+        if mode == "read-check-write":
+            engine.dispose()
+        result = check(database, accounts, args.funds)
+        total = sum(counts.values())
+        print(f"{mode:<20}{counts['made']:>7}{counts['refused']:>9}{counts['failed']:>8}{total / seconds:>8.0f}"
+              f"{percentile(latencies, 0.5):>8.1f}{percentile(latencies, 0.99):>8.1f}"
+              f"{str(result['conserved']):>11}{str(result['negative']):>10}{'ok' if result['ledger_ok'] else 'DRIFT':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Shared helpers for the standalone benchmark scripts.
+
+Benchmarks never touch data/fortuna.db: each one builds its own throwaway
+SQLite file from the models.py schema and seeds it directly.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import create_engine  # noqa: E402
+from models import Base, PRESET_CATEGORIES  # noqa: E402
+
+EXPENSE_CATEGORY_IDS = [i + 1 for i, (_, t) in enumerate(PRESET_CATEGORIES) if t == 'expense']
+INCOME_CATEGORY_IDS = [i + 1 for i, (_, t) in enumerate(PRESET_CATEGORIES) if t == 'income']
+
+
+def temp_engine(name="bench.db"):
+    """Fresh SQLite engine in a temporary directory with the full schema"""
+    path = os.path.join(tempfile.mkdtemp(prefix="fortuna-bench-"), name)
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def seed(engine, rows, users=100, accounts_per_user=2, years=3, seed_value=42):
+    """Insert users, accounts, preset categories and `rows` random transactions.
+
+    Uses raw executemany on the DBAPI connection so a million rows take
+    seconds rather than minutes.
+    """
+    rng = random.Random(seed_value)
+    today = date.today()
+    first_day = today - timedelta(days=365 * years)
+    span = (today - first_day).days
+
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.executemany(
+            "INSERT INTO categories (id, user_id, name, type, is_preset) VALUES (?, NULL, ?, ?, 1)",
+            [(i + 1, name, cat_type) for i, (name, cat_type) in enumerate(PRESET_CATEGORIES)],
+        )
+        cur.executemany(
+            "INSERT INTO users (id, username, hash, currency) VALUES (?, ?, 'x', 'USD')",
+            [(u, f"user{u}") for u in range(1, users + 1)],
+        )
+        cur.executemany(
+            "INSERT INTO accounts (id, user_id, name, type, balance, created_at) VALUES (?, ?, ?, 'current', 0, ?)",
+            [((u - 1) * accounts_per_user + a + 1, u, f"Account {a + 1}", first_day.isoformat())
+             for u in range(1, users + 1) for a in range(accounts_per_user)],
+        )
+
+        # Amounts are integer cents
+        def generate():
+            for _ in range(rows):
+                user_id = rng.randint(1, users)
+                account_id = (user_id - 1) * accounts_per_user + rng.randint(1, accounts_per_user)
+                day = (first_day + timedelta(days=rng.randint(0, span))).isoformat()
+                if rng.random() < 0.8:
+                    yield (user_id, account_id, rng.choice(EXPENSE_CATEGORY_IDS),
+                           rng.randint(100, 20000), day, 'expense')
+                else:
+                    yield (user_id, account_id, rng.choice(INCOME_CATEGORY_IDS),
+                           rng.randint(10000, 300000), day, 'income')
+
+        cur.executemany(
+            "INSERT INTO transactions (user_id, account_id, category_id, amount, date, type) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            generate(),
+        )
+        raw.commit()
+        cur.execute("ANALYZE")
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def measure(fn, repeat=20):
+    """Run fn `repeat` times and return (median_ms, p95_ms)"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+def explain(conn, statement):
+    """EXPLAIN QUERY PLAN lines for a SQLAlchemy statement"""
+    compiled = statement.compile(conn, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")]
@@ -0,0 +1,218 @@
+"""Realistic synthetic data for the benchmarks, written straight into the schema.
+
+Every user gets accounts of mixed types with opening balances, a few
+custom categories, monthly budgets and a ledger of transactions spread
+over the last `years`: mostly expenses, a salary-like stream of income,
+personal loans and transfers between their own accounts (a Transfer row
+plus its two transactions, as /add_transaction writes them). Rollups,
+budget states, balances and the search index are then rebuilt, so the
+database is what the app itself would have produced.
+
+Rows are generated and inserted in batches, so memory stays flat from a
+1k-row smoke run to a 10M-row stress run:
+
+    python -m benchmarks.synthetic --users 10000 --transactions 1000 --output /tmp/stress.db
+"""
+import argparse
+from dataclasses import asdict, dataclass
+import random
+import time
+from datetime import date, timedelta
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from benchmarks.common import EXPENSE_CATEGORY_IDS, INCOME_CATEGORY_IDS, temp_engine
+from models import Base, PRESET_CATEGORIES
+import budget_states
+import ledger
+import rollups
+import search
+
+ACCOUNT_TYPES = ('current', 'savings', 'business', 'investment', 'safe')
+CUSTOM_CATEGORIES = (('Pets', 'expense'), ('Travel', 'expense'), ('Gym', 'expense'),
+                     ('Subscriptions', 'expense'), ('Side Project', 'income'), ('Rental', 'income'))
+PEOPLE = ('Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi')
+WORDS = ('weekly', 'shop', 'coffee', 'lunch', 'train', 'ticket', 'rent', 'bill', 'online', 'order',
+         'refund', 'gift', 'dinner', 'market', 'fuel', 'pharmacy', 'book', 'cinema', 'taxi', 'hotel')
+
+# Share of each user's transactions by kind; the rest are expenses
+INCOME_SHARE = 0.12
+PERSONAL_SHARE = 0.03
+TRANSFER_SHARE = 0.05
+
+
+@dataclass
+class Profile:
+    """Shape of the generated data set"""
+    users: int = 100
+    accounts_per_user: int = 2
+    transactions_per_user: int = 100
+    years: int = 3
+    categories_per_user: int = 2
+    budget_months: int = 12
+    budgets_per_month: int = 5
+    seed: int = 42
+
+    @property
+    def transactions(self):
+        return self.users * self.transactions_per_user
+
+
+def _description(rng):
+    if rng.random() < 0.3:
+        return None
+    return " ".join(rng.sample(WORDS, rng.randint(1, 3)))
+
+
+def generate(engine, profile, password_hash='x', batch_size=50_000):
+    """Fill an empty schema on `engine` with `profile`'s data; returns row counts"""
+    rng = random.Random(profile.seed)
+    today = date.today()
+    first_day = today - timedelta(days=365 * profile.years)
+    span = (today - first_day).days
+    months = [(today - relativedelta(months=n)).strftime("%Y-%m") for n in range(profile.budget_months)]
+    counts = dict(users=profile.users, accounts=0, categories=0, budgets=0, transactions=0, transfers=0)
+
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.executemany(
+            "INSERT INTO categories (id, user_id, name, type, is_preset) VALUES (?, NULL, ?, ?, 1)",
+            [(i + 1, name, cat_type) for i, (name, cat_type) in enumerate(PRESET_CATEGORIES)],
+        )
+        next_category = len(PRESET_CATEGORIES) + 1
+        next_account = 1
+        next_transfer = 1
+
+        pending, transfers = [], []
+
+        def flush():
+            cur.executemany(
+                "INSERT INTO transactions (user_id, account_id, category_id, amount, description, date, type, "
+                "person_name, direction) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                pending,
+            )
+            cur.executemany(
+                "INSERT INTO transfers (id, user_id, from_account_id, to_account_id, amount, date, description) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                transfers,
+            )
+            counts['transactions'] += len(pending)
+            counts['transfers'] += len(transfers)
+            pending.clear()
+            transfers.clear()
+
+        for user_id in range(1, profile.users + 1):
+            cur.execute(
+                "INSERT INTO users (id, username, hash, currency) VALUES (?, ?, ?, 'USD')",
+                (user_id, f"user{user_id}", password_hash),
+            )
+
+            account_ids = list(range(next_account, next_account + profile.accounts_per_user))
+            names = {}
+            for n, account_id in enumerate(account_ids):
+                names[account_id] = "Main Account" if n == 0 else f"{ACCOUNT_TYPES[n % len(ACCOUNT_TYPES)].title()} {n}"
+                cur.execute(
+                    "INSERT INTO accounts (id, user_id, name, type, balance, opening_balance, created_at) "
+                    "VALUES (?, ?, ?, ?, 0, ?, ?)",
+                    (account_id, user_id, names[account_id], ACCOUNT_TYPES[n % len(ACCOUNT_TYPES)],
+                     rng.randint(0, 500_000), first_day.isoformat()),
+                )
+            next_account += profile.accounts_per_user
+            counts['accounts'] += profile.accounts_per_user
+
+            expense_ids, income_ids = list(EXPENSE_CATEGORY_IDS), list(INCOME_CATEGORY_IDS)
+            for name, cat_type in rng.sample(CUSTOM_CATEGORIES, min(profile.categories_per_user, len(CUSTOM_CATEGORIES))):
+                cur.execute(
+                    "INSERT INTO categories (id, user_id, name, type, is_preset) VALUES (?, ?, ?, ?, 0)",
+                    (next_category, user_id, name, cat_type),
+                )
+                (expense_ids if cat_type == 'expense' else income_ids).append(next_category)
+                next_category += 1
+                counts['categories'] += 1
+
+            budgeted = rng.sample(expense_ids, min(profile.budgets_per_month, len(expense_ids)))
+            cur.executemany(
+                "INSERT INTO budgets (user_id, category_id, monthly_limit, month) VALUES (?, ?, ?, ?)",
+                [(user_id, category_id, rng.randint(100, 2000) * 100, month)
+                 for month in months for category_id in budgeted],
+            )
+            counts['budgets'] += len(months) * len(budgeted)
+
+            remaining = profile.transactions_per_user
+            while remaining > 0:
+                account_id = rng.choice(account_ids)
+                day = (first_day + timedelta(days=rng.randint(0, span))).isoformat()
+                kind = rng.random()
+                if kind < TRANSFER_SHARE and len(account_ids) > 1 and remaining >= 2:
+                    to_account = rng.choice([a for a in account_ids if a != account_id])
+                    amount = rng.randint(1000, 100_000)
+                    transfers.append((next_transfer, user_id, account_id, to_account, amount, day, None))
+                    next_transfer += 1
+                    pending.append((user_id, account_id, None, amount, f"Transfer to {names[to_account]}",
+                                    day, 'expense', names[to_account], None))
+                    pending.append((user_id, to_account, None, amount, f"Transfer from {names[account_id]}",
+                                    day, 'income', names[account_id], None))
+                    remaining -= 2
+                    continue
+                if kind < TRANSFER_SHARE + PERSONAL_SHARE:
+                    pending.append((user_id, account_id, None, rng.randint(500, 50_000), _description(rng), day,
+                                    'personal', rng.choice(PEOPLE), rng.choice(('lent', 'borrowed'))))
+                elif kind < TRANSFER_SHARE + PERSONAL_SHARE + INCOME_SHARE:
+                    pending.append((user_id, account_id, rng.choice(income_ids), rng.randint(10_000, 500_000),
+                                    _description(rng), day, 'income', None, None))
+                else:
+                    pending.append((user_id, account_id, rng.choice(expense_ids), rng.randint(100, 20_000),
+                                    _description(rng), day, 'expense', None, None))
+                remaining -= 1
+
+            if len(pending) >= batch_size:
+                flush()
+        flush()
+        raw.commit()
+    finally:
+        raw.close()
+
+    with Session(engine) as db:
+        rollups.rebuild(db)
+        budget_states.rebuild(db)
+        ledger.rebuild(db)
+        if search.install(engine):
+            search.rebuild(db)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    return counts
+
+
+def build(profile, path=None, password_hash='x'):
+    """Create (or replace) a database at `path`, or a temporary one, and fill it"""
+    if path is None:
+        engine = temp_engine()
+    else:
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+    start = time.perf_counter()
+    counts = generate(engine, profile, password_hash)
+    counts['seconds'] = round(time.perf_counter() - start, 2)
+    engine.dispose()
+    return engine.url.database, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, value in asdict(Profile()).items():
+        flag = "--" + name.replace("_per_user", "").replace("_", "-")
+        parser.add_argument(flag, dest=name, type=int, default=value)
+    parser.add_argument("--output", help="Database file to create (default: a temporary file)")
+    args = vars(parser.parse_args())
+    path = args.pop("output")
+    database, counts = build(Profile(**args), path)
+    print(database)
+    print(", ".join(f"{key}={value:,}" for key, value in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
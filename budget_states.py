@@ -0,0 +1,307 @@
+"""Running spent totals per budget and the thresholds they cross.
+
+Every budget (user, category, month) has a row in budget_states holding
+its limit, the month's expenses in that category so far and the highest
+of THRESHOLDS (percent of the limit) they have reached. Write routes call
+record()/unrecord()/apply_many() inside their own database transaction,
+next to rollups: the spent total moves by the same delta, and a threshold
+crossed on the way up is logged in budget_events. The dashboard's alerts
+are then an indexed lookup of the month's states at or above the lowest
+threshold instead of a join and HAVING over the rollups on every load.
+
+Spending in a category without a budget is not tracked; set_limit()
+starts a state from the month's rollups when a budget is created.
+rebuild() regenerates the states from budgets and the raw `transactions`
+table (plus archived_totals, archive.py) and verify() reports any that
+have drifted.
+
+Spent totals are in the user's currency. Expenses from accounts held in
+another currency are converted per currency and month at the month's
+average rate (fx.py), as one total rather than expense by expense, so a
+state they touch is recomputed from the month's rollups instead of moved
+by a delta, and rebuild() reaches the same figure from grouped sums.
+"""
+from datetime import datetime
+from sqlalchemy import and_, delete, func, insert, select, union_all, update
+from models import Account, ArchivedTotal, Budget, BudgetEvent, BudgetState, MonthlyRollup, Transaction, User
+from queries import month_bucket
+import fx
+
+# Percent of a budget's limit that raises an alert; the highest one reached is the state's level
+THRESHOLDS = (80, 100)
+
+states = BudgetState.__table__
+events = BudgetEvent.__table__
+
+
+def level(spent, monthly_limit):
+    """Highest threshold that `spent` reaches, or 0"""
+    reached = [threshold for threshold in THRESHOLDS if spent * 100 >= threshold * monthly_limit]
+    return max(reached, default=0)
+
+
+def _log(db, user_id, category_id, month, old_level, new_level, spent, monthly_limit):
+    """Add an event for every threshold between two levels, if spending went up"""
+    crossed = [threshold for threshold in THRESHOLDS if old_level < threshold <= new_level]
+    if crossed:
+        db.execute(insert(events), [{
+            'user_id': user_id, 'category_id': category_id, 'month': month, 'threshold': threshold,
+            'percent': spent * 100 // monthly_limit, 'created_at': datetime.now(),
+        } for threshold in crossed])
+
+
+def _settle(db, user_id, category_id, month, state):
+    """Store an updated state's new level, logging the thresholds it crossed"""
+    new_level = level(state.spent, state.monthly_limit)
+    if new_level == state.level:
+        return
+    db.execute(update(states).where(states.c.id == state.id).values(level=new_level))
+    _log(db, user_id, category_id, month, state.level, new_level, state.spent, state.monthly_limit)
+
+
+def spend(db, user_id, category_id, month, amount):
+    """Add `amount` (negative to remove) to the spent total of a budget, if there is one"""
+    if category_id is None or not amount:
+        return
+    state = db.execute(
+        update(states)
+        .where(states.c.user_id == user_id, states.c.category_id == category_id, states.c.month == month)
+        .values(spent=states.c.spent + amount)
+        .returning(states.c.id, states.c.spent, states.c.monthly_limit, states.c.level)
+    ).first()
+    if state is not None:
+        _settle(db, user_id, category_id, month, state)
+
+
+def _spent(db, user_id, category_id, month, skip_account=None):
+    """A category's expenses in a month from the rollups, in the user's currency"""
+    home, foreign = fx.foreign_accounts(db, user_id)
+    totals = {}
+    for account_id, total in db.execute(
+        select(MonthlyRollup.account_id, func.sum(MonthlyRollup.total))
+        .where(
+            MonthlyRollup.user_id == user_id,
+            MonthlyRollup.month == month,
+            MonthlyRollup.type == 'expense',
+            MonthlyRollup.category_id == category_id
+        ).group_by(MonthlyRollup.account_id)
+    ):
+        if skip_account is None or account_id != skip_account:
+            currency = foreign.get(account_id, home)
+            totals[currency] = totals.get(currency, 0) + int(total)
+    return fx.rates(db).total(totals, home, month)
+
+
+def restate(db, user_id, category_id, month, skip_account=None):
+    """Recompute a budget's spent total from the rollups (which must be up to date), if there is one"""
+    if category_id is None:
+        return
+    state = db.execute(
+        update(states)
+        .where(states.c.user_id == user_id, states.c.category_id == category_id, states.c.month == month)
+        .values(spent=_spent(db, user_id, category_id, month, skip_account))
+        .returning(states.c.id, states.c.spent, states.c.monthly_limit, states.c.level)
+    ).first()
+    if state is not None:
+        _settle(db, user_id, category_id, month, state)
+
+
+def apply_many(db, user_id, deltas):
+    """Apply rollups.apply_many()-style {(account_id, category_id, type, month): (amount, count)} for one user.
+
+    The user's budgets in those months are found with one query; only
+    those are updated. Call after rollups.apply_many().
+    """
+    _, foreign = fx.foreign_accounts(db, user_id)
+    spent = {}
+    converted = set()
+    for (account_id, category_id, trans_type, month), (amount, _) in deltas.items():
+        if trans_type == 'expense' and category_id is not None:
+            spent[(category_id, month)] = spent.get((category_id, month), 0) + amount
+            if account_id in foreign:
+                converted.add((category_id, month))
+    if not spent:
+        return
+
+    budgeted = db.execute(
+        select(states.c.category_id, states.c.month)
+        .where(states.c.user_id == user_id, states.c.month.in_({month for _, month in spent}))
+    ).all()
+    for category_id, month in budgeted:
+        if (category_id, month) in converted:
+            restate(db, user_id, category_id, month)
+        elif (category_id, month) in spent:
+            spend(db, user_id, category_id, month, spent[(category_id, month)])
+
+
+def _count(db, transaction, sign):
+    if transaction.type != 'expense':
+        return
+    month = transaction.date.strftime("%Y-%m")
+    _, foreign = fx.foreign_accounts(db, transaction.user_id)
+    if transaction.account_id in foreign:
+        restate(db, transaction.user_id, transaction.category_id, month)
+    else:
+        spend(db, transaction.user_id, transaction.category_id, month, sign * transaction.amount)
+
+
+def record(db, transaction):
+    """Count a newly added expense against its budget; call after rollups.record()"""
+    _count(db, transaction, 1)
+
+
+def unrecord(db, transaction):
+    """Take a deleted expense off its budget; call after rollups.unrecord()"""
+    _count(db, transaction, -1)
+
+
+def set_limit(db, user_id, category_id, month, monthly_limit):
+    """Track a budget that was just created or changed; a new one starts from the month's rollups"""
+    state = db.execute(
+        update(states)
+        .where(states.c.user_id == user_id, states.c.category_id == category_id, states.c.month == month)
+        .values(monthly_limit=monthly_limit)
+        .returning(states.c.id, states.c.spent, states.c.monthly_limit, states.c.level)
+    ).first()
+    if state is None:
+        spent = _spent(db, user_id, category_id, month)
+        new_level = level(spent, monthly_limit)
+        db.execute(insert(states).values(
+            user_id=user_id, category_id=category_id, month=month,
+            monthly_limit=monthly_limit, spent=spent, level=new_level
+        ))
+        _log(db, user_id, category_id, month, 0, new_level, spent, monthly_limit)
+        return
+    _settle(db, user_id, category_id, month, state)
+
+
+def drop_account(db, user_id, account_id):
+    """Take a deleted account's expenses off the budgets; call before rollups.drop_account()"""
+    rows = db.execute(
+        select(MonthlyRollup.category_id, MonthlyRollup.month, func.sum(MonthlyRollup.total))
+        .where(
+            MonthlyRollup.account_id == account_id,
+            MonthlyRollup.type == 'expense',
+            MonthlyRollup.category_id.is_not(None)
+        ).group_by(MonthlyRollup.category_id, MonthlyRollup.month)
+    ).all()
+    _, foreign = fx.foreign_accounts(db, user_id)
+    if account_id not in foreign:
+        apply_many(db, user_id, {
+            (account_id, category_id, 'expense', month): (-total, 0) for category_id, month, total in rows
+        })
+        return
+    budgeted = set(db.execute(
+        select(states.c.category_id, states.c.month).where(states.c.user_id == user_id)
+    ).all())
+    for category_id, month, _ in rows:
+        if (category_id, month) in budgeted:
+            restate(db, user_id, category_id, month, skip_account=account_id)
+
+
+def drop_category(db, category_id):
+    """Forget the states and events of a deleted category's budgets"""
+    db.execute(delete(states).where(states.c.category_id == category_id))
+    db.execute(delete(events).where(events.c.category_id == category_id))
+
+
+def _expected(db, user_id=None):
+    """{(user_id, category_id, month): (monthly_limit, spent, level)} straight from budgets, `transactions` and archived_totals"""
+    month = month_bucket(Transaction.date)
+    hot = select(
+        Transaction.user_id,
+        Transaction.category_id,
+        month.label('month'),
+        Transaction.account_id,
+        func.sum(Transaction.amount).label('spent')
+    ).where(
+        Transaction.type == 'expense',
+        Transaction.category_id.is_not(None)
+    ).group_by(Transaction.user_id, Transaction.category_id, month, Transaction.account_id)
+    archived = select(
+        ArchivedTotal.user_id,
+        ArchivedTotal.category_id,
+        ArchivedTotal.month,
+        ArchivedTotal.account_id,
+        ArchivedTotal.total
+    ).where(
+        ArchivedTotal.type == 'expense',
+        ArchivedTotal.category_id.is_not(None)
+    )
+    query = select(Budget.user_id, Budget.category_id, Budget.month, Budget.monthly_limit, User.currency)\
+        .join(User, Budget.user_id == User.id)
+    if user_id is not None:
+        hot = hot.where(Transaction.user_id == user_id)
+        archived = archived.where(ArchivedTotal.user_id == user_id)
+        query = query.where(Budget.user_id == user_id)
+    rows = union_all(hot, archived).subquery()
+    spent = select(
+        rows.c.user_id,
+        rows.c.category_id,
+        rows.c.month,
+        Account.currency,
+        func.sum(rows.c.spent).label('spent')
+    ).outerjoin(Account, rows.c.account_id == Account.id)\
+        .group_by(rows.c.user_id, rows.c.category_id, rows.c.month, Account.currency)\
+        .subquery()
+
+    query = query.add_columns(spent.c.currency, func.coalesce(spent.c.spent, 0)).outerjoin(spent, and_(
+        spent.c.user_id == Budget.user_id,
+        spent.c.category_id == Budget.category_id,
+        spent.c.month == Budget.month
+    ))
+    limits = {}
+    totals = {}
+    for owner, category_id, budget_month, monthly_limit, home, currency, total in db.execute(query):
+        key = (owner, category_id, budget_month)
+        limits[key] = (monthly_limit, home)
+        by_currency = totals.setdefault(key, {})
+        by_currency[currency or home] = by_currency.get(currency or home, 0) + int(total)
+
+    rates = fx.rates(db)
+    expected = {}
+    for key, (monthly_limit, home) in limits.items():
+        total = rates.total(totals[key], home, key[2])
+        expected[key] = (monthly_limit, total, level(total, monthly_limit))
+    return expected
+
+
+def rebuild(db, user_id=None):
+    """Regenerate budget states (for one user or everyone) and commit; no events are logged"""
+    regenerate(db, user_id)
+    db.commit()
+
+
+def regenerate(db, user_id=None):
+    """Regenerate budget states inside the caller's transaction, which commits"""
+    expected = _expected(db, user_id)
+
+    stmt = delete(states)
+    if user_id is not None:
+        stmt = stmt.where(states.c.user_id == user_id)
+    db.execute(stmt)
+    if expected:
+        db.execute(insert(states), [
+            {'user_id': owner, 'category_id': category_id, 'month': month,
+             'monthly_limit': monthly_limit, 'spent': spent, 'level': state_level}
+            for (owner, category_id, month), (monthly_limit, spent, state_level) in expected.items()
+        ])
+
+
+def verify(db, user_id=None):
+    """Return a list of (key, expected, actual) for every budget state that disagrees"""
+    expected = _expected(db, user_id)
+
+    query = select(states.c.user_id, states.c.category_id, states.c.month,
+                   states.c.monthly_limit, states.c.spent, states.c.level)
+    if user_id is not None:
+        query = query.where(states.c.user_id == user_id)
+    actual = {(owner, category_id, month): tuple(values) for owner, category_id, month, *values in db.execute(query)}
+
+    problems = []
+    for key in expected.keys() | actual.keys():
+        want = expected.get(key)
+        got = actual.get(key)
+        if want != got:
+            problems.append((key, want, got))
+    return sorted(problems, key=lambda p: tuple(str(part) for part in p[0]))
@@ -0,0 +1,87 @@
+"""Small in-process caches shared by the routes.
+
+Keys are tuples whose first element is the owning user_id, so every entry
+belonging to a user can be dropped with invalidate(user_id) when one of
+their write routes commits.
+"""
+from collections import OrderedDict
+import os
+import threading
+import time
+
+MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._by_owner = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._by_owner.setdefault(key[0], set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, owner):
+        """Drop every entry whose key starts with `owner`"""
+        with self._lock:
+            for key in self._by_owner.pop(owner, ()):
+                self._data.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._by_owner.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        self._data.pop(key, None)
+        keys = self._by_owner.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_owner[key[0]]
+
+
+# Dashboard payloads keyed by (user_id, account_id, month)
+dashboard_cache = TTLCache(
+    maxsize=int(os.getenv("DASHBOARD_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("DASHBOARD_CACHE_TTL", 60))
+)
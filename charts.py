@@ -0,0 +1,214 @@
+"""Precomputed analytics chart payloads.
+
+Each dataset on the analytics page is stored per user in `chart_payloads`
+as ready-to-serve JSON with an ETag and a last-modified time. Write routes
+call mark_stale() with the charts their change affects, inside their own
+database transaction; payload() recomputes only stale charts (or charts
+whose 12-month window has rolled over) on the next read. A recomputed
+chart that comes out identical keeps its ETag and timestamp, so browsers
+revalidating it get a 304.
+
+Charts are in the user's currency. Rollups of accounts held in another
+currency are grouped per account and month and converted at the month's
+average rate, balances at its closing rate (fx.py); for everyone else the
+queries group exactly as before.
+"""
+from datetime import date, datetime, timezone
+import hashlib
+import json
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import case, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import BudgetState, Category, ChartPayload, MonthlyRollup
+from money import to_major
+from helpers import row_to_dict
+import fx
+import ledger
+
+CHARTS = ('monthly', 'budget', 'balances', 'income_sources', 'expense_breakdown')
+
+# Charts a transaction of each type can change
+CHARTS_BY_TYPE = {
+    'income': ('monthly', 'balances', 'income_sources'),
+    'expense': ('monthly', 'balances', 'budget', 'expense_breakdown'),
+    'personal': ('balances',),
+}
+
+payloads = ChartPayload.__table__
+
+
+def charts_for(*trans_types):
+    """Charts affected by writing transactions of the given types"""
+    return tuple(chart for chart in CHARTS if any(chart in CHARTS_BY_TYPE[t] for t in trans_types))
+
+
+def mark_stale(db, user_id, charts=CHARTS):
+    """Flag a user's charts for recomputation on their next read"""
+    db.execute(
+        update(payloads)
+        .where(payloads.c.user_id == user_id, payloads.c.chart.in_(charts))
+        .values(stale=True)
+    )
+
+
+def _months(today):
+    """The trailing 12 "YYYY-MM" months, current month last"""
+    return [(today - relativedelta(months=n)).strftime("%Y-%m") for n in range(11, -1, -1)]
+
+
+def _rows(rows, currency, *money_keys):
+    """Rows as dicts with minor-unit amounts converted to major units for Chart.js"""
+    data = [row_to_dict(r) for r in rows]
+    for item in data:
+        for key in money_keys:
+            item[key] = to_major(item[key], currency)
+    return data
+
+
+def _split(foreign, *columns):
+    """Group-by columns that are NULL except on rollups of the accounts in `foreign`"""
+    held = MonthlyRollup.account_id.in_(list(foreign))
+    return [case((held, column), else_=None).label(column.key) for column in columns]
+
+
+def _monthly(db, user_id, currency, months):
+    """Income vs expense by month"""
+    _, foreign = fx.foreign_accounts(db, user_id)
+    account_id, = _split(foreign, MonthlyRollup.account_id)
+    rows = db.query(
+        MonthlyRollup.month.label('month'),
+        account_id,
+        func.sum(case((MonthlyRollup.type == 'income', MonthlyRollup.total), else_=0)).label('income'),
+        func.sum(case((MonthlyRollup.type == 'expense', MonthlyRollup.total), else_=0)).label('expense')
+    ).filter(
+        MonthlyRollup.user_id == user_id,
+        MonthlyRollup.month >= months[0]
+    ).group_by(MonthlyRollup.month, account_id)\
+    .order_by(MonthlyRollup.month).all()
+
+    rates = fx.rates(db)
+    totals = {}
+    for row in rows:
+        source = foreign.get(row.account_id, currency)
+        month = totals.setdefault(row.month, {'month': row.month, 'income': 0, 'expense': 0})
+        month['income'] += rates.convert(row.income, source, currency, row.month)
+        month['expense'] += rates.convert(row.expense, source, currency, row.month)
+    return _rows(totals.values(), currency, 'income', 'expense')
+
+
+def _budget(db, user_id, currency, months):
+    """Budget vs actual spending this month"""
+    rows = db.query(
+        Category.name.label('category'),
+        BudgetState.monthly_limit.label('budget'),
+        BudgetState.spent.label('actual')
+    ).join(Category, BudgetState.category_id == Category.id)\
+    .filter(BudgetState.user_id == user_id, BudgetState.month == months[-1])\
+    .order_by(Category.name).all()
+    return _rows(rows, currency, 'budget', 'actual')
+
+
+def _balances(db, user_id, currency, months):
+    """Month-end balance of each account, from the ledger snapshots"""
+    _, foreign = fx.foreign_accounts(db, user_id)
+    rates = fx.rates(db)
+    series = ledger.balance_series(db, user_id, months)
+    for account in series:
+        source = foreign.get(account['id'], currency)
+        account['balances'] = [
+            None if b is None else to_major(rates.convert(b, source, currency, month, closing=True), currency)
+            for b, month in zip(account['balances'], months)
+        ]
+    return {'months': months, 'accounts': series}
+
+
+def _breakdown(trans_type):
+    def compute(db, user_id, currency, months):
+        _, foreign = fx.foreign_accounts(db, user_id)
+        account_id, month = _split(foreign, MonthlyRollup.account_id, MonthlyRollup.month)
+        rows = db.query(
+            Category.name.label('category'),
+            account_id,
+            month,
+            func.sum(MonthlyRollup.total).label('total')
+        ).select_from(MonthlyRollup)\
+        .join(Category, MonthlyRollup.category_id == Category.id)\
+        .filter(
+            MonthlyRollup.user_id == user_id,
+            MonthlyRollup.month >= months[0],
+            MonthlyRollup.type == trans_type
+        ).group_by(Category.name, account_id, month).all()
+
+        rates = fx.rates(db)
+        totals = {}
+        for row in rows:
+            source = foreign.get(row.account_id, currency)
+            total = rates.convert(row.total, source, currency, row.month or months[-1])
+            totals[row.category] = totals.get(row.category, 0) + total
+        ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+        return _rows([{'category': category, 'total': total} for category, total in ranked], currency, 'total')
+    compute.__doc__ = f"Twelve-month {trans_type} totals by category"
+    return compute
+
+
+COMPUTE = {
+    'monthly': _monthly,
+    'budget': _budget,
+    'balances': _balances,
+    'income_sources': _breakdown('income'),
+    'expense_breakdown': _breakdown('expense'),
+}
+
+
+def stored(user_id, chart):
+    """SELECT of a chart's stored payload row"""
+    return select(payloads.c.data, payloads.c.etag, payloads.c.updated_at, payloads.c.month, payloads.c.stale)\
+        .where(payloads.c.user_id == user_id, payloads.c.chart == chart)
+
+
+def is_current(row, today=None):
+    """True if a stored payload row can be served without recomputing"""
+    return row is not None and not row.stale and row.month == (today or date.today()).strftime("%Y-%m")
+
+
+def payload(db, user_id, chart, currency, today=None):
+    """Return (json_text, etag, updated_at) for one chart, recomputing it only if stale"""
+    today = today or date.today()
+    window = today.strftime("%Y-%m")
+    row = db.execute(stored(user_id, chart)).first()
+    if is_current(row, today):
+        return row.data, row.etag, row.updated_at
+
+    data = json.dumps(
+        {'chart': chart, 'currency': currency, 'data': COMPUTE[chart](db, user_id, currency, _months(today))},
+        separators=(',', ':')
+    )
+    etag = hashlib.sha1(data.encode()).hexdigest()
+    # Timestamps are naive UTC, truncated to the second like HTTP dates
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+    try:
+        if row is None:
+            db.execute(insert(payloads).values(
+                user_id=user_id, chart=chart, month=window, data=data, etag=etag, updated_at=now, stale=False
+            ))
+        elif row.etag == etag:
+            # Recomputed to the same payload: clients holding it stay valid
+            now = row.updated_at
+            db.execute(
+                update(payloads)
+                .where(payloads.c.user_id == user_id, payloads.c.chart == chart)
+                .values(month=window, stale=False)
+            )
+        else:
+            db.execute(
+                update(payloads)
+                .where(payloads.c.user_id == user_id, payloads.c.chart == chart)
+                .values(month=window, data=data, etag=etag, updated_at=now, stale=False)
+            )
+        db.commit()
+    except IntegrityError:
+        # Another request stored this chart first; ours is just as current
+        db.rollback()
+    return data, etag, now
+
@@ -1,18 +1,370 @@
-from sqlalchemy import create_engine
+from sqlalchemy import BigInteger, Float, case, cast, column, create_engine, event, func, inspect, insert, or_, select, table, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
-from models import Base, Category, PRESET_CATEGORIES
+from models import Base, Account, BalanceSnapshot, Budget, BudgetState, Category, MonthlyRollup, RecurringRule, Transaction, Transfer, User, PRESET_CATEGORIES
+from money import DEFAULT_CURRENCY, DEFAULT_DIGITS, MINOR_DIGITS, minor_digits
+from dotenv import load_dotenv
+import archive
+import budget_states
+import ledger
+import rollups
+import search
 import os
+import threading
+import time
 from pathlib import Path
 
-Path("data").mkdir(exist_ok=True)
+load_dotenv()
 
-engine = create_engine('sqlite:///data/fortuna.db', echo=False)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///data/fortuna.db")
+
+# PRAGMAs applied to every new SQLite connection, by SQLITE_PROFILE
+SQLITE_PROFILES = {
+    # SQLite's own defaults (rollback journal, full fsync per commit)
+    "default": {},
+    # WAL lets readers run alongside the writer; synchronous=NORMAL only
+    # fsyncs at checkpoints, which is still crash-safe in WAL mode
+    "tuned": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "foreign_keys": "ON",
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)),
+        "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64000)),
+        "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+        "temp_store": "MEMORY",
+    },
+}
+
+def sqlite_pragmas(profile):
+    """PRAGMA name/value pairs for a named SQLite profile"""
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLITE_PROFILE '{profile}', expected one of {', '.join(SQLITE_PROFILES)}")
+    return SQLITE_PROFILES[profile]
+
+def install_pragmas(engine, pragmas):
+    """Run the given PRAGMAs on each connection the engine's pool opens"""
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+def pool_options():
+    """QueuePool sizing from the environment, tuned per deployment"""
+    return {
+        "poolclass": MeteredQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+
+def make_engine(url=DATABASE_URL, profile=None):
+    """Create the engine for `url`, applying the SQLite profile when relevant"""
+    url = make_url(url)
+
+    if url.get_backend_name() != "sqlite":
+        return create_engine(url, echo=False, **pool_options())
+
+    if not url.database or url.database == ":memory:":
+        engine = create_engine(url, echo=False)
+    else:
+        Path(url.database).parent.mkdir(parents=True, exist_ok=True)
+        # Local file: no network round-trip to pre-ping and nothing to recycle
+        options = dict(pool_options(), pool_pre_ping=False, pool_recycle=-1)
+        engine = create_engine(url, echo=False, **options)
+
+    install_pragmas(engine, sqlite_pragmas(profile or os.getenv("SQLITE_PROFILE", "tuned")))
+    return engine
+
+# Async drivers used for each backend by make_async_engine()
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def make_async_engine(url=DATABASE_URL, profile=None):
+    """AsyncEngine for the same database, used by the ASGI read routes (asgi.py)"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{backend}'")
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+
+    options = {key: value for key, value in pool_options().items() if key != "poolclass"}
+    if backend != "sqlite":
+        return create_async_engine(url, echo=False, **options)
+
+    options.update(pool_pre_ping=False, pool_recycle=-1)
+    engine = create_async_engine(url, echo=False, **options)
+    install_pragmas(engine.sync_engine, sqlite_pragmas(profile or os.getenv("SQLITE_PROFILE", "tuned")))
+    return engine
+
+def pool_status(engine):
+    """Snapshot of connection pool usage for sizing against the worker count"""
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+        )
+    if isinstance(pool, MeteredQueuePool):
+        with pool._metrics_lock:
+            status.update(
+                checkouts=pool.checkouts,
+                timeouts=pool.timeouts,
+                total_wait_ms=round(pool.total_wait * 1000, 3),
+                avg_wait_ms=round(pool.total_wait * 1000 / pool.checkouts, 3) if pool.checkouts else 0.0,
+                max_wait_ms=round(pool.max_wait * 1000, 3),
+            )
+    return status
+
+engine = make_engine()
 db_session = scoped_session(sessionmaker(bind=engine))
 
+# Money columns per table; each table has a user_id whose currency sets the scale.
+# balance_snapshots and budget_states are left out: ledger.rebuild() and
+# budget_states.rebuild() regenerate them from these.
+MONEY_COLUMNS = (
+    (Account.__table__, ('balance', 'opening_balance')),
+    (Transaction.__table__, ('amount',)),
+    (Budget.__table__, ('monthly_limit',)),
+    (Transfer.__table__, ('amount',)),
+    (RecurringRule.__table__, ('amount',)),
+    (MonthlyRollup.__table__, ('total',)),
+)
+
+# Column naming the account whose currency a row's amounts are in; budgets are always in the user's
+ACCOUNT_COLUMNS = {
+    'accounts': 'id',
+    'transactions': 'account_id',
+    'transfers': 'from_account_id',
+    'recurring_rules': 'account_id',
+    'monthly_rollups': 'account_id',
+}
+
+def minor_unit_scale(user_id_column):
+    """SQL expression for 10**digits of the currency of the row's user"""
+    currency = select(User.currency).where(User.id == user_id_column).scalar_subquery()
+    return case(
+        {code: 10 ** digits for code, digits in MINOR_DIGITS.items()},
+        value=func.coalesce(currency, DEFAULT_CURRENCY),
+        else_=10 ** DEFAULT_DIGITS
+    )
+
+def money_columns_are_float(bind):
+    """True for databases created before amounts became integer minor units"""
+    columns = {c['name']: c['type'] for c in inspect(bind).get_columns('transactions')}
+    return isinstance(columns.get('amount'), Float)
+
+def migrate_money_columns(bind):
+    """Convert Float major-unit amounts into BIGINT minor units in place.
+
+    SQLite cannot change a column type, so each table is renamed, recreated
+    from the model and copied across with the amount scaled by the owner's
+    currency. PostgreSQL scales the values and then alters the column type.
+    The whole conversion runs in one transaction.
+    """
+    with bind.connect() as conn:
+        if bind.dialect.name != "sqlite":
+            for money_table, names in MONEY_COLUMNS:
+                scale = minor_unit_scale(money_table.c.user_id)
+                conn.execute(update(money_table).values({
+                    name: func.round(money_table.c[name] * scale) for name in names
+                }))
+                for name in names:
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {money_table.name} ALTER COLUMN {name} TYPE BIGINT USING ROUND({name})::bigint"
+                    )
+            conn.commit()
+            return
+
+        foreign_keys = conn.exec_driver_sql("PRAGMA foreign_keys").scalar()
+        # Keep other tables' REFERENCES pointing at the original names while renaming
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.exec_driver_sql("PRAGMA legacy_alter_table=ON")
+        try:
+            conn.exec_driver_sql("BEGIN")
+            for money_table, money_names in MONEY_COLUMNS:
+                old_name = f"{money_table.name}_float"
+                # Columns added since the table was created keep their defaults
+                names = [c['name'] for c in inspect(conn).get_columns(money_table.name)]
+                for index in money_table.indexes:
+                    conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+                conn.exec_driver_sql(f"ALTER TABLE {money_table.name} RENAME TO {old_name}")
+                money_table.create(conn)
+
+                old = table(old_name, *[column(n) for n in names])
+                values = [
+                    cast(func.round(old.c[n] * minor_unit_scale(old.c.user_id)), BigInteger) if n in money_names else old.c[n]
+                    for n in names
+                ]
+                conn.execute(insert(money_table).from_select(names, select(*values)))
+                conn.exec_driver_sql(f"DROP TABLE {old_name}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql("PRAGMA legacy_alter_table=OFF")
+            conn.exec_driver_sql(f"PRAGMA foreign_keys={'ON' if foreign_keys else 'OFF'}")
+
+def transaction_ids_reused(bind):
+    """True for SQLite databases whose transactions table was created without AUTOINCREMENT"""
+    if bind.dialect.name != "sqlite":
+        return False
+    with bind.connect() as conn:
+        sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transactions'").scalar()
+    return sql is not None and "AUTOINCREMENT" not in sql.upper()
+
+def migrate_transaction_ids(bind, floor=0):
+    """Recreate transactions with AUTOINCREMENT so SQLite stops reusing the highest id.
+
+    Without it, archiving the newest rows let the next insert take an id
+    that is already in an archive file. The table is renamed, recreated
+    from the model and copied across like migrate_money_columns() does,
+    and the id sequence starts above both the table's ids and `floor`
+    (the largest archived id).
+    """
+    transactions = Transaction.__table__
+    with bind.connect() as conn:
+        foreign_keys = conn.exec_driver_sql("PRAGMA foreign_keys").scalar()
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.exec_driver_sql("PRAGMA legacy_alter_table=ON")
+        try:
+            conn.exec_driver_sql("BEGIN")
+            names = [c['name'] for c in inspect(conn).get_columns('transactions')]
+            for index in transactions.indexes:
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+            conn.exec_driver_sql("ALTER TABLE transactions RENAME TO transactions_reused_ids")
+            transactions.create(conn)
+            old = table('transactions_reused_ids', *[column(n) for n in names])
+            conn.execute(insert(transactions).from_select(names, select(*[old.c[n] for n in names])))
+            conn.exec_driver_sql("DROP TABLE transactions_reused_ids")
+            conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'transactions'")
+            conn.exec_driver_sql(
+                "INSERT INTO sqlite_sequence (name, seq) "
+                "SELECT 'transactions', MAX(COALESCE(MAX(id), 0), ?) FROM transactions", (floor,)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql("PRAGMA legacy_alter_table=OFF")
+            conn.exec_driver_sql(f"PRAGMA foreign_keys={'ON' if foreign_keys else 'OFF'}")
+
+def rescale_user_money(db, user_id, old_currency, new_currency):
+    """Keep a user's amounts in major units when their currency's minor unit changes.
+
+    Switching USD to JPY turns 1050 cents into 11 yen-units rather than
+    1050 yen; the caller regenerates the user's rollups, budget states and
+    ledger and commits once, since rounded totals no longer match rounded
+    transactions exactly. Accounts held in a currency of their own (and
+    their rows) keep their amounts. Archived years are rewritten the same
+    way by archive.rescale().
+    """
+    shift = minor_digits(new_currency) - minor_digits(old_currency)
+    if not shift:
+        return False
+    following = select(Account.id).where(Account.user_id == user_id, Account.currency.is_(None))
+    for money_table, names in MONEY_COLUMNS:
+        values = {}
+        for name in names:
+            amount = money_table.c[name]
+            scaled = amount * 10 ** shift if shift > 0 else func.round(amount / float(10 ** -shift))
+            values[name] = cast(scaled, BigInteger)
+        stmt = update(money_table).where(money_table.c.user_id == user_id)
+        if money_table.name in ACCOUNT_COLUMNS:
+            account_id = money_table.c[ACCOUNT_COLUMNS[money_table.name]]
+            stmt = stmt.where(or_(account_id.is_(None), account_id.in_(following)))
+        db.execute(stmt.values(values))
+    archive.rescale(db, user_id, shift)
+    return True
+
+def add_opening_balance_column(bind):
+    """Add accounts.opening_balance to databases created before the ledger; True if added"""
+    if 'opening_balance' in {c['name'] for c in inspect(bind).get_columns('accounts')}:
+        return False
+    with bind.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE accounts ADD COLUMN opening_balance BIGINT NOT NULL DEFAULT 0")
+    return True
+
+def add_account_currency_column(bind):
+    """Add accounts.currency to databases created before per-account currencies"""
+    if 'currency' in {c['name'] for c in inspect(bind).get_columns('accounts')}:
+        return
+    with bind.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE accounts ADD COLUMN currency VARCHAR")
+
 def init_db():
     """Create all tables and seed preset categories"""
     Base.metadata.create_all(engine)
-    
+
+    # Balances used to be adjusted in place with no opening balance
+    needs_ledger = add_opening_balance_column(engine)
+    # Accounts used to all be in the user's currency
+    add_account_currency_column(engine)
+
+    # Amounts used to be Float major units
+    if money_columns_are_float(engine):
+        migrate_money_columns(engine)
+        rollups.rebuild(db_session)
+
+    if needs_ledger:
+        ledger.reset_openings(db_session)
+        ledger.rebuild(db_session)
+
+    # SQLite used to hand the id of an archived newest row to the next insert
+    if transaction_ids_reused(engine):
+        floor = archive.max_id(db_session)
+        db_session.remove()
+        migrate_transaction_ids(engine, floor)
+
+    # create_all skips indexes on tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    # Full-text search index (SQLite only), filled from transactions when new
+    search.install(engine, db_session)
+
     # Check if preset categories already exist
     existing = db_session.query(Category).filter_by(is_preset=1).first()
     if not existing:
@@ -27,10 +379,18 @@ def init_db():
             db_session.add(category)
         db_session.commit()
 
+    # Backfill rollups for databases created before monthly_rollups existed
+    if not db_session.query(MonthlyRollup.id).first() and db_session.query(Transaction.id).first():
+        rollups.rebuild(db_session)
+    if not db_session.query(BalanceSnapshot.id).first() and db_session.query(Transaction.id).first():
+        ledger.rebuild(db_session)
+    if not db_session.query(BudgetState.id).first() and db_session.query(Budget.id).first():
+        budget_states.rebuild(db_session)
+
 def get_db():
     """Get database session for use in routes"""
     return db_session
 
 def close_db():
     """Close database session"""
-    db_session.remove()
\ No newline at end of file
+    db_session.remove()
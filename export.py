@@ -0,0 +1,123 @@
+"""Streaming transaction export.
+
+Rows are pulled from the database in batches of `batch_size` with
+yield_per and turned into CSV or NDJSON chunks as they arrive, so memory
+use is bounded by the batch size rather than the size of the export.
+Archived years (archive.py) are merged in newest first as the stream
+reaches them, one year's file at a time. Amounts are written as exact decimal strings in their account's
+currency, which the next column names.
+"""
+import csv
+import heapq
+import io
+import json
+import zlib
+from sqlalchemy import select
+from models import Account, Category, Transaction
+from money import DEFAULT_CURRENCY, Money
+from queries import transaction_conditions
+import archive
+import refdata
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+AMOUNT = 3
+CURRENCY = 4
+COLUMNS = ("id", "date", "type", "amount", "currency", "category", "account", "description", "person_name", "direction")
+
+
+def export_query(user_id, filters):
+    """SELECT for a user's filtered transactions, newest first"""
+    return select(
+        Transaction.id,
+        Transaction.date,
+        Transaction.type,
+        Transaction.amount,
+        Account.currency,
+        Category.name.label("category"),
+        Account.name.label("account"),
+        Transaction.description,
+        Transaction.person_name,
+        Transaction.direction
+    )\
+    .outerjoin(Category, Transaction.category_id == Category.id)\
+    .outerjoin(Account, Transaction.account_id == Account.id)\
+    .where(*transaction_conditions(user_id, filters))\
+    .order_by(Transaction.date.desc(), Transaction.id.desc())
+
+
+def archived_rows(db, user_id, filters):
+    """The user's archived transactions in export_query() column order, newest first"""
+    accounts = {account.id: account for account in refdata.accounts(db, user_id)}
+    for record in archive.records(db, user_id, filters):
+        account = accounts.get(record.account_id)
+        yield (
+            record.id, record.date, record.type, record.amount,
+            account.currency if account else None, record.name, account.name if account else None,
+            record.description, record.person_name, record.direction
+        )
+
+
+def iter_rows(db, user_id, filters, batch_size=1000, currency=DEFAULT_CURRENCY):
+    """Yield result rows as tuples, fetching `batch_size` at a time from the cursor"""
+    result = db.execute(export_query(user_id, filters).execution_options(yield_per=batch_size))
+    hot = (row for partition in result.partitions() for row in partition)
+    rows = heapq.merge(hot, archived_rows(db, user_id, filters), key=lambda row: (row[1], row[0]), reverse=True)
+    for row in rows:
+        row = list(row)
+        # NULL: the account follows the user's currency
+        row[CURRENCY] = row[CURRENCY] or currency
+        row[AMOUNT] = str(Money(row[AMOUNT], row[CURRENCY]))
+        yield row
+
+
+def csv_chunks(rows, batch_size=1000):
+    """Encode rows as CSV, emitting one chunk per `batch_size` rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= batch_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode()
+
+
+def ndjson_chunks(rows, batch_size=1000):
+    """Encode rows as newline-delimited JSON objects"""
+    lines = []
+    for row in rows:
+        record = dict(zip(COLUMNS, row))
+        record["date"] = record["date"].isoformat()
+        lines.append(json.dumps(record))
+        if len(lines) >= batch_size:
+            yield ("\n".join(lines) + "\n").encode()
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode()
+
+
+def gzip_chunks(chunks):
+    """Compress a byte stream on the fly into a single gzip member"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(db, user_id, filters, fmt="csv", compress=False, batch_size=1000, currency=DEFAULT_CURRENCY):
+    """Byte chunks of a full export in the requested format"""
+    rows = iter_rows(db, user_id, filters, batch_size, currency)
+    encode = csv_chunks if fmt == "csv" else ndjson_chunks
+    chunks = encode(rows, batch_size)
+    return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,248 @@
+"""Exchange rates for accounts held in another currency.
+
+An account may hold a currency other than its owner's (Account.currency;
+NULL means it follows the owner's currency, the "home" currency). Its
+amounts are integer minor units of its own currency, so its balance,
+rollups and snapshots stay exact and nothing changes for users whose
+accounts all follow their home currency. Anything reported across
+accounts (budgets, analytics charts, net worth) is in the home currency.
+
+Rates come from local CSV files loaded with `flask fx import`; nothing is
+fetched over the network. A file holds either one row per date and
+currency (date,currency,rate) or one row per date with a column per
+currency, like the ECB's historical reference rates. Every rate is stored
+in fx_rates as units of the currency per one FX_BASE, and the import
+refreshes fx_months, the average and closing rate of every currency for
+each month it touched.
+
+Money flows (income, expenses, budgets) convert at their month's average
+rate and balances at the month's closing rate; a month without rates uses
+the closest earlier month, or the first month known. Aggregate queries
+still group in SQL, split by account only where an account is in another
+currency, and the few resulting totals are converted with rates(), which
+keeps fx_months in memory: a multi-currency chart costs about the same as
+a single-currency one.
+"""
+from bisect import bisect_right
+import csv
+from datetime import date
+import io
+import os
+from sqlalchemy import delete, func, insert, select
+from cache import MISSING, TTLCache
+from models import Account, FxMonth, FxRate
+from money import MINOR_DIGITS, minor_digits
+import refdata
+
+FX_BASE = os.getenv("FX_BASE", "EUR")
+# Stop collecting errors past this point; the import fails either way
+MAX_ERRORS = 100
+
+fx_rates = FxRate.__table__
+fx_months = FxMonth.__table__
+
+# The whole of fx_months, shared by every user; other workers see an import once it expires
+rate_cache = TTLCache(maxsize=1, ttl=float(os.getenv("FX_CACHE_TTL", 300)))
+RATES_KEY = ("fx",)
+
+
+class MissingRate(LookupError):
+    """No rates have been imported for a currency"""
+
+
+class Rates:
+    """Average and closing rate per currency and month, in units per FX_BASE"""
+
+    def __init__(self, rows):
+        self._months = {}
+        for currency, month, average, closing in rows:
+            months, averages, closings = self._months.setdefault(currency, ([], [], []))
+            months.append(month)
+            averages.append(average)
+            closings.append(closing)
+
+    def has(self, currency):
+        return currency == FX_BASE or currency in self._months
+
+    def rate(self, currency, month, closing=False):
+        """Units of `currency` per FX_BASE in a "YYYY-MM" month"""
+        if currency == FX_BASE:
+            return 1.0
+        if currency not in self._months:
+            raise MissingRate(f"No exchange rates for {currency}; import them with `flask fx import`")
+        months, averages, closings = self._months[currency]
+        index = max(bisect_right(months, month) - 1, 0)
+        return (closings if closing else averages)[index]
+
+    def factor(self, source, target, month, closing=False):
+        """Multiplier from minor units of `source` to minor units of `target`"""
+        if source == target:
+            return 1
+        ratio = self.rate(target, month, closing) / self.rate(source, month, closing)
+        return ratio * 10 ** (minor_digits(target) - minor_digits(source))
+
+    def convert(self, minor, source, target, month, closing=False):
+        """Minor units of `source` in whole minor units of `target`"""
+        if source == target:
+            return minor
+        return round(int(minor) * self.factor(source, target, month, closing))
+
+    def total(self, amounts, target, month, closing=False):
+        """Sum of {currency: minor units} in `target`, each currency converted once"""
+        return sum(self.convert(minor, currency, target, month, closing) for currency, minor in amounts.items())
+
+
+def rates(db):
+    """Every currency's monthly rates, loaded once and cached"""
+    cached = rate_cache.get(RATES_KEY)
+    if cached is MISSING:
+        cached = Rates(db.execute(
+            select(fx_months.c.currency, fx_months.c.month, fx_months.c.average, fx_months.c.closing)
+            .order_by(fx_months.c.currency, fx_months.c.month)
+        ).all())
+        rate_cache.set(RATES_KEY, cached)
+    return cached
+
+
+def foreign_accounts(db, user_id):
+    """(home currency, {account_id: currency} of the user's accounts held in another currency)"""
+    home = refdata.currency(db, user_id)
+    return home, {
+        account.id: account.currency
+        for account in refdata.accounts(db, user_id)
+        if account.currency not in (None, home)
+    }
+
+
+def net_worth(db, user_id, today=None):
+    """Sum of the user's balances in their home currency, at the latest closing rates"""
+    home = refdata.currency(db, user_id)
+    month = (today or date.today()).strftime("%Y-%m")
+    balances = {}
+    for currency, balance in db.execute(
+        select(Account.currency, func.sum(Account.balance))
+        .where(Account.user_id == user_id)
+        .group_by(Account.currency)
+    ):
+        balances[currency or home] = balances.get(currency or home, 0) + int(balance or 0)
+    return rates(db).total(balances, home, month, closing=True)
+
+
+# ====================
+# Import
+# ====================
+def _read(stream, base):
+    """({day: {currency: units per `base`}}, errors) from a long or wide rate file"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = [name.strip() for name in next(reader, [])]
+    lowered = [name.lower() for name in header]
+    days = {}
+    errors = []
+    if not header or lowered[0] != 'date':
+        return days, [(1, "the first column must be date")]
+    long_format = 'currency' in lowered and 'rate' in lowered
+
+    def add(day, currency, value):
+        currency = currency.strip().upper()
+        value = value.strip()
+        # Currencies the app has no use for, and the ECB's N/A for days without a rate
+        if currency not in MINOR_DIGITS or not value or value.upper() == 'N/A':
+            return
+        try:
+            rate = float(value)
+        except ValueError:
+            rate = 0
+        if not rate > 0 or rate == float('inf'):
+            raise ValueError(f"{currency} rate must be a positive number, got {value!r}")
+        days.setdefault(day, {})[currency] = rate
+
+    for line, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            try:
+                day = date.fromisoformat(row[0].strip())
+            except ValueError:
+                raise ValueError("date must be YYYY-MM-DD")
+            if long_format:
+                fields = dict(zip(lowered, row))
+                add(day, fields.get('currency', ''), fields.get('rate', ''))
+            else:
+                for currency, value in zip(header[1:], row[1:]):
+                    if currency:
+                        add(day, currency, value)
+        except ValueError as e:
+            if len(errors) < MAX_ERRORS:
+                errors.append((line, str(e)))
+
+    # Restate every day's rates per FX_BASE
+    for day, found in list(days.items()):
+        found[base] = 1.0
+        if base == FX_BASE:
+            continue
+        if FX_BASE not in found:
+            if len(errors) < MAX_ERRORS:
+                errors.append((0, f"{day.isoformat()} has no {FX_BASE} rate to convert from {base}"))
+            continue
+        per_base = found[FX_BASE]
+        days[day] = {currency: rate / per_base for currency, rate in found.items()}
+    return days, errors
+
+
+def refresh_months(db, months):
+    """Recompute fx_months for some "YYYY-MM" months from fx_rates"""
+    months = set(months)
+    if not months:
+        return
+    first = date.fromisoformat(f"{min(months)}-01")
+    summary = {}
+    for currency, day, rate in db.execute(
+        select(fx_rates.c.currency, fx_rates.c.day, fx_rates.c.rate)
+        .where(fx_rates.c.day >= first)
+        .order_by(fx_rates.c.currency, fx_rates.c.day)
+    ):
+        month = day.strftime("%Y-%m")
+        if month not in months:
+            continue
+        summary.setdefault((currency, month), []).append(rate)
+
+    db.execute(delete(fx_months).where(fx_months.c.month.in_(months)))
+    if summary:
+        db.execute(insert(fx_months), [
+            {'currency': currency, 'month': month, 'average': sum(found) / len(found), 'closing': found[-1]}
+            for (currency, month), found in summary.items()
+        ])
+
+
+def import_rates(db, stream, base=None, chunk_size=500):
+    """Load a CSV byte stream of rates quoted against `base` (FX_BASE by default).
+
+    Returns a dict with the number of days and rates read, the currencies
+    found and a list of (line, message) errors. Rates already stored for
+    the file's dates are replaced; nothing is written if any line fails.
+    The caller commits.
+    """
+    base = (base or FX_BASE).upper()
+    result = {'days': 0, 'rates': 0, 'currencies': [], 'errors': []}
+    if base not in MINOR_DIGITS:
+        result['errors'].append((0, f"unsupported base currency {base}"))
+        return result
+    days, result['errors'] = _read(stream, base)
+    if result['errors']:
+        return result
+
+    rows = [{'day': day, 'currency': currency, 'rate': rate}
+            for day, found in days.items() for currency, rate in found.items()]
+    ordered = sorted(days)
+    for start in range(0, len(ordered), chunk_size):
+        db.execute(delete(fx_rates).where(fx_rates.c.day.in_(ordered[start:start + chunk_size])))
+    if rows:
+        db.execute(insert(fx_rates), rows)
+    refresh_months(db, {day.strftime("%Y-%m") for day in days})
+    rate_cache.clear()
+
+    result['days'] = len(days)
+    result['rates'] = len(rows)
+    result['currencies'] = sorted({row['currency'] for row in rows})
+    return result
@@ -1,6 +1,9 @@
-from flask import redirect, render_template, session
+from flask import Response, abort, current_app, g, redirect, render_template, request, session
 from functools import wraps
+import hmac
 from datetime import date
+from decimal import Decimal
+from money import DEFAULT_CURRENCY, Money, minor_digits
 
 
 def login_required(f):
@@ -13,13 +16,44 @@ def login_required(f):
     return decorated_function
 
 
+def metrics_required(f):
+    """Serve a metrics endpoint only to requests carrying METRICS_TOKEN as a bearer token"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = current_app.config.get("METRICS_TOKEN")
+        if not token:
+            abort(404)
+        sent = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+            return Response("Unauthorized\n", 401, {"WWW-Authenticate": "Bearer"}, mimetype="text/plain")
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 def apology(message, code=400):
     return render_template("apology.html", top=code, bottom=message), code
 
 
-def usd(value):
-    """Format value as USD."""
-    return f"${value:,.2f}"
+def usd(value, currency=None):
+    """Format integer minor units (or Money) in the user's currency."""
+    if isinstance(value, Money):
+        return value.format()
+    return Money(value, currency or g.get("currency", DEFAULT_CURRENCY)).format()
+
+
+def major(value, currency=None):
+    """Integer minor units as a plain decimal string, e.g. for form values."""
+    return str(Money(value, currency or g.get("currency", DEFAULT_CURRENCY)))
+
+
+def money_step(currency=None):
+    """Smallest amount a form field accepts in the user's currency."""
+    return str(Decimal(1).scaleb(-minor_digits(currency or g.get("currency", DEFAULT_CURRENCY))))
+
+def amount_step(accounts):
+    """Finest money_step() among some accounts' currencies, for an amount field shared by all of them."""
+    return min((money_step(account.currency) for account in accounts), key=Decimal, default=money_step())
 
 def row_to_dict(row):
     return dict(row._mapping) if hasattr(row, '_mapping') else row
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""Bulk CSV import of transactions.
+
+The file is parsed as a stream, rows are validated against account and
+category maps built once per import, and valid rows are written with Core
+executemany inserts in batches and added to the search index. Rollup and
+balance changes are accumulated in memory and applied once per bucket and
+account-month at the end, all inside the caller's single database
+transaction.
+
+Amounts are decimal strings in the currency of the row's account and are
+stored as integer minor units; a row with a currency column (as exported)
+must name that currency.
+
+Expected columns (the same ones /export produces; extra columns are ignored):
+date, type, amount, currency, category, account, description, person_name, direction
+"""
+import csv
+import io
+from datetime import date
+from sqlalchemy import insert
+from models import Transaction
+from money import to_minor
+import budget_states
+import ledger
+import refdata
+import rollups
+import search
+
+IMPORT_TYPES = ('income', 'expense', 'personal')
+REQUIRED_COLUMNS = ('date', 'type', 'amount')
+# Stop collecting errors past this point; the import fails either way
+MAX_ERRORS = 100
+
+
+def _lookup_maps(db, user_id):
+    accounts = {
+        account.name.strip().lower(): account.id
+        for account in refdata.accounts(db, user_id)
+    }
+    # Presets come first so a user's custom category wins on a name clash
+    categories = {
+        (category.type, category.name.strip().lower()): category.id
+        for category in refdata.categories(db, user_id)
+    }
+    home = refdata.currency(db, user_id, for_update=True)
+    currencies = {account.id: account.currency or home for account in refdata.accounts(db, user_id)}
+    return accounts, categories, currencies
+
+
+def _parse_row(row, user_id, default_account_id, accounts, categories, currencies):
+    """Turn one CSV record into an insert dict, or raise ValueError"""
+    trans_type = (row.get('type') or '').strip().lower()
+    if trans_type not in IMPORT_TYPES:
+        raise ValueError(f"type must be one of {', '.join(IMPORT_TYPES)}")
+
+    try:
+        day = date.fromisoformat((row.get('date') or '').strip())
+    except ValueError:
+        raise ValueError("date must be YYYY-MM-DD")
+
+    account_name = (row.get('account') or '').strip().lower()
+    account_id = accounts.get(account_name) if account_name else default_account_id
+    if account_id is None or account_id not in currencies:
+        raise ValueError(f"unknown account '{row.get('account')}'")
+
+    currency = currencies[account_id]
+    stated = (row.get('currency') or '').strip().upper()
+    if stated and stated != currency:
+        raise ValueError(f"amount is in {stated} but the account holds {currency}")
+    try:
+        amount = to_minor(row.get('amount') or '', currency)
+    except ValueError as e:
+        raise ValueError(f"amount: {e}")
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+
+    category_id = None
+    person_name = None
+    direction = None
+    if trans_type == 'personal':
+        person_name = (row.get('person_name') or '').strip()
+        direction = (row.get('direction') or '').strip().lower()
+        if not person_name or direction not in ('lent', 'borrowed'):
+            raise ValueError("personal rows need person_name and direction lent/borrowed")
+    else:
+        category_name = (row.get('category') or '').strip().lower() or 'other'
+        category_id = categories.get((trans_type, category_name))
+        if category_id is None:
+            raise ValueError(f"unknown {trans_type} category '{row.get('category')}'")
+
+    return {
+        'user_id': user_id,
+        'account_id': account_id,
+        'category_id': category_id,
+        'amount': amount,
+        'description': (row.get('description') or '').strip() or None,
+        'date': day,
+        'type': trans_type,
+        'person_name': person_name,
+        'direction': direction,
+    }
+
+
+def _insert(db, user_id, batch):
+    ledger.begin(db)
+    table = Transaction.__table__
+    ids = db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), batch).scalars().all()
+    for values, id_ in zip(batch, ids):
+        values['id'] = id_
+    search.record(db, user_id, batch)
+
+
+def import_csv(db, user_id, default_account_id, stream, dry_run=False, batch_size=5000, progress=None):
+    """Import a CSV byte stream for a user.
+
+    Returns a dict with the number of rows read, rows imported and a list of
+    (line, message) errors. Nothing is written when dry_run is set or when any
+    row fails validation; otherwise the caller commits. `progress`, if given,
+    is called with the number of rows read so far every `batch_size` rows.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    result = {'rows': 0, 'imported': 0, 'errors': [], 'dry_run': dry_run}
+
+    fields = [name.strip().lower() for name in (reader.fieldnames or [])]
+    missing = [name for name in REQUIRED_COLUMNS if name not in fields]
+    if missing:
+        result['errors'].append((1, f"missing column(s): {', '.join(missing)}"))
+        return result
+    reader.fieldnames = fields
+
+    # Amounts are parsed in the user's currency, which must not change before the rows are written
+    if not dry_run:
+        ledger.begin(db)
+    accounts, categories, currencies = _lookup_maps(db, user_id)
+    balance_deltas = {}
+    rollup_deltas = {}
+    batch = []
+
+    for line, row in enumerate(reader, start=2):
+        result['rows'] += 1
+        if progress is not None and result['rows'] % batch_size == 0:
+            progress(result['rows'])
+        try:
+            values = _parse_row(row, user_id, default_account_id, accounts, categories, currencies)
+        except ValueError as e:
+            if len(result['errors']) < MAX_ERRORS:
+                result['errors'].append((line, str(e)))
+            continue
+
+        if result['errors'] or dry_run:
+            continue
+
+        account_id = values['account_id']
+        month = values['date'].strftime("%Y-%m")
+        balance_key = (account_id, month)
+        balance_deltas[balance_key] = balance_deltas.get(balance_key, 0) + \
+            ledger.balance_effect(values['type'], values['direction'], values['amount'])
+        key = (account_id, values['category_id'], values['type'], month)
+        bucket = rollup_deltas.setdefault(key, [0, 0])
+        bucket[0] += values['amount']
+        bucket[1] += 1
+
+        batch.append(values)
+        if len(batch) >= batch_size:
+            _insert(db, user_id, batch)
+            result['imported'] += len(batch)
+            batch = []
+
+    if result['errors']:
+        db.rollback()
+        result['imported'] = 0
+        return result
+
+    if dry_run:
+        return result
+
+    if batch:
+        _insert(db, user_id, batch)
+        result['imported'] += len(batch)
+
+    rollups.apply_many(db, user_id, rollup_deltas)
+    budget_states.apply_many(db, user_id, rollup_deltas)
+    ledger.post_many(db, user_id, balance_deltas)
+
+    return result
@@ -0,0 +1,334 @@
+"""In-process background jobs backed by a local SQLite queue.
+
+Routes enqueue work with JobQueue.enqueue() and poll it with get(); worker
+threads started by init_jobs() claim queued jobs and run the handler
+registered for their kind with @task. Nothing beyond the standard library
+is needed, and the queue survives restarts because it lives in its own
+SQLite file (JOBS_SQLITE_PATH) next to the session store.
+
+- Claiming is one BEGIN IMMEDIATE transaction, so several processes (or
+  `flask jobs work`) can share the queue without running a job twice.
+- A user never has more than JOBS_PER_USER jobs running at once, so one
+  heavy user cannot occupy every worker.
+- A handler that raises is retried with exponential backoff until its
+  task's max_attempts is used up. A running job holds a lease that its
+  progress reports renew; jobs whose worker died are requeued once the
+  lease runs out.
+- Handlers report progress through the JobContext they receive.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from pathlib import Path
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+TASKS = {}
+
+
+def task(kind, max_attempts=3):
+    """Register `handler(ctx, **params)` as the runner for jobs of `kind`"""
+    def register(handler):
+        TASKS[kind] = (handler, max_attempts)
+        return handler
+    return register
+
+
+class JobStore:
+    """The jobs table in a standalone SQLite file, one connection per thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user_id INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "params TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'queued', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "max_attempts INTEGER NOT NULL, "
+            "progress REAL NOT NULL DEFAULT 0, "
+            "message TEXT, "
+            "result TEXT, "
+            "error TEXT, "
+            "created_at REAL NOT NULL, "
+            "run_after REAL NOT NULL, "
+            "started_at REAL, "
+            "finished_at REAL, "
+            "lease_until REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_status ON jobs (user_id, status)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, user_id, kind, params, max_attempts, now):
+        return self._connect().execute(
+            "INSERT INTO jobs (user_id, kind, params, max_attempts, created_at, run_after) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, kind, json.dumps(params), max_attempts, now, now)
+        ).lastrowid
+
+    def get(self, job_id):
+        return self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def recent(self, user_id, limit=20):
+        return self._connect().execute(
+            "SELECT * FROM jobs WHERE user_id = ? ORDER BY id DESC LIMIT ?", (user_id, limit)
+        ).fetchall()
+
+    def claim(self, now, per_user, lease):
+        """Mark the oldest runnable job as running and return it, or None.
+
+        Jobs of users already running `per_user` jobs are skipped.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND run_after <= ? "
+                "AND user_id NOT IN ("
+                "SELECT user_id FROM jobs WHERE status = 'running' "
+                "GROUP BY user_id HAVING COUNT(*) >= ?) "
+                "ORDER BY run_after, id LIMIT 1",
+                (now, per_user)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                    "started_at = ?, lease_until = ?, error = NULL WHERE id = ?",
+                    (now, now + lease, row["id"])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return None if row is None else self.get(row["id"])
+
+    def report(self, job_id, progress, message, lease_until):
+        self._connect().execute(
+            "UPDATE jobs SET progress = ?, message = ?, lease_until = ? WHERE id = ? AND status = 'running'",
+            (progress, message, lease_until, job_id)
+        )
+
+    def finish(self, job_id, result, now):
+        self._connect().execute(
+            "UPDATE jobs SET status = 'done', progress = 1, result = ?, finished_at = ?, lease_until = NULL "
+            "WHERE id = ?",
+            (json.dumps(result), now, job_id)
+        )
+
+    def retry(self, job_id, error, run_after):
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', error = ?, run_after = ?, lease_until = NULL WHERE id = ?",
+            (error, run_after, job_id)
+        )
+
+    def fail(self, job_id, error, now):
+        self._connect().execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+            (error, now, job_id)
+        )
+
+    def recover(self, now):
+        """Requeue (or fail, if out of attempts) running jobs whose lease expired"""
+        conn = self._connect()
+        failed = conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Worker stopped responding', finished_at = ?, "
+            "lease_until = NULL WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+            (now, now)
+        ).rowcount
+        requeued = conn.execute(
+            "UPDATE jobs SET status = 'queued', run_after = ?, lease_until = NULL "
+            "WHERE status = 'running' AND lease_until < ?",
+            (now, now)
+        ).rowcount
+        return requeued + failed
+
+    def sweep(self, before):
+        """Delete finished jobs older than `before`, returning their rows"""
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (before,)
+        ).fetchall()
+        conn.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+        return rows
+
+    def counts(self):
+        return dict(self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class JobContext:
+    """What a running handler sees: its job and a way to report progress"""
+
+    # Progress writes are throttled to one per this many seconds
+    REPORT_INTERVAL = 0.5
+
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.job_id = row["id"]
+        self.user_id = row["user_id"]
+        self.attempt = row["attempts"]
+        self.max_attempts = row["max_attempts"]
+        self._reported = 0.0
+
+    @property
+    def last_attempt(self):
+        return self.attempt >= self.max_attempts
+
+    def progress(self, done, total=None, message=None):
+        """Record progress as done/total (or a 0-1 fraction) and renew the lease"""
+        now = time.time()
+        fraction = done / total if total else done
+        if now - self._reported < self.REPORT_INTERVAL and fraction < 1:
+            return
+        self._reported = now
+        self.queue.store.report(self.job_id, min(max(fraction, 0.0), 1.0), message, now + self.queue.lease)
+
+
+class JobQueue:
+    """Enqueue/poll API plus the worker threads that drain the queue"""
+
+    def __init__(self, store, workers=2, per_user=1, lease=300, poll_interval=1.0, teardown=None):
+        self.store = store
+        self.workers = workers
+        self.per_user = per_user
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.teardown = teardown
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._recovered_at = 0.0
+
+    def enqueue(self, user_id, kind, **params):
+        """Queue a job and return its id"""
+        if kind not in TASKS:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        job_id = self.store.add(user_id, kind, params, TASKS[kind][1], time.time())
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id, user_id=None):
+        """A job as a dict, or None if it does not exist (or belongs to another user)"""
+        row = self.store.get(job_id)
+        if row is None or (user_id is not None and row["user_id"] != user_id):
+            return None
+        return job_dict(row)
+
+    def recent(self, user_id, limit=20):
+        return [job_dict(row) for row in self.store.recent(user_id, limit)]
+
+    def run_next(self):
+        """Claim and run one job in the calling thread; False when none was runnable"""
+        now = time.time()
+        if now - self._recovered_at > self.lease / 4:
+            self._recovered_at = now
+            self.store.recover(now)
+        row = self.store.claim(now, self.per_user, self.lease)
+        if row is None:
+            return False
+
+        handler, _ = TASKS.get(row["kind"], (None, 0))
+        context = JobContext(self, row)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for '{row['kind']}'")
+            result = handler(context, **json.loads(row["params"]))
+            self.store.finish(row["id"], result, time.time())
+        except Exception as e:
+            print(f"Job {row['id']} ({row['kind']}) error: {e}")
+            error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            if handler is not None and not context.last_attempt:
+                # Back off 2, 4, 8... seconds between attempts
+                self.store.retry(row["id"], error, time.time() + 2 ** context.attempt)
+            else:
+                self.store.fail(row["id"], error, time.time())
+        finally:
+            if self.teardown is not None:
+                self.teardown()
+        return True
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                ran = self.run_next()
+            except sqlite3.OperationalError as e:
+                # Queue file busy past the connection timeout; try again shortly
+                print(f"Job queue error: {e}")
+                ran = False
+            if not ran:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def start(self):
+        """Start any missing worker threads (daemons, so they never block shutdown)"""
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            for n in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._stop.clear()
+
+
+def job_dict(row):
+    """JSON-friendly view of a job row"""
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "progress": round(row["progress"], 4),
+        "message": row["message"],
+        "attempts": row["attempts"],
+        "max_attempts": row["max_attempts"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+
+
+def init_jobs(app, teardown=None):
+    """Create the app's JobQueue from the environment.
+
+    Workers start with the first request the process serves, so CLI
+    commands and the reloader's parent process never run jobs. JOBS_WORKERS=0
+    leaves the queue to a separate `flask jobs work` process.
+    """
+    queue = JobQueue(
+        JobStore(os.getenv("JOBS_SQLITE_PATH", "data/jobs.db")),
+        workers=int(os.getenv("JOBS_WORKERS", 2)),
+        per_user=int(os.getenv("JOBS_PER_USER", 1)),
+        lease=float(os.getenv("JOBS_LEASE", 300)),
+        poll_interval=float(os.getenv("JOBS_POLL_INTERVAL", 1.0)),
+        teardown=teardown,
+    )
+    app.extensions["jobs"] = queue
+    app.before_request(queue.start)
+    return queue
@@ -0,0 +1,329 @@
+"""Account balances derived from the transaction ledger.
+
+Every transaction is a signed entry on its account's ledger: income and
+borrowed money add to the balance, everything else subtracts. An account's
+balance is its opening_balance plus all of its entries. balance_snapshots
+keeps the closing balance of every month in which the account had
+activity, so the balance on any date is the latest earlier snapshot plus a
+scan of at most one month of entries.
+
+Write routes call record()/unrecord() (post_many() for bulk imports)
+inside their own database transaction; these are the only writers of
+Account.balance, which is kept as the cached current balance. rebuild()
+regenerates balances and snapshots from the ledger and verify() reports
+anything that has drifted; entries moved to cold storage count through
+their archived_totals (archive.py).
+
+Balances change only through single UPDATE statements (balance = balance
++ delta), never by reading a balance and writing it back. An entry that
+must be covered, like the outgoing leg of a transfer, is posted with
+require_funds: the UPDATE only matches while the balance covers it, and
+InsufficientFunds is raised when no row changed, so two concurrent
+transfers can never both spend the same money. Balance-changing routes
+start their transaction with begin(), which on SQLite takes the write lock
+up front (BEGIN IMMEDIATE) instead of upgrading a read lock midway, and
+retries a few times when another writer holds it.
+"""
+from collections import defaultdict
+import os
+import random
+import time
+from sqlalchemy import bindparam, case, delete, func, insert, or_, select, union_all, update
+from sqlalchemy.exc import OperationalError
+from models import Account, ArchivedTotal, BalanceSnapshot, Transaction
+from queries import month_bounds, month_bucket
+import archive
+
+# Attempts at taking SQLite's write lock, each waiting up to the busy timeout
+LOCK_ATTEMPTS = int(os.getenv("LEDGER_LOCK_ATTEMPTS", 3))
+
+accounts = Account.__table__
+snapshots = BalanceSnapshot.__table__
+
+
+class InsufficientFunds(ValueError):
+    """An entry that must be covered would take the account's balance below zero"""
+
+
+def begin(db):
+    """Start a balance-changing transaction; on SQLite take the write lock now (BEGIN IMMEDIATE).
+
+    Does nothing when the session's connection is already in a
+    transaction. Lock contention is retried LOCK_ATTEMPTS times with a
+    short random backoff before the OperationalError is raised.
+    """
+    conn = db.connection()
+    if conn.dialect.name != "sqlite" or conn.connection.dbapi_connection.in_transaction:
+        return
+    for attempt in range(1, LOCK_ATTEMPTS + 1):
+        try:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        except OperationalError as e:
+            if attempt == LOCK_ATTEMPTS or "locked" not in str(e.orig):
+                raise
+            time.sleep(random.uniform(0, 0.05 * attempt))
+
+
+def _month_of(day):
+    return day.strftime("%Y-%m")
+
+
+def balance_effect(trans_type, direction, amount):
+    """Signed change a transaction makes to its account balance"""
+    if trans_type == 'income' or direction == 'borrowed':
+        return amount
+    return -amount
+
+
+def signed_amount(amount=Transaction.amount, trans_type=Transaction.type, direction=Transaction.direction):
+    """SQL expression for a transaction's ledger entry (or an archived total's)"""
+    return case(
+        (or_(trans_type == 'income', direction == 'borrowed'), amount),
+        else_=-amount
+    )
+
+
+def entries(user_id, account_id):
+    """SELECT of an account's ledger (id, date, signed amount), oldest first"""
+    return select(Transaction.id, Transaction.date, signed_amount().label('amount'))\
+        .where(Transaction.user_id == user_id, Transaction.account_id == account_id)\
+        .order_by(Transaction.date, Transaction.id)
+
+
+def closing_before(db, account_id, month):
+    """Balance at the start of `month`: the latest earlier snapshot, else the opening balance"""
+    balance = db.execute(
+        select(snapshots.c.balance)
+        .where(snapshots.c.account_id == account_id, snapshots.c.month < month)
+        .order_by(snapshots.c.month.desc())
+        .limit(1)
+    ).scalar()
+    if balance is None:
+        balance = db.execute(select(accounts.c.opening_balance).where(accounts.c.id == account_id)).scalar()
+    return balance or 0
+
+
+def post(db, user_id, account_id, month, delta, require_funds=False):
+    """Add a ledger delta dated in `month` to the balance and every snapshot from `month` on.
+
+    With require_funds a negative delta is only applied while the balance
+    covers it; otherwise nothing is written and InsufficientFunds is raised.
+    """
+    if not delta:
+        return
+
+    stmt = update(accounts).where(accounts.c.id == account_id).values(balance=accounts.c.balance + delta)
+    if require_funds and delta < 0:
+        if not db.execute(stmt.where(accounts.c.balance >= -delta)).rowcount:
+            raise InsufficientFunds("Insufficient balance in source account")
+    else:
+        db.execute(stmt)
+    db.execute(
+        update(snapshots)
+        .where(snapshots.c.account_id == account_id, snapshots.c.month >= month)
+        .values(balance=snapshots.c.balance + delta)
+    )
+
+    exists = db.execute(
+        select(snapshots.c.id).where(snapshots.c.account_id == account_id, snapshots.c.month == month)
+    ).first()
+    if exists is None:
+        db.execute(insert(snapshots).values(
+            user_id=user_id,
+            account_id=account_id,
+            month=month,
+            balance=closing_before(db, account_id, month) + delta
+        ))
+
+
+def post_many(db, user_id, deltas):
+    """Apply {(account_id, month): delta} for one user, e.g. after a bulk import"""
+    for (account_id, month), delta in sorted(deltas.items()):
+        post(db, user_id, account_id, month, delta)
+
+
+def record(db, transaction, require_funds=False):
+    """Post a newly added transaction to its account"""
+    post(db, transaction.user_id, transaction.account_id, _month_of(transaction.date),
+         balance_effect(transaction.type, transaction.direction, transaction.amount), require_funds)
+
+
+def unrecord(db, transaction):
+    """Reverse a deleted transaction's entry"""
+    post(db, transaction.user_id, transaction.account_id, _month_of(transaction.date),
+         -balance_effect(transaction.type, transaction.direction, transaction.amount))
+
+
+def drop_account(db, account_id):
+    """Forget the snapshots of a deleted account"""
+    db.execute(delete(snapshots).where(snapshots.c.account_id == account_id))
+
+
+def balance_as_of(db, user_id, account_id, day):
+    """Closing balance of an account on `day`: nearest snapshot plus that month's entries"""
+    month = _month_of(day)
+    start, _ = month_bounds(month)
+    since = db.execute(
+        select(func.coalesce(func.sum(signed_amount()), 0))
+        .where(
+            Transaction.user_id == user_id,
+            Transaction.account_id == account_id,
+            Transaction.date >= start,
+            Transaction.date <= day
+        )
+    ).scalar()
+    return closing_before(db, account_id, month) + since + archive.net(db, user_id, account_id, start, day)
+
+
+def balance_series(db, user_id, months):
+    """Month-end balance of each of the user's accounts over consecutive "YYYY-MM" months.
+
+    Returns [{'id', 'name', 'balances'}] where balances lines up with
+    `months`; months before an account existed are None. Reads one
+    carried-in snapshot per account plus the snapshots inside the window.
+    """
+    first, last = months[0], months[-1]
+    owned = db.execute(
+        select(accounts.c.id, accounts.c.name, accounts.c.opening_balance, accounts.c.created_at)
+        .where(accounts.c.user_id == user_id)
+        .order_by(accounts.c.created_at, accounts.c.id)
+    ).all()
+
+    latest_before = select(snapshots.c.account_id, func.max(snapshots.c.month).label('month'))\
+        .where(snapshots.c.user_id == user_id, snapshots.c.month < first)\
+        .group_by(snapshots.c.account_id)\
+        .subquery()
+    carried = dict(db.execute(
+        select(snapshots.c.account_id, snapshots.c.balance)
+        .join(latest_before, (snapshots.c.account_id == latest_before.c.account_id) &
+              (snapshots.c.month == latest_before.c.month))
+    ).all())
+
+    in_window = defaultdict(dict)
+    for account_id, month, balance in db.execute(
+        select(snapshots.c.account_id, snapshots.c.month, snapshots.c.balance)
+        .where(snapshots.c.user_id == user_id, snapshots.c.month >= first, snapshots.c.month <= last)
+    ):
+        in_window[account_id][month] = balance
+
+    series = []
+    for account in owned:
+        # Imports can date entries before the account was created
+        opened = _month_of(account.created_at) if account.created_at else first
+        if account.id in carried:
+            opened = first
+        elif in_window[account.id]:
+            opened = min(opened, min(in_window[account.id]))
+        balance = carried.get(account.id, account.opening_balance)
+        balances = []
+        for month in months:
+            balance = in_window[account.id].get(month, balance)
+            balances.append(balance if month >= opened else None)
+        series.append({'id': account.id, 'name': account.name, 'balances': balances})
+    return series
+
+
+def _expected(db, user_id=None):
+    """Balances and snapshots recomputed from scratch: ({account_id: balance}, {(account_id, month): (user_id, balance)})"""
+    query = select(accounts.c.id, accounts.c.user_id, accounts.c.opening_balance)
+    if user_id is not None:
+        query = query.where(accounts.c.user_id == user_id)
+    balances = {}
+    owners = {}
+    for account_id, owner, opening in db.execute(query):
+        balances[account_id] = opening
+        owners[account_id] = owner
+
+    month = month_bucket(Transaction.date)
+    hot = select(Transaction.account_id, month.label('month'), func.sum(signed_amount()).label('net'))\
+        .group_by(Transaction.account_id, month)
+    archived = select(ArchivedTotal.account_id, ArchivedTotal.month, signed_amount(ArchivedTotal.total, ArchivedTotal.type, ArchivedTotal.direction))
+    if user_id is not None:
+        hot = hot.where(Transaction.user_id == user_id)
+        archived = archived.where(ArchivedTotal.user_id == user_id)
+    rows = union_all(hot, archived).subquery()
+    monthly = select(rows.c.account_id, rows.c.month, func.sum(rows.c.net))\
+        .group_by(rows.c.account_id, rows.c.month)\
+        .order_by(rows.c.account_id, rows.c.month)
+
+    expected = {}
+    for account_id, month, net in db.execute(monthly):
+        if account_id not in balances:
+            continue
+        balances[account_id] += net
+        expected[(account_id, month)] = (owners[account_id], balances[account_id])
+    return balances, expected
+
+
+def reset_openings(db):
+    """Treat whatever transactions don't explain as each account's opening balance.
+
+    Used once when opening_balance is introduced on an existing database.
+    """
+    net = select(func.coalesce(func.sum(signed_amount()), 0))\
+        .where(Transaction.account_id == accounts.c.id)\
+        .scalar_subquery()
+    db.execute(update(accounts).values(opening_balance=accounts.c.balance - net))
+
+
+def rebuild(db, user_id=None):
+    """Regenerate balances and snapshots (for one user or everyone) from the ledger and commit"""
+    regenerate(db, user_id)
+    db.commit()
+
+
+def regenerate(db, user_id=None):
+    """Regenerate balances and snapshots inside the caller's transaction, which commits"""
+    # Nothing may post between reading the ledger and writing the balances
+    begin(db)
+    balances, expected = _expected(db, user_id)
+
+    if balances:
+        db.execute(
+            update(accounts).where(accounts.c.id == bindparam('account_id')).values(balance=bindparam('value')),
+            [{'account_id': account_id, 'value': value} for account_id, value in balances.items()]
+        )
+
+    stmt = delete(snapshots)
+    if user_id is not None:
+        stmt = stmt.where(snapshots.c.user_id == user_id)
+    db.execute(stmt)
+    if expected:
+        db.execute(insert(snapshots), [
+            {'user_id': owner, 'account_id': account_id, 'month': month, 'balance': balance}
+            for (account_id, month), (owner, balance) in expected.items()
+        ])
+
+
+def verify(db, user_id=None):
+    """Return a list of (what, key, expected, actual) for every balance or snapshot that disagrees"""
+    balances, expected = _expected(db, user_id)
+    problems = []
+
+    query = select(accounts.c.id, accounts.c.balance)
+    if user_id is not None:
+        query = query.where(accounts.c.user_id == user_id)
+    for account_id, balance in db.execute(query):
+        if balance != balances[account_id]:
+            problems.append(('balance', account_id, balances[account_id], balance))
+
+    query = select(snapshots.c.account_id, snapshots.c.month, snapshots.c.balance)
+    if user_id is not None:
+        query = query.where(snapshots.c.user_id == user_id)
+    actual = {(account_id, month): balance for account_id, month, balance in db.execute(query)}
+    openings = dict(db.execute(select(accounts.c.id, accounts.c.opening_balance)).all())
+
+    # A month without a snapshot carries the previous balance forward, so
+    # compare the carried-forward values rather than the rows themselves
+    carried_want = {}
+    carried_got = {}
+    for key in sorted(expected.keys() | actual.keys()):
+        account_id, month = key
+        want = expected[key][1] if key in expected else carried_want.get(account_id, openings.get(account_id))
+        got = actual.get(key, carried_got.get(account_id, openings.get(account_id)))
+        if want != got:
+            problems.append(('snapshot', key, want, got))
+        carried_want[account_id] = want
+        carried_got[account_id] = got
+    return problems
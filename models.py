@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, CheckConstraint, UniqueConstraint, Index
+from sqlalchemy import create_engine, Column, Integer, BigInteger, Float, String, Text, Boolean, Date, DateTime, ForeignKey, CheckConstraint, UniqueConstraint, Index
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import date
 
@@ -26,7 +26,12 @@ class Account(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     name = Column(String, nullable=False)
     type = Column(String, nullable=False)
-    balance = Column(Float, nullable=False, default=0)
+    # Currency the account is held in; NULL follows the user's currency (fx.py)
+    currency = Column(String, nullable=True)
+    # Money columns hold integer minor units of the account's currency (money.py)
+    # balance caches opening_balance plus the account's ledger (ledger.py)
+    balance = Column(BigInteger, nullable=False, default=0)
+    opening_balance = Column(BigInteger, nullable=False, default=0, server_default='0')
     created_at = Column(Date, default=date.today)
     
     __table_args__ = (
@@ -62,7 +67,7 @@ class Transaction(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     account_id = Column(Integer, ForeignKey('accounts.id'), nullable=True)
     category_id = Column(Integer, ForeignKey('categories.id'), nullable=True)
-    amount = Column(Float, nullable=False)
+    amount = Column(BigInteger, nullable=False)
     description = Column(String, nullable=True)
     date = Column(Date, default=date.today, nullable=False)
     type = Column(String, nullable=False)
@@ -75,6 +80,15 @@ class Transaction(Base):
         Index('idx_transactions_user', 'user_id'),
         Index('idx_transactions_account', 'account_id'),
         Index('idx_transactions_date', 'date'),
+        # Composite indexes backing the month-window queries in queries.py
+        Index('idx_transactions_user_account_type_date', 'user_id', 'account_id', 'type', 'date'),
+        Index('idx_transactions_user_category_type_date', 'user_id', 'category_id', 'type', 'date'),
+        Index('idx_transactions_user_type_date', 'user_id', 'type', 'date'),
+        # Keyset pagination on (date, id); id is the rowid so it is implied
+        Index('idx_transactions_user_date', 'user_id', 'date'),
+        Index('idx_transactions_user_account_date', 'user_id', 'account_id', 'date'),
+        # Ids are never handed out twice, even once the newest rows were archived (archive.py)
+        {'sqlite_autoincrement': True},
     )
     
     user = relationship("User", back_populates="transactions")
@@ -87,7 +101,7 @@ class Budget(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
-    monthly_limit = Column(Float, nullable=False)
+    monthly_limit = Column(BigInteger, nullable=False)
     month = Column(String, nullable=False)
     
     __table_args__ = (
@@ -105,7 +119,8 @@ class Transfer(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     from_account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
     to_account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
-    amount = Column(Float, nullable=False)
+    # In the source account's currency; the incoming transaction holds the converted amount
+    amount = Column(BigInteger, nullable=False)
     date = Column(Date, default=date.today(), nullable=False)
     description = Column(String, nullable=True)
     
@@ -117,6 +132,137 @@ class Transfer(Base):
     from_account = relationship("Account", foreign_keys=[from_account_id])
     to_account = relationship("Account", foreign_keys=[to_account_id])
 
+class MonthlyRollup(Base):
+    __tablename__ = 'monthly_rollups'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=True)
+    category_id = Column(Integer, ForeignKey('categories.id'), nullable=True)
+    type = Column(String, nullable=False)
+    month = Column(String, nullable=False)
+    total = Column(BigInteger, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        CheckConstraint("type IN ('income', 'expense', 'personal')", name='check_rollup_type'),
+        Index('idx_rollups_user_month_type', 'user_id', 'month', 'type', 'account_id', 'category_id'),
+    )
+
+class BalanceSnapshot(Base):
+    __tablename__ = 'balance_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
+    month = Column(String, nullable=False)
+    # Closing balance at the end of `month`, opening balance included
+    balance = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('account_id', 'month', name='unique_snapshot_per_month'),
+        Index('idx_snapshots_user_month', 'user_id', 'month'),
+    )
+
+class BudgetState(Base):
+    __tablename__ = 'budget_states'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
+    month = Column(String, nullable=False)
+    # The budget's limit and the month's expenses in its category so far (budget_states.py)
+    monthly_limit = Column(BigInteger, nullable=False)
+    spent = Column(BigInteger, nullable=False, default=0)
+    # Highest threshold (percent of the limit) spending has reached, 0 below all of them
+    level = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'category_id', 'month', name='unique_budget_state_per_month'),
+        # Dashboard alerts: a user's month at or above a threshold
+        Index('idx_budget_states_alerts', 'user_id', 'month', 'level'),
+    )
+
+class BudgetEvent(Base):
+    __tablename__ = 'budget_events'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
+    month = Column(String, nullable=False)
+    # Threshold crossed on the way up, and the percent of the limit spent at that point
+    threshold = Column(Integer, nullable=False)
+    percent = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('idx_budget_events_user_month', 'user_id', 'month'),
+    )
+
+class ChartPayload(Base):
+    __tablename__ = 'chart_payloads'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    chart = Column(String, nullable=False)
+    # Last month of the 12-month window the payload was computed for
+    month = Column(String, nullable=False)
+    # Serialized JSON served as-is by /api/analytics/<chart> (charts.py)
+    data = Column(Text, nullable=False)
+    etag = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    stale = Column(Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'chart', name='unique_chart_per_user'),
+    )
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    key = Column(String, nullable=False)
+    # SHA-256 of the request body, so a reused key with a different batch is refused
+    request_hash = Column(String, nullable=False)
+    # Response replayed for a retry of the same request (batch.py)
+    status = Column(Integer, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'key', name='unique_idempotency_key_per_user'),
+        Index('idx_idempotency_keys_user_created', 'user_id', 'created_at'),
+    )
+
+class RecurringRule(Base):
+    __tablename__ = 'recurring_rules'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
+    category_id = Column(Integer, ForeignKey('categories.id'), nullable=True)
+    type = Column(String, nullable=False)
+    amount = Column(BigInteger, nullable=False)
+    description = Column(String, nullable=True)
+    # Every `interval` days, weeks or months from start_date (recurring.py)
+    frequency = Column(String, nullable=False)
+    interval = Column(Integer, nullable=False, default=1)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=True)
+    # Occurrences written so far; next_due is the next one, NULL once the rule has ended
+    occurrences = Column(Integer, nullable=False, default=0)
+    next_due = Column(Date, nullable=True)
+
+    __table_args__ = (
+        CheckConstraint("type IN ('income', 'expense')", name='check_recurring_type'),
+        CheckConstraint("frequency IN ('daily', 'weekly', 'monthly')", name='check_recurring_frequency'),
+        CheckConstraint("interval >= 1", name='check_recurring_interval'),
+        Index('idx_recurring_rules_user', 'user_id'),
+        # The scheduler only ever reads rules that are due
+        Index('idx_recurring_rules_next_due', 'next_due'),
+    )
+
 PRESET_CATEGORIES = [
     # Expense categories
     ('Groceries', 'expense'), ('Rent', 'expense'), ('Entertainment', 'expense'),
@@ -126,4 +272,65 @@ PRESET_CATEGORIES = [
     # Income categories
     ('Salary', 'income'), ('Freelance', 'income'), ('Investment', 'income'),
     ('Gift', 'income'), ('Other', 'income')
-]
\ No newline at end of file
+]
+
+class FxRate(Base):
+    __tablename__ = 'fx_rates'
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    currency = Column(String, nullable=False)
+    # Units of `currency` per one FX_BASE on `day` (fx.py)
+    rate = Column(Float, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('currency', 'day', name='unique_fx_rate_per_day'),
+        Index('idx_fx_rates_day', 'day'),
+    )
+
+class FxMonth(Base):
+    __tablename__ = 'fx_months'
+
+    id = Column(Integer, primary_key=True)
+    currency = Column(String, nullable=False)
+    month = Column(String, nullable=False)
+    # Mean of the month's daily rates, and the last one, per one FX_BASE
+    average = Column(Float, nullable=False)
+    closing = Column(Float, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('currency', 'month', name='unique_fx_month'),
+    )
+
+class ArchivedYear(Base):
+    __tablename__ = 'archived_years'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    year = Column(Integer, nullable=False)
+    # Columnar file under ARCHIVE_DIR/<user_id>/ holding the year's transactions (archive.py)
+    file = Column(String, nullable=False)
+    count = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'year', name='unique_archived_year'),
+    )
+
+class ArchivedTotal(Base):
+    __tablename__ = 'archived_totals'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=True)
+    category_id = Column(Integer, ForeignKey('categories.id'), nullable=True)
+    type = Column(String, nullable=False)
+    direction = Column(String, nullable=True)
+    month = Column(String, nullable=False)
+    # What the month's archived transactions add up to, so rebuilds need not read the files
+    total = Column(BigInteger, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_archived_totals_user_month', 'user_id', 'month'),
+    )
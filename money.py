@@ -0,0 +1,152 @@
+"""Exact money amounts stored as integer minor units.
+
+Every amount column holds an integer count of the user's currency's minor
+unit (cents for USD, whole yen for JPY), so sums and balance updates are
+exact integer arithmetic in both Python and SQL. Money wraps such a count
+together with its currency for parsing form input and formatting output.
+"""
+from decimal import Decimal, InvalidOperation
+
+DEFAULT_CURRENCY = 'USD'
+DEFAULT_DIGITS = 2
+
+# Digits after the decimal point (ISO 4217 minor unit) per supported currency
+MINOR_DIGITS = {
+    'USD': 2,
+    'EUR': 2,
+    'GBP': 2,
+    'INR': 2,
+    'JPY': 0,
+}
+
+SYMBOLS = {
+    'USD': '$',
+    'EUR': '€',
+    'GBP': '£',
+    'INR': '₹',
+    'JPY': '¥',
+}
+
+
+def minor_digits(currency):
+    """Number of minor-unit digits for a currency code"""
+    return MINOR_DIGITS.get(currency, DEFAULT_DIGITS)
+
+
+def to_minor(value, currency=DEFAULT_CURRENCY):
+    """Parse a decimal string (or number) into integer minor units.
+
+    Raises ValueError for text that is not a finite number or that has more
+    decimal places than the currency allows.
+    """
+    return Money.parse(value, currency).minor
+
+
+def to_major(minor, currency=DEFAULT_CURRENCY):
+    """Minor units as a float in major units, for charts and other display-only output"""
+    return float(Money(minor or 0, currency).decimal)
+
+
+class Money:
+    """An exact amount: integer minor units of one currency"""
+
+    __slots__ = ('minor', 'currency')
+
+    def __init__(self, minor, currency=DEFAULT_CURRENCY):
+        # Aggregates may come back as Decimal (PostgreSQL SUM) or None (empty SUM)
+        value = int(minor or 0)
+        if value != minor and minor is not None:
+            raise ValueError(f"Minor units must be whole numbers, got {minor!r}")
+        self.minor = value
+        self.currency = currency
+
+    @classmethod
+    def parse(cls, value, currency=DEFAULT_CURRENCY):
+        """Money from user input such as '1,234.50'"""
+        try:
+            amount = Decimal(str(value).strip().replace(',', ''))
+        except InvalidOperation:
+            raise ValueError(f"'{value}' is not a valid amount")
+        if not amount.is_finite():
+            raise ValueError(f"'{value}' is not a valid amount")
+
+        scaled = amount.scaleb(minor_digits(currency))
+        if scaled != scaled.to_integral_value():
+            if not minor_digits(currency):
+                raise ValueError(f"{currency} amounts must be whole numbers")
+            raise ValueError(f"{currency} amounts allow at most {minor_digits(currency)} decimal places")
+        return cls(int(scaled), currency)
+
+    @property
+    def decimal(self):
+        """The amount in major units as an exact Decimal"""
+        return Decimal(self.minor).scaleb(-minor_digits(self.currency))
+
+    def format(self):
+        """Amount with currency symbol and thousands separators, e.g. -$1,234.50"""
+        digits = minor_digits(self.currency)
+        symbol = SYMBOLS.get(self.currency, self.currency + ' ')
+        sign = '-' if self.minor < 0 else ''
+        return f"{sign}{symbol}{abs(self.decimal):,.{digits}f}"
+
+    def _same(self, other):
+        """True for Money in the same currency; mixing currencies is an error"""
+        if not isinstance(other, Money):
+            return False
+        if other.currency != self.currency:
+            raise ValueError(f"Cannot combine {self.currency} and {other.currency}")
+        return True
+
+    def __add__(self, other):
+        if not self._same(other):
+            return NotImplemented
+        return Money(self.minor + other.minor, self.currency)
+
+    def __sub__(self, other):
+        if not self._same(other):
+            return NotImplemented
+        return Money(self.minor - other.minor, self.currency)
+
+    def __neg__(self):
+        return Money(-self.minor, self.currency)
+
+    def __abs__(self):
+        return Money(abs(self.minor), self.currency)
+
+    def __eq__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.minor == other.minor and self.currency == other.currency
+
+    def __lt__(self, other):
+        if not self._same(other):
+            return NotImplemented
+        return self.minor < other.minor
+
+    def __le__(self, other):
+        if not self._same(other):
+            return NotImplemented
+        return self.minor <= other.minor
+
+    def __gt__(self, other):
+        if not self._same(other):
+            return NotImplemented
+        return self.minor > other.minor
+
+    def __ge__(self, other):
+        if not self._same(other):
+            return NotImplemented
+        return self.minor >= other.minor
+
+    def __hash__(self):
+        return hash((self.minor, self.currency))
+
+    def __bool__(self):
+        return self.minor != 0
+
+    def __str__(self):
+        digits = minor_digits(self.currency)
+        return f"{self.decimal:.{digits}f}"
+
+    def __repr__(self):
+        return f"Money({self.minor}, {self.currency!r})"
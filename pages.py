@@ -0,0 +1,185 @@
+"""Queries behind the read-only pages, shared by the Flask views and asgi.py.
+
+Each page's queries are independent Core statements keyed by name. The
+Flask views run them one after another on the request's session with
+fetch(); the ASGI views run them concurrently, one connection each, on
+the async engine with fetch_async(). Both then build the template context
+from the same rows.
+"""
+import asyncio
+from sqlalchemy import case, func, literal, select
+from models import Account, BudgetEvent, BudgetState, Category, MonthlyRollup, Transaction
+from helpers import row_to_dict
+from queries import older_than, text_match, transaction_conditions
+import budget_states
+import search
+
+RECENT_TRANSACTIONS = 8
+
+
+def fetch(db, statements):
+    """Run named statements in turn on a sync session: {name: rows}"""
+    return {name: db.execute(statement).all() for name, statement in statements.items()}
+
+
+async def fetch_async(engine, statements):
+    """Run named statements concurrently on an async engine: {name: rows}"""
+    async def run(statement):
+        async with engine.connect() as conn:
+            return (await conn.execute(statement)).all()
+
+    rows = await asyncio.gather(*(run(statement) for statement in statements.values()))
+    return dict(zip(statements, rows))
+
+
+def dashboard_statements(user_id, account_id, month):
+    """Home page queries for one account and month"""
+    percent = BudgetState.spent * 100.0 / BudgetState.monthly_limit
+
+    return {
+        'account': select(Account.name, Account.type, Account.balance, Account.currency)
+            .where(Account.id == account_id, Account.user_id == user_id),
+
+        # This month's income and expenses for THIS account only, in one pass
+        'totals': select(
+            func.coalesce(func.sum(case((MonthlyRollup.type == 'income', MonthlyRollup.total), else_=0)), 0).label('income'),
+            func.coalesce(func.sum(case((MonthlyRollup.type == 'expense', MonthlyRollup.total), else_=0)), 0).label('expense')
+        ).where(
+            MonthlyRollup.user_id == user_id,
+            MonthlyRollup.month == month,
+            MonthlyRollup.type.in_(('income', 'expense')),
+            MonthlyRollup.account_id == account_id
+        ),
+
+        # Budget alerts (spending across ALL accounts), kept up to date by budget_states
+        'budget_alerts': select(
+            Category.name.label('category_name'),
+            BudgetState.monthly_limit.label('budget_limit'),
+            BudgetState.spent.label('spent'),
+            percent.label('percent')
+        ).join(Category, BudgetState.category_id == Category.id)
+            .where(
+                BudgetState.user_id == user_id,
+                BudgetState.month == month,
+                BudgetState.level >= budget_states.THRESHOLDS[0]
+            )
+            .order_by(percent.desc())
+            .limit(5),
+
+        # Recent transactions for THIS account only
+        'recent': select(
+            Transaction.id.label("id"),
+            Transaction.amount.label("amount"),
+            Transaction.date.label("date"),
+            Transaction.type.label("type"),
+            Transaction.person_name.label("person_name"),
+            Transaction.direction.label("direction"),
+            Category.name.label("name")
+        ).select_from(Transaction)
+            .outerjoin(Category, Transaction.category_id == Category.id)
+            .where(Transaction.user_id == user_id, Transaction.account_id == account_id)
+            .order_by(Transaction.date.desc(), Transaction.id.desc())
+            .limit(RECENT_TRANSACTIONS),
+    }
+
+
+def dashboard(rows):
+    """home.html context from dashboard_statements() rows, or None if the account is not the user's"""
+    if not rows['account']:
+        return None
+    account = rows['account'][0]
+    totals = rows['totals'][0]
+    return dict(
+        account_balance=account.balance,
+        account_name=account.name,
+        account_type=account.type,
+        # None: the account is in the user's currency
+        account_currency=account.currency,
+        monthly_income=totals.income,
+        monthly_expenses=totals.expense,
+        monthly_net=totals.income - totals.expense,
+        budget_alerts=[row_to_dict(r) for r in rows['budget_alerts']],
+        recent_transactions=[row_to_dict(r) for r in rows['recent']]
+    )
+
+
+def transactions_statements(user_id, filters, cursor, page_size):
+    """One page of the transaction list, plus one extra row to tell whether an older page exists"""
+    conditions = transaction_conditions(user_id, filters)
+    if cursor:
+        conditions.append(older_than(cursor))
+
+    return {
+        'rows': select(
+            Transaction.id,
+            Transaction.account_id,
+            Transaction.amount,
+            Transaction.description,
+            Transaction.date,
+            Transaction.type,
+            Transaction.person_name,
+            Transaction.direction,
+            Category.name
+        ).outerjoin(Category, Transaction.category_id == Category.id)
+            .where(*conditions)
+            .order_by(Transaction.date.desc(), Transaction.id.desc())
+            .limit(page_size + 1),
+    }
+
+
+def search_statements(user_id, query, filters, limit, offset):
+    """One page of search results, best match first, plus one extra row to tell whether more exist.
+
+    Without FTS5 the matches are description substrings, newest first, and
+    score is None.
+    """
+    conditions = transaction_conditions(user_id, {k: v for k, v in filters.items() if k != 'q'})
+    columns = (
+        Transaction.id,
+        Transaction.amount,
+        Transaction.description,
+        Transaction.date,
+        Transaction.type,
+        Transaction.person_name,
+        Transaction.direction,
+        Transaction.account_id,
+        Category.name.label('category'),
+    )
+    if search.enabled:
+        hits = search.ranked(user_id, query)
+        statement = select(*columns, hits.c.score)\
+            .join(hits, hits.c.id == Transaction.id)\
+            .order_by(hits.c.score, Transaction.date.desc(), Transaction.id.desc())
+    else:
+        statement = select(*columns, literal(None).label('score'))\
+            .where(text_match(user_id, query))\
+            .order_by(Transaction.date.desc(), Transaction.id.desc())
+
+    return {
+        'rows': statement.outerjoin(Category, Transaction.category_id == Category.id)
+            .where(*conditions)
+            .limit(limit + 1)
+            .offset(offset),
+    }
+
+
+def budgets_statements(user_id, month):
+    """Budget limits, spending and the thresholds crossed per category for a month"""
+    return {
+        'budgets': select(BudgetState.category_id, BudgetState.monthly_limit, BudgetState.spent)
+            .where(BudgetState.user_id == user_id, BudgetState.month == month),
+        'events': select(Category.name.label('category_name'), BudgetEvent.threshold,
+                         BudgetEvent.percent, BudgetEvent.created_at)
+            .join(Category, BudgetEvent.category_id == Category.id)
+            .where(BudgetEvent.user_id == user_id, BudgetEvent.month == month)
+            .order_by(BudgetEvent.created_at.desc(), BudgetEvent.id.desc()),
+    }
+
+
+def budgets(rows):
+    """({category_id: limit}, {category_id: spent}, [threshold events]) for budgets.html"""
+    return (
+        {b.category_id: b.monthly_limit for b in rows['budgets']},
+        {b.category_id: b.spent for b in rows['budgets']},
+        [row_to_dict(e) for e in rows['events']],
+    )
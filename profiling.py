@@ -0,0 +1,302 @@
+"""Per-route query profiling.
+
+SQLAlchemy cursor events time every statement a sampled request runs.
+Once its response has been sent, the totals are folded into per-route
+counters: requests, queries, DB time, the slowest statements (normalized,
+so calls that differ only in their parameters are grouped together) and
+requests where one SELECT ran over and over (a likely N+1). /metrics
+serves these in the Prometheus text format. QUERY_PROFILE_LOG, when set, also writes
+one JSON line per slow or N+1 request to a rotating log.
+
+Unsampled requests pay only a context variable lookup per statement, so
+profiling can stay on in production. QUERY_PROFILE_SAMPLE_RATE sets the
+share of requests profiled (default 1; 0 turns the hooks off).
+"""
+from contextvars import ContextVar
+from functools import lru_cache
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import random
+import re
+import threading
+import time
+from flask import request
+from sqlalchemy import event
+
+# Slowest statements per route exported to /metrics
+TOP_STATEMENTS = int(os.getenv("QUERY_PROFILE_TOP", 5))
+# A SELECT repeated this many times in one request is reported as N+1
+N_PLUS_ONE = int(os.getenv("QUERY_PROFILE_N_PLUS_ONE", 10))
+# Distinct statements remembered per route; later ones are not tracked
+MAX_STATEMENTS = 200
+
+_current = ContextVar("query_profile", default=None)
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PYFORMAT = re.compile(r"%\(\w+\)s|\$\d+")
+_IN_LIST = re.compile(r"\bIN \((?:\?, )*\?\)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=2048)
+def normalize(statement):
+    """Statement text with literals and parameters as ? and IN lists collapsed"""
+    text = _WHITESPACE.sub(" ", statement).strip()
+    text = _STRING.sub("?", text)
+    text = _PYFORMAT.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    return _IN_LIST.sub("IN (...)", text)
+
+
+class RequestProfile:
+    """Statements one request ran: {normalized: [calls, seconds, max_seconds]}"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = None
+        self.streamed = False
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = {}
+
+    def record(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        entry = self.statements.get(statement)
+        if entry is None:
+            self.statements[statement] = [1, elapsed, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+    def repeated(self):
+        """SELECTs run at least N_PLUS_ONE times, with their call counts"""
+        return {s: e[0] for s, e in self.statements.items() if e[0] >= N_PLUS_ONE and s[:6].upper() == "SELECT"}
+
+
+class RouteStats:
+    """Totals over every profiled request to one route"""
+
+    def __init__(self):
+        self.requests = 0
+        self.request_time = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.max_queries = 0
+        self.n_plus_one = 0
+        self.statements = {}
+
+    def add(self, profile, elapsed, repeated):
+        self.requests += 1
+        self.request_time += elapsed
+        self.queries += profile.queries
+        self.db_time += profile.db_time
+        self.max_queries = max(self.max_queries, profile.queries)
+        self.n_plus_one += bool(repeated)
+        for statement, (calls, seconds, slowest) in profile.statements.items():
+            entry = self.statements.get(statement)
+            if entry is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    continue
+                self.statements[statement] = [calls, seconds, slowest]
+            else:
+                entry[0] += calls
+                entry[1] += seconds
+                entry[2] = max(entry[2], slowest)
+
+    def slowest(self, n=TOP_STATEMENTS):
+        return sorted(self.statements.items(), key=lambda item: item[1][2], reverse=True)[:n]
+
+
+class QueryProfiler:
+    """Collects per-route query statistics from sampled requests"""
+
+    def __init__(self, sample_rate=1.0, log=None, log_min_ms=0.0):
+        self.sample_rate = sample_rate
+        self.log = log
+        self.log_min_ms = log_min_ms
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def instrument(self, engine):
+        """Time every statement `engine` runs for a profiled request"""
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    def start(self):
+        """before_request hook: profile this request with probability sample_rate"""
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        _current.set(RequestProfile() if sampled else None)
+
+    def finish(self, response):
+        """after_request hook: note the status, and defer streamed responses.
+
+        A generator body (stream_with_context) runs its queries after the
+        view returns and after the first teardown, so its profile is
+        recorded when the server closes the response instead.
+        """
+        profile = _current.get()
+        if profile is not None:
+            profile.status = response.status_code
+            if inspect.isgenerator(response.response):
+                profile.streamed = True
+                details = self._details(profile)
+                response.call_on_close(lambda: self._record(profile, *details))
+        return response
+
+    def teardown(self, exception=None):
+        """teardown_request hook: record the profile of a non-streamed request"""
+        profile = _current.get()
+        if profile is not None and not profile.streamed:
+            self._record(profile, *self._details(profile))
+
+    @staticmethod
+    def _details(profile):
+        rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        return request.method, rule, request.path, profile.status
+
+    def _record(self, profile, method, rule, path, status):
+        if _current.get() is profile:
+            _current.set(None)
+        elapsed = time.perf_counter() - profile.started
+        repeated = profile.repeated()
+
+        with self._lock:
+            stats = self.routes.get((method, rule))
+            if stats is None:
+                stats = self.routes[(method, rule)] = RouteStats()
+            stats.add(profile, elapsed, repeated)
+
+        if self.log is not None and (repeated or profile.db_time * 1000 >= self.log_min_ms):
+            self.log.info(json.dumps({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "method": method,
+                "route": rule,
+                "path": path,
+                "status": status,
+                "request_ms": round(elapsed * 1000, 3),
+                "queries": profile.queries,
+                "db_ms": round(profile.db_time * 1000, 3),
+                "slowest": [
+                    {"statement": s, "calls": e[0], "ms": round(e[1] * 1000, 3)}
+                    for s, e in sorted(profile.statements.items(), key=lambda item: item[1][1], reverse=True)[:3]
+                ],
+                "n_plus_one": repeated,
+            }))
+
+    def snapshot(self):
+        """{(method, rule): RouteStats} copy safe to read while requests continue"""
+        with self._lock:
+            copies = {}
+            for key, stats in self.routes.items():
+                copy = RouteStats()
+                copy.__dict__.update(stats.__dict__, statements={s: list(e) for s, e in stats.statements.items()})
+                copies[key] = copy
+            return copies
+
+    def discard(self):
+        """Stop profiling the current request without recording it"""
+        _current.set(None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    if profile is not None:
+        starts = conn.info.get("query_start")
+        if starts:
+            profile.record(normalize(statement), time.perf_counter() - starts.pop())
+
+
+# ====================
+# Prometheus text format
+# ====================
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def metric(name, kind, help_text, samples):
+    """One metric family: samples are (labels dict, value) pairs"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{k}="{_label(v)}"' for k, v in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+
+def prometheus(profiler):
+    """The profiler's per-route statistics as Prometheus metric families"""
+    routes = sorted(profiler.snapshot().items())
+
+    def per_route(attribute):
+        return [({"method": m, "route": r}, getattr(stats, attribute)) for (m, r), stats in routes]
+
+    statements = [
+        ({"method": m, "route": r, "statement": statement}, entry)
+        for (m, r), stats in routes for statement, entry in stats.slowest()
+    ]
+    return [
+        *metric("fortuna_profile_sample_rate", "gauge", "Share of requests whose queries are profiled",
+                [({}, profiler.sample_rate)]),
+        *metric("fortuna_route_requests_total", "counter", "Profiled requests", per_route("requests")),
+        *metric("fortuna_route_request_seconds_total", "counter", "Time spent in profiled requests",
+                per_route("request_time")),
+        *metric("fortuna_route_queries_total", "counter", "SQL statements run by profiled requests",
+                per_route("queries")),
+        *metric("fortuna_route_db_seconds_total", "counter", "Time profiled requests spent in SQL statements",
+                per_route("db_time")),
+        *metric("fortuna_route_queries_max", "gauge", "Most SQL statements run by one profiled request",
+                per_route("max_queries")),
+        *metric("fortuna_route_n_plus_one_total", "counter",
+                f"Profiled requests that ran one SELECT at least {N_PLUS_ONE} times", per_route("n_plus_one")),
+        *metric("fortuna_statement_calls_total", "counter", "Calls of the slowest statements per route",
+                [(labels, entry[0]) for labels, entry in statements]),
+        *metric("fortuna_statement_seconds_total", "counter", "Time spent in the slowest statements per route",
+                [(labels, entry[1]) for labels, entry in statements]),
+        *metric("fortuna_statement_max_seconds", "gauge", "Slowest single call of each statement",
+                [(labels, entry[2]) for labels, entry in statements]),
+    ]
+
+
+def _log_from_env():
+    path = os.getenv("QUERY_PROFILE_LOG")
+    if not path:
+        return None
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        path,
+        maxBytes=int(os.getenv("QUERY_PROFILE_LOG_BYTES", 10 * 1024 * 1024)),
+        backupCount=int(os.getenv("QUERY_PROFILE_LOG_BACKUPS", 5)),
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log = logging.getLogger("fortuna.queries")
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    log.addHandler(handler)
+    return log
+
+
+def init_profiling(app, engine):
+    """Create the app's QueryProfiler from the environment and hook it into `engine`"""
+    profiler = QueryProfiler(
+        sample_rate=float(os.getenv("QUERY_PROFILE_SAMPLE_RATE", 1.0)),
+        log=_log_from_env(),
+        log_min_ms=float(os.getenv("QUERY_PROFILE_LOG_MIN_MS", 100)),
+    )
+    app.extensions["profiling"] = profiler
+    if profiler.sample_rate > 0:
+        profiler.instrument(engine)
+        # First, so the queries of the app's other before_request hooks count too
+        app.before_request_funcs.setdefault(None, []).insert(0, profiler.start)
+        app.after_request(profiler.finish)
+        app.teardown_request(profiler.teardown)
+    return profiler
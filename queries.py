@@ -0,0 +1,141 @@
+from datetime import date
+from sqlalchemy import Integer, String, and_, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from models import Transaction
+import search
+
+TRANSACTION_TYPES = ('income', 'expense', 'personal')
+TRANSACTION_FILTERS = ('start', 'end', 'type', 'account_id', 'category_id', 'q')
+
+
+def month_bounds(month):
+    """Return the half-open [first_day, next_month_first_day) range for a "YYYY-MM" month"""
+    year, mon = (int(part) for part in month.split("-"))
+    start = date(year, mon, 1)
+    end = date(year + mon // 12, mon % 12 + 1, 1)
+    return start, end
+
+
+def in_month(column, month):
+    """Sargable predicate matching dates inside the given "YYYY-MM" month.
+
+    Comparing the raw column against date bounds lets SQLite use the
+    composite (..., date) indexes instead of evaluating strftime() per row.
+    """
+    start, end = month_bounds(month)
+    return and_(column >= start, column < end)
+
+
+class month_bucket(FunctionElement):
+    """Dialect-neutral "YYYY-MM" label of a date column, for GROUP BY month"""
+    type = String()
+    name = "month_bucket"
+    inherit_cache = True
+
+
+@compiles(month_bucket)
+def _month_bucket_sqlite(element, compiler, **kw):
+    return "strftime('%%Y-%%m', %s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(month_bucket, "postgresql")
+def _month_bucket_postgresql(element, compiler, **kw):
+    return "to_char(%s, 'YYYY-MM')" % compiler.process(element.clauses, **kw)
+
+
+class epoch_day(FunctionElement):
+    """Dialect-neutral day number of a date column, counted from 1970-01-01"""
+    type = Integer()
+    name = "epoch_day"
+    inherit_cache = True
+
+
+@compiles(epoch_day)
+def _epoch_day_sqlite(element, compiler, **kw):
+    return "CAST(julianday(%s) - 2440587.5 AS INTEGER)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(epoch_day, "postgresql")
+def _epoch_day_postgresql(element, compiler, **kw):
+    return "(%s - DATE '1970-01-01')" % compiler.process(element.clauses, **kw)
+
+
+def current_month():
+    """Current month as "YYYY-MM" """
+    return date.today().strftime("%Y-%m")
+
+
+def parse_transaction_filters(args):
+    """Normalize transaction list filters from a query string, dropping blank or invalid values"""
+    filters = {}
+
+    for key in ('start', 'end'):
+        value = args.get(key)
+        if value:
+            try:
+                filters[key] = date.fromisoformat(value)
+            except ValueError:
+                pass
+
+    trans_type = args.get('type')
+    if trans_type in TRANSACTION_TYPES:
+        filters['type'] = trans_type
+
+    for key in ('account_id', 'category_id'):
+        value = args.get(key)
+        if value and value.isdigit():
+            filters[key] = int(value)
+
+    text = (args.get('q') or '').strip()
+    if text:
+        filters['q'] = text
+
+    return filters
+
+
+def transaction_conditions(user_id, filters):
+    """WHERE clauses for a user's transactions restricted by parsed filters"""
+    conditions = [Transaction.user_id == user_id]
+
+    if 'start' in filters:
+        conditions.append(Transaction.date >= filters['start'])
+    if 'end' in filters:
+        conditions.append(Transaction.date <= filters['end'])
+    if 'type' in filters:
+        conditions.append(Transaction.type == filters['type'])
+    if 'account_id' in filters:
+        conditions.append(Transaction.account_id == filters['account_id'])
+    if 'category_id' in filters:
+        conditions.append(Transaction.category_id == filters['category_id'])
+    if 'q' in filters:
+        conditions.append(text_match(user_id, filters['q']))
+
+    return conditions
+
+
+def text_match(user_id, query):
+    """Search box predicate: full-text words and prefixes when FTS5 is available, else a description substring"""
+    if search.enabled:
+        return Transaction.id.in_(search.matching_ids(user_id, query))
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return Transaction.description.ilike(f"%{pattern}%", escape='\\')
+
+
+def encode_cursor(row):
+    """Opaque keyset cursor pointing just past `row` in (date DESC, id DESC) order"""
+    return f"{row.date.isoformat()}_{row.id}"
+
+
+def decode_cursor(value):
+    """Parse a cursor from encode_cursor(), or None if it is malformed"""
+    try:
+        day, row_id = value.split("_")
+        return date.fromisoformat(day), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def older_than(cursor):
+    """Keyset predicate selecting rows after `cursor` in (date DESC, id DESC) order"""
+    return tuple_(Transaction.date, Transaction.id) < cursor
@@ -0,0 +1,220 @@
+"""Recurring transaction templates (salary, rent, subscriptions).
+
+A rule repeats an income or expense every `interval` days, weeks or
+months from its start date; the n-th occurrence is always counted from
+the start date, so a monthly rule on the 31st falls on the last day of
+shorter months without drifting. Each rule keeps the number of
+occurrences written so far and the date of the next one in next_due,
+which is indexed: a scheduler tick reads only the rules that are due and
+costs nothing when none are.
+
+Catching up after downtime writes every missed occurrence of a user's
+due rules with one executemany insert, then applies their rollup and
+balance changes once per bucket and account-month through rollups and
+ledger, like a CSV import. A rule is claimed with an UPDATE conditional on
+its occurrence count in the same transaction, so two processes ticking at
+once never write an occurrence twice.
+
+The Scheduler thread ticks every RECURRING_INTERVAL seconds once the app
+has served its first request; RECURRING_INTERVAL=0 leaves it to
+`flask recurring run` from cron.
+"""
+from datetime import date, timedelta
+import os
+import threading
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import insert, select, update
+from cache import dashboard_cache
+from models import RecurringRule, Transaction
+import budget_states
+import charts
+import ledger
+import rollups
+import search
+import timeseries
+
+FREQUENCIES = {'daily': 'days', 'weekly': 'weeks', 'monthly': 'months'}
+# Due rules read per scheduler query; every user's due rules are caught up together
+BATCH_SIZE = 1000
+# A user whose catch-up fails is retried this much later; no occurrence is lost meanwhile
+RETRY_DELAY = timedelta(days=1)
+
+rules = RecurringRule.__table__
+
+
+def occurrence(start_date, frequency, interval, n):
+    """Date of the n-th occurrence (0-based) of a rule"""
+    if frequency == 'monthly':
+        return start_date + relativedelta(months=interval * n)
+    return start_date + timedelta(**{FREQUENCIES[frequency]: interval * n})
+
+
+def schedule(rule, today):
+    """(dates due up to `today`, occurrences after writing them, next due date or None)"""
+    dates = []
+    n = rule.occurrences
+    day = occurrence(rule.start_date, rule.frequency, rule.interval, n)
+    while day <= today and (rule.end_date is None or day <= rule.end_date):
+        dates.append(day)
+        n += 1
+        day = occurrence(rule.start_date, rule.frequency, rule.interval, n)
+    if rule.end_date is not None and day > rule.end_date:
+        day = None
+    return dates, n, day
+
+
+def catch_up(db, user_id, due_rules, today=None):
+    """Write every occurrence of a user's rules due by `today`; returns the number of transactions.
+
+    `due_rules` are RecurringRule objects or rows of the recurring_rules
+    table. A rule another process has already advanced is skipped. The
+    caller commits.
+    """
+    today = today or date.today()
+    ledger.begin(db)
+    rows = []
+    for rule in due_rules:
+        dates, occurrences, next_due = schedule(rule, today)
+        if not dates:
+            continue
+        claimed = db.execute(
+            update(rules)
+            .where(rules.c.id == rule.id, rules.c.occurrences == rule.occurrences)
+            .values(occurrences=occurrences, next_due=next_due)
+        ).rowcount
+        if not claimed:
+            continue
+        rows += [{
+            'user_id': user_id, 'account_id': rule.account_id, 'category_id': rule.category_id,
+            'amount': rule.amount, 'description': rule.description, 'date': day, 'type': rule.type,
+            'person_name': None, 'direction': None,
+        } for day in dates]
+    if not rows:
+        return 0
+
+    table = Transaction.__table__
+    ids = db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows).scalars().all()
+
+    balance_deltas = {}
+    rollup_deltas = {}
+    for row, id_ in zip(rows, ids):
+        row['id'] = id_
+        month = row['date'].strftime("%Y-%m")
+        balance_key = (row['account_id'], month)
+        balance_deltas[balance_key] = balance_deltas.get(balance_key, 0) + \
+            ledger.balance_effect(row['type'], None, row['amount'])
+        bucket = rollup_deltas.setdefault((row['account_id'], row['category_id'], row['type'], month), [0, 0])
+        bucket[0] += row['amount']
+        bucket[1] += 1
+
+    rollups.apply_many(db, user_id, rollup_deltas)
+    budget_states.apply_many(db, user_id, rollup_deltas)
+    ledger.post_many(db, user_id, balance_deltas)
+    search.record(db, user_id, rows)
+    charts.mark_stale(db, user_id, charts.charts_for(*{row['type'] for row in rows}))
+    return len(rows)
+
+
+def back_off(db, user_rules, today):
+    """Move rules whose catch-up failed behind everyone else's, to be retried after RETRY_DELAY.
+
+    Only next_due changes, so the retry still writes every occurrence
+    missed since; a rule another process has advanced is left alone.
+    """
+    for rule in user_rules:
+        db.execute(
+            update(rules)
+            .where(rules.c.id == rule.id, rules.c.occurrences == rule.occurrences)
+            .values(next_due=today + RETRY_DELAY)
+        )
+
+
+def run_due(db, today=None, batch_size=BATCH_SIZE):
+    """Catch up every user with due rules, committing per user; returns counts.
+
+    A user whose catch-up raises is rolled back, logged, counted under
+    'failed' and backed off, and the run goes on with the other users.
+    """
+    today = today or date.today()
+    result = {'users': 0, 'rules': 0, 'transactions': 0, 'failed': 0}
+    failed = set()
+    while True:
+        query = select(rules).where(rules.c.next_due <= today)
+        if failed:
+            # Their back-off may have failed too; never pick them up again in this run
+            query = query.where(rules.c.user_id.not_in(failed))
+        due = db.execute(query.order_by(rules.c.next_due).limit(batch_size)).all()
+        if not due:
+            return result
+        by_user = {}
+        for rule in due:
+            by_user.setdefault(rule.user_id, []).append(rule)
+        for user_id, user_rules in by_user.items():
+            try:
+                written = catch_up(db, user_id, user_rules, today)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"Recurring rules of user {user_id} failed: {e}")
+                failed.add(user_id)
+                result['failed'] += 1
+                try:
+                    back_off(db, user_rules, today)
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                continue
+            dashboard_cache.invalidate(user_id)
+            timeseries.invalidate(user_id)
+            result['users'] += 1
+            result['rules'] += len(user_rules)
+            result['transactions'] += written
+
+
+class Scheduler:
+    """Daemon thread running run_due() every `interval` seconds, the first time straight away"""
+
+    def __init__(self, session_factory, interval=300, teardown=None):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.teardown = teardown
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def tick(self):
+        try:
+            return run_due(self.session_factory())
+        except Exception as e:
+            print(f"Recurring scheduler error: {e}")
+        finally:
+            if self.teardown is not None:
+                self.teardown()
+
+    def _run(self):
+        self.tick()
+        while not self._stop.wait(self.interval):
+            self.tick()
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="recurring-scheduler", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        self._stop.clear()
+
+
+def init_scheduler(app, session_factory, teardown=None):
+    """Create the app's Scheduler from the environment; it starts with the first request"""
+    scheduler = Scheduler(session_factory, float(os.getenv("RECURRING_INTERVAL", 300)), teardown)
+    app.extensions["recurring"] = scheduler
+    app.before_request(scheduler.start)
+    return scheduler
@@ -0,0 +1,118 @@
+"""Cached reference data: categories and accounts, plus each user's currency.
+
+Preset categories never change, so they are loaded once per process. A
+user's custom categories and accounts live in a bounded LRU keyed by
+user_id and are dropped by invalidate(user_id) whenever a route creates,
+renames or deletes one of them. Entries are immutable snapshots, safe to
+share between threads and sessions; balances are deliberately left out
+because they change on every transaction. The currency is not cached: it
+sets the scale of every amount parsed, and a worker still holding the old
+one would store amounts off by a power of ten.
+"""
+from collections import namedtuple
+import os
+import threading
+from models import Account, Category, User
+from money import DEFAULT_CURRENCY
+from cache import MISSING, TTLCache
+
+CategoryRef = namedtuple("CategoryRef", "id name type is_preset")
+AccountRef = namedtuple("AccountRef", "id name type currency")
+
+_presets = None
+_presets_lock = threading.Lock()
+
+# Other workers only see a change once their entry expires
+user_cache = TTLCache(
+    maxsize=int(os.getenv("REFDATA_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("REFDATA_CACHE_TTL", 300))
+)
+
+
+def preset_categories(db):
+    """Preset categories shared by every user"""
+    global _presets
+    if _presets is None:
+        with _presets_lock:
+            if _presets is None:
+                rows = db.query(Category.id, Category.name, Category.type)\
+                    .filter(Category.user_id == None)\
+                    .order_by(Category.id)\
+                    .all()
+                _presets = tuple(CategoryRef(r.id, r.name, r.type, True) for r in rows)
+    return _presets
+
+
+def user_categories(db, user_id):
+    """A user's own categories, ordered by type then name"""
+    key = (user_id, "categories")
+    cached = user_cache.get(key)
+    if cached is MISSING:
+        rows = db.query(Category.id, Category.name, Category.type)\
+            .filter(Category.user_id == user_id)\
+            .order_by(Category.type, Category.name)\
+            .all()
+        cached = tuple(CategoryRef(r.id, r.name, r.type, False) for r in rows)
+        user_cache.set(key, cached)
+    return cached
+
+
+def categories(db, user_id, cat_type=None):
+    """Preset plus custom categories visible to a user, optionally of one type"""
+    found = preset_categories(db) + user_categories(db, user_id)
+    if cat_type is not None:
+        found = tuple(c for c in found if c.type == cat_type)
+    return found
+
+
+def find_category(db, user_id, name, cat_type):
+    """Category by name and type, preferring the user's own over a preset"""
+    match = None
+    for category in categories(db, user_id, cat_type):
+        if category.name == name:
+            match = category
+    return match
+
+
+def accounts(db, user_id):
+    """A user's accounts in creation order; currency is None for those following the user's"""
+    key = (user_id, "accounts")
+    cached = user_cache.get(key)
+    if cached is MISSING:
+        rows = db.query(Account.id, Account.name, Account.type, Account.currency)\
+            .filter(Account.user_id == user_id)\
+            .order_by(Account.created_at, Account.id)\
+            .all()
+        cached = tuple(AccountRef(r.id, r.name, r.type, r.currency) for r in rows)
+        user_cache.set(key, cached)
+    return cached
+
+
+def find_account(db, user_id, account_id):
+    """One of the user's accounts by id (int or form string), or None"""
+    try:
+        account_id = int(account_id)
+    except (TypeError, ValueError):
+        return None
+    for account in accounts(db, user_id):
+        if account.id == account_id:
+            return account
+    return None
+
+
+def currency(db, user_id, for_update=False):
+    """The user's currency code, which sets the scale of their amounts; read from the database every time.
+
+    Writers that parse amounts read it after ledger.begin() with
+    for_update (which locks the user row on server databases), so a
+    concurrent change_currency cannot rescale in between.
+    """
+    query = db.query(User.currency).filter(User.id == user_id)
+    if for_update:
+        query = query.with_for_update()
+    return query.scalar() or DEFAULT_CURRENCY
+
+
+def invalidate(user_id):
+    """Forget a user's cached categories and accounts"""
+    user_cache.invalidate(user_id)
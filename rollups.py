@@ -0,0 +1,212 @@
+"""Materialized monthly totals per (user, account, category, type, month).
+
+Write routes call record()/unrecord() inside their own database transaction
+so the rollups commit or roll back together with the transactions they
+summarize. rebuild() regenerates them from the raw `transactions` table,
+plus archived_totals for years moved to cold storage (archive.py), and
+verify() reports any bucket that has drifted.
+"""
+from sqlalchemy import bindparam, delete, func, insert, select, union_all, update
+from models import ArchivedTotal, MonthlyRollup, Transaction
+from queries import month_bucket
+
+def _month_of(day):
+    return day.strftime("%Y-%m")
+
+
+def _eq(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _bucket(user_id, account_id, category_id, trans_type, month):
+    table = MonthlyRollup.__table__
+    return (
+        table.c.user_id == user_id,
+        table.c.month == month,
+        table.c.type == trans_type,
+        _eq(table.c.account_id, account_id),
+        _eq(table.c.category_id, category_id),
+    )
+
+
+def apply(db, user_id, account_id, category_id, trans_type, month, amount, count):
+    """Add amount/count (negative to remove) to a single rollup bucket"""
+    table = MonthlyRollup.__table__
+    updated = db.execute(
+        update(table)
+        .where(*_bucket(user_id, account_id, category_id, trans_type, month))
+        .values(total=table.c.total + amount, count=table.c.count + count)
+    ).rowcount
+
+    if not updated:
+        db.execute(insert(table).values(
+            user_id=user_id,
+            account_id=account_id,
+            category_id=category_id,
+            type=trans_type,
+            month=month,
+            total=amount,
+            count=count
+        ))
+
+
+def apply_many(db, user_id, deltas):
+    """Apply {(account_id, category_id, type, month): (amount, count)} for one user.
+
+    Existing buckets are found with one query and updated with a single
+    executemany; missing ones are inserted the same way.
+    """
+    if not deltas:
+        return
+
+    months = {key[3] for key in deltas}
+    existing = {
+        (r.account_id, r.category_id, r.type, r.month): r.id
+        for r in db.query(
+            MonthlyRollup.id, MonthlyRollup.account_id, MonthlyRollup.category_id,
+            MonthlyRollup.type, MonthlyRollup.month
+        ).filter(MonthlyRollup.user_id == user_id, MonthlyRollup.month.in_(months))
+    }
+
+    updates = []
+    inserts = []
+    for key, (amount, count) in deltas.items():
+        if key in existing:
+            updates.append({"bucket_id": existing[key], "amount": amount, "delta": count})
+        else:
+            account_id, category_id, trans_type, month = key
+            inserts.append({
+                "user_id": user_id, "account_id": account_id, "category_id": category_id,
+                "type": trans_type, "month": month, "total": amount, "count": count
+            })
+
+    table = MonthlyRollup.__table__
+    if updates:
+        db.execute(
+            update(table)
+            .where(table.c.id == bindparam("bucket_id"))
+            .values(total=table.c.total + bindparam("amount"), count=table.c.count + bindparam("delta")),
+            updates
+        )
+    if inserts:
+        db.execute(insert(table), inserts)
+
+
+def record(db, transaction):
+    """Count a newly added transaction in its month's bucket"""
+    apply(db, transaction.user_id, transaction.account_id, transaction.category_id,
+          transaction.type, _month_of(transaction.date), transaction.amount, 1)
+
+
+def unrecord(db, transaction):
+    """Remove a deleted transaction from its month's bucket"""
+    apply(db, transaction.user_id, transaction.account_id, transaction.category_id,
+          transaction.type, _month_of(transaction.date), -transaction.amount, -1)
+
+
+def uncategorize(db, user_id, category_id):
+    """Fold a deleted category's buckets into the uncategorized ones"""
+    rows = db.query(MonthlyRollup).filter_by(user_id=user_id, category_id=category_id).all()
+    for row in rows:
+        apply(db, row.user_id, row.account_id, None, row.type, row.month, row.total, row.count)
+
+    db.query(MonthlyRollup)\
+        .filter_by(user_id=user_id, category_id=category_id)\
+        .delete(synchronize_session=False)
+
+
+def drop_account(db, account_id):
+    """Forget all buckets of a deleted account"""
+    db.query(MonthlyRollup)\
+        .filter_by(account_id=account_id)\
+        .delete(synchronize_session=False)
+
+
+def _aggregate(user_id=None):
+    """SELECT producing the rollup rows straight from `transactions` and archived_totals"""
+    month = month_bucket(Transaction.date)
+    hot = select(
+        Transaction.user_id,
+        Transaction.account_id,
+        Transaction.category_id,
+        Transaction.type,
+        month.label('month'),
+        func.sum(Transaction.amount).label('total'),
+        func.count(Transaction.id).label('count')
+    ).group_by(
+        Transaction.user_id,
+        Transaction.account_id,
+        Transaction.category_id,
+        Transaction.type,
+        month
+    )
+    archived = select(
+        ArchivedTotal.user_id,
+        ArchivedTotal.account_id,
+        ArchivedTotal.category_id,
+        ArchivedTotal.type,
+        ArchivedTotal.month,
+        ArchivedTotal.total,
+        ArchivedTotal.count
+    )
+    if user_id is not None:
+        hot = hot.where(Transaction.user_id == user_id)
+        archived = archived.where(ArchivedTotal.user_id == user_id)
+    rows = union_all(hot, archived).subquery()
+    return select(
+        rows.c.user_id,
+        rows.c.account_id,
+        rows.c.category_id,
+        rows.c.type,
+        rows.c.month,
+        func.sum(rows.c.total).label('total'),
+        func.sum(rows.c.count).label('count')
+    ).group_by(
+        rows.c.user_id,
+        rows.c.account_id,
+        rows.c.category_id,
+        rows.c.type,
+        rows.c.month
+    )
+
+
+def rebuild(db, user_id=None):
+    """Regenerate rollups (for one user or everyone) from `transactions` and commit"""
+    regenerate(db, user_id)
+    db.commit()
+
+
+def regenerate(db, user_id=None):
+    """Regenerate rollups inside the caller's transaction, which commits"""
+    stmt = delete(MonthlyRollup)
+    if user_id is not None:
+        stmt = stmt.where(MonthlyRollup.user_id == user_id)
+    db.execute(stmt)
+
+    columns = ['user_id', 'account_id', 'category_id', 'type', 'month', 'total', 'count']
+    db.execute(insert(MonthlyRollup).from_select(columns, _aggregate(user_id)))
+
+
+def verify(db, user_id=None):
+    """Return a list of (key, expected, actual) for every bucket that disagrees"""
+    expected = {
+        (r.user_id, r.account_id, r.category_id, r.type, r.month): (r.total, r.count)
+        for r in db.execute(_aggregate(user_id))
+    }
+
+    query = db.query(MonthlyRollup)
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    actual = {}
+    for r in query:
+        key = (r.user_id, r.account_id, r.category_id, r.type, r.month)
+        total, count = actual.get(key, (0, 0))
+        actual[key] = (total + r.total, count + r.count)
+
+    problems = []
+    for key in expected.keys() | actual.keys():
+        want = expected.get(key, (0, 0))
+        got = actual.get(key, (0, 0))
+        if want != got:
+            problems.append((key, want, got))
+    return sorted(problems, key=lambda p: tuple(str(part) for part in p[0]))
@@ -1,3 +1,6 @@
+-- Money columns (balance, amount, monthly_limit, total) hold integer minor
+-- units of the user's currency: cents for USD, whole yen for JPY
+
 -- Users table
 CREATE TABLE users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -12,7 +15,9 @@ CREATE TABLE accounts (
     user_id INTEGER NOT NULL,
     name TEXT NOT NULL,
     type TEXT NOT NULL CHECK(type IN ('current', 'savings', 'safe', 'business', 'investment')),
-    balance REAL NOT NULL DEFAULT 0,
+    currency TEXT,
+    balance INTEGER NOT NULL DEFAULT 0,
+    opening_balance INTEGER NOT NULL DEFAULT 0,
     created_at DATE DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
@@ -33,7 +38,7 @@ CREATE TABLE transactions (
     user_id INTEGER NOT NULL,
     account_id INTEGER,
     category_id INTEGER,
-    amount REAL NOT NULL,
+    amount INTEGER NOT NULL,
     description TEXT,
     date DATE NOT NULL,
     type TEXT NOT NULL CHECK(type IN ('income', 'expense', 'personal')),
@@ -49,7 +54,7 @@ CREATE TABLE budgets (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     category_id INTEGER NOT NULL,
-    monthly_limit REAL NOT NULL,
+    monthly_limit INTEGER NOT NULL,
     month TEXT NOT NULL,
     FOREIGN KEY (user_id) REFERENCES users(id),
     FOREIGN KEY (category_id) REFERENCES categories(id),
@@ -62,7 +67,7 @@ CREATE TABLE transfers (
     user_id INTEGER NOT NULL,
     from_account_id INTEGER NOT NULL,
     to_account_id INTEGER NOT NULL,
-    amount REAL NOT NULL,
+    amount INTEGER NOT NULL,
     date DATE NOT NULL,
     description TEXT,
     FOREIGN KEY (user_id) REFERENCES users(id),
@@ -70,15 +75,185 @@ CREATE TABLE transfers (
     FOREIGN KEY (to_account_id) REFERENCES accounts(id)
 );
 
+-- Monthly rollups (per user/account/category/type totals, maintained by rollups.py)
+CREATE TABLE monthly_rollups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    account_id INTEGER,
+    category_id INTEGER,
+    type TEXT NOT NULL CHECK(type IN ('income', 'expense', 'personal')),
+    month TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (account_id) REFERENCES accounts(id),
+    FOREIGN KEY (category_id) REFERENCES categories(id)
+);
+
+-- Running spent total and threshold level per budget, maintained by budget_states.py
+CREATE TABLE budget_states (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    category_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    monthly_limit INTEGER NOT NULL,
+    spent INTEGER NOT NULL DEFAULT 0,
+    level INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (category_id) REFERENCES categories(id),
+    UNIQUE(user_id, category_id, month)
+);
+
+-- Budget thresholds (80%, 100%) crossed by spending
+CREATE TABLE budget_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    category_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    threshold INTEGER NOT NULL,
+    percent INTEGER NOT NULL,
+    created_at DATETIME NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (category_id) REFERENCES categories(id)
+);
+
+-- Month-end balance checkpoints per account, maintained by ledger.py
+CREATE TABLE balance_snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    account_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    balance INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (account_id) REFERENCES accounts(id),
+    UNIQUE(account_id, month)
+);
+
+-- Precomputed analytics chart JSON per user, maintained by charts.py
+CREATE TABLE chart_payloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chart TEXT NOT NULL,
+    month TEXT NOT NULL,
+    data TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    updated_at DATETIME NOT NULL,
+    stale BOOLEAN NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    UNIQUE(user_id, chart)
+);
+
+-- Stored responses of keyed batch requests, replayed on retry (batch.py)
+CREATE TABLE idempotency_keys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    request_hash TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    response TEXT NOT NULL,
+    created_at DATETIME NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    UNIQUE(user_id, key)
+);
+
+-- Recurring income/expense templates; next_due is NULL once a rule has ended (recurring.py)
+CREATE TABLE recurring_rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    account_id INTEGER NOT NULL,
+    category_id INTEGER,
+    type TEXT NOT NULL CHECK(type IN ('income', 'expense')),
+    amount INTEGER NOT NULL,
+    description TEXT,
+    frequency TEXT NOT NULL CHECK(frequency IN ('daily', 'weekly', 'monthly')),
+    interval INTEGER NOT NULL DEFAULT 1 CHECK(interval >= 1),
+    start_date DATE NOT NULL,
+    end_date DATE,
+    occurrences INTEGER NOT NULL DEFAULT 0,
+    next_due DATE,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (account_id) REFERENCES accounts(id),
+    FOREIGN KEY (category_id) REFERENCES categories(id)
+);
+
+-- Daily exchange rates, units of `currency` per one FX_BASE, loaded by `flask fx import` (fx.py)
+CREATE TABLE fx_rates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    day DATE NOT NULL,
+    currency TEXT NOT NULL,
+    rate REAL NOT NULL,
+    UNIQUE(currency, day)
+);
+
+-- Average and closing rate per currency and month, refreshed from fx_rates on import
+CREATE TABLE fx_months (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    currency TEXT NOT NULL,
+    month TEXT NOT NULL,
+    average REAL NOT NULL,
+    closing REAL NOT NULL,
+    UNIQUE(currency, month)
+);
+
+-- Closed years of transactions moved to compressed files under ARCHIVE_DIR (archive.py)
+CREATE TABLE archived_years (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    year INTEGER NOT NULL,
+    file TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    archived_at DATETIME NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    UNIQUE(user_id, year)
+);
+
+-- Monthly totals of the archived transactions, read by the rollup, ledger and budget rebuilds
+CREATE TABLE archived_totals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    account_id INTEGER,
+    category_id INTEGER,
+    type TEXT NOT NULL,
+    direction TEXT,
+    month TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (account_id) REFERENCES accounts(id),
+    FOREIGN KEY (category_id) REFERENCES categories(id)
+);
+
+-- Full-text index of transactions (rowid = transactions.id), maintained by search.py.
+-- Words are stored prefixed with their owner: "coffee" becomes "u42_coffee".
+CREATE VIRTUAL TABLE transaction_search USING fts5(
+    description, person_name, category,
+    tokenize="unicode61 remove_diacritics 2 tokenchars '_'"
+);
+INSERT INTO transaction_search (transaction_search, rank) VALUES ('rank', 'bm25(3.0, 2.0, 1.0)');
+
 -- Indexes for faster queries
 CREATE INDEX idx_users_username ON users (username);
 CREATE INDEX idx_accounts_user ON accounts(user_id);
 CREATE INDEX idx_transactions_user ON transactions(user_id);
 CREATE INDEX idx_transactions_account ON transactions(account_id);
 CREATE INDEX idx_transactions_date ON transactions(date);
+CREATE INDEX idx_transactions_user_account_type_date ON transactions(user_id, account_id, type, date);
+CREATE INDEX idx_transactions_user_category_type_date ON transactions(user_id, category_id, type, date);
+CREATE INDEX idx_transactions_user_type_date ON transactions(user_id, type, date);
+CREATE INDEX idx_transactions_user_date ON transactions(user_id, date);
+CREATE INDEX idx_transactions_user_account_date ON transactions(user_id, account_id, date);
 CREATE INDEX idx_categories_user ON categories(user_id);
 CREATE INDEX idx_budgets_user ON budgets(user_id);
 CREATE INDEX idx_transfers_user ON transfers(user_id);
+CREATE INDEX idx_rollups_user_month_type ON monthly_rollups(user_id, month, type, account_id, category_id);
+CREATE INDEX idx_snapshots_user_month ON balance_snapshots(user_id, month);
+CREATE INDEX idx_budget_states_alerts ON budget_states(user_id, month, level);
+CREATE INDEX idx_budget_events_user_month ON budget_events(user_id, month);
+CREATE INDEX idx_idempotency_keys_user_created ON idempotency_keys(user_id, created_at);
+CREATE INDEX idx_recurring_rules_user ON recurring_rules(user_id);
+CREATE INDEX idx_recurring_rules_next_due ON recurring_rules(next_due);
+CREATE INDEX idx_fx_rates_day ON fx_rates(day);
+CREATE INDEX idx_archived_totals_user_month ON archived_totals(user_id, month);
 
 -- Insert preset expense categories
 INSERT INTO categories (user_id, name, type, is_preset) VALUES
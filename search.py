@@ -0,0 +1,181 @@
+"""Full-text search over transactions with SQLite FTS5.
+
+transaction_search holds one row per transaction (rowid = transactions.id)
+with its description, person_name and category name. Every word is stored
+scoped to its owner ("coffee" becomes "u42_coffee"), so a user's query
+only walks that user's postings and stays fast however many other users
+share the database; bm25 ranks against the user's own ledger too.
+
+Write routes call record()/unrecord()/refresh() inside their own database
+transaction, like rollups and ledger, so the index commits or rolls back
+with the rows it describes. rebuild() regenerates it and verify() reports
+rows that have drifted.
+
+Queries match every word of the user's text as a prefix ("cof sh" finds
+"Coffee shop"). On databases without FTS5 (PostgreSQL) `enabled` stays
+False, the write hooks do nothing and callers fall back to a LIKE on the
+description.
+"""
+import re
+from sqlalchemy import column, delete, false, insert, inspect, literal_column, select, table, text
+from models import Category, Transaction
+import refdata
+
+TABLE = "transaction_search"
+# bm25 weights for description, person_name, category
+RANK = "bm25(3.0, 2.0, 1.0)"
+# Words beyond this are ignored rather than making the query ever slower
+MAX_TERMS = 8
+BATCH_SIZE = 10_000
+
+enabled = False
+
+search_table = table(TABLE, column("rowid"), column("description"), column("person_name"), column("category"))
+
+_WORD = re.compile(r"\w+")
+
+
+def terms(user_id, value):
+    """Text as stored in the index: each word prefixed with its owner"""
+    if not value:
+        return None
+    return " ".join(f"u{user_id}_{word}" for word in _WORD.findall(value))
+
+
+def supported(bind):
+    """Whether `bind` is SQLite built with FTS5"""
+    if bind.dialect.name != "sqlite":
+        return False
+    with bind.connect() as conn:
+        options = {row[0] for row in conn.exec_driver_sql("PRAGMA compile_options")}
+    return "ENABLE_FTS5" in options
+
+
+def install(bind, db=None):
+    """Create the index if needed, filling it from `db` when it is new; sets `enabled`"""
+    global enabled
+    enabled = supported(bind)
+    if not enabled or inspect(bind).has_table(TABLE):
+        return enabled
+
+    with bind.begin() as conn:
+        # '_' joins the owner prefix to the word, so it must not split tokens
+        conn.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE {TABLE} USING fts5(description, person_name, category, "
+            "tokenize=\"unicode61 remove_diacritics 2 tokenchars '_'\")"
+        )
+        conn.exec_driver_sql(f"INSERT INTO {TABLE} ({TABLE}, rank) VALUES ('rank', '{RANK}')")
+    if db is not None:
+        rebuild(db)
+    return True
+
+
+def _row(user_id, transaction_id, description, person_name, category):
+    return {
+        'rowid': transaction_id,
+        'description': terms(user_id, description),
+        'person_name': terms(user_id, person_name),
+        'category': terms(user_id, category),
+    }
+
+
+def record(db, user_id, transactions):
+    """Index a user's new transactions: flushed Transaction objects, or insert dicts with their 'id'"""
+    if not enabled or not transactions:
+        return
+    names = {category.id: category.name for category in refdata.categories(db, user_id)}
+    rows = []
+    for t in transactions:
+        if not isinstance(t, dict):
+            t = {name: getattr(t, name) for name in ('id', 'description', 'person_name', 'category_id')}
+        rows.append(_row(user_id, t['id'], t['description'], t['person_name'], names.get(t['category_id'])))
+    db.execute(insert(search_table), rows)
+
+
+def unrecord(db, ids):
+    """Drop transactions (a list of ids or a SELECT of them) from the index"""
+    if enabled:
+        db.execute(delete(search_table).where(search_table.c.rowid.in_(ids)))
+
+
+def _source(*conditions):
+    return select(Transaction.user_id, Transaction.id, Transaction.description, Transaction.person_name,
+                  Category.name)\
+        .outerjoin(Category, Category.id == Transaction.category_id)\
+        .where(*conditions)
+
+
+def refresh(db, *conditions):
+    """Re-index the transactions matching `conditions`, e.g. after their category changed"""
+    if not enabled:
+        return
+    rows = db.execute(_source(*conditions)).all()
+    unrecord(db, [row.id for row in rows])
+    if rows:
+        db.execute(insert(search_table), [_row(*row) for row in rows])
+
+
+def rebuild(db, user_id=None):
+    """Regenerate the index (for one user or everyone) from transactions"""
+    if user_id is None:
+        db.execute(delete(search_table))
+        source = _source()
+    else:
+        unrecord(db, select(Transaction.id).where(Transaction.user_id == user_id))
+        source = _source(Transaction.user_id == user_id)
+
+    result = db.execute(source.execution_options(yield_per=BATCH_SIZE))
+    for partition in result.partitions():
+        db.execute(insert(search_table), [_row(*row) for row in partition])
+    db.execute(text(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')"))
+    db.commit()
+
+
+def verify(db, user_id=None):
+    """Return a list of (what, transaction_id) for every index row that is missing, extra or out of date"""
+    source = _source() if user_id is None else _source(Transaction.user_id == user_id)
+    expected = {}
+    for row in db.execute(source):
+        values = _row(*row)
+        expected[values['rowid']] = (values['description'], values['person_name'], values['category'])
+
+    query = select(search_table.c.rowid, search_table.c.description, search_table.c.person_name,
+                   search_table.c.category)
+    if user_id is not None:
+        query = query.where(search_table.c.rowid.in_(select(Transaction.id).where(Transaction.user_id == user_id)))
+    actual = {row[0]: tuple(row[1:]) for row in db.execute(query)}
+
+    problems = [('missing', id_) for id_ in sorted(expected.keys() - actual.keys())]
+    problems += [('extra', id_) for id_ in sorted(actual.keys() - expected.keys())]
+    problems += [('stale', id_) for id_ in sorted(expected.keys() & actual.keys()) if expected[id_] != actual[id_]]
+    return problems
+
+
+# ====================
+# Queries
+# ====================
+def match_expression(user_id, query):
+    """FTS5 MATCH text for a user's search box input, or None when it has no words"""
+    words = _WORD.findall(query.lower())[:MAX_TERMS]
+    if not words:
+        return None
+    return " AND ".join(f'"u{int(user_id)}_{word}"*' for word in words)
+
+
+def _match(expression):
+    # Input without any words matches nothing
+    if expression is None:
+        return false()
+    return literal_column(TABLE).op("MATCH")(expression)
+
+
+def matching_ids(user_id, query):
+    """SELECT of the ids of a user's transactions matching `query`"""
+    return select(search_table.c.rowid).where(_match(match_expression(user_id, query)))
+
+
+def ranked(user_id, query):
+    """Subquery of (id, score) for a user's matches; a lower score ranks higher"""
+    return select(search_table.c.rowid.label("id"), literal_column("rank").label("score"))\
+        .where(_match(match_expression(user_id, query)))\
+        .subquery()
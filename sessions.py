@@ -0,0 +1,191 @@
+"""Pluggable session storage selected with SESSION_BACKEND.
+
+cookie      Flask's signed cookie; nothing is stored server-side. The session
+            only holds user_id, the active account and the theme, so it fits
+            comfortably in a cookie.
+sqlite      Server-side store in its own SQLite file (SESSION_SQLITE_PATH).
+            Rows carry an expiry and are only written when the session
+            changes; expired rows are swept by `flask sessions sweep` and,
+            with probability SESSION_SWEEP_PROBABILITY, after a request.
+redis       Flask-Session's Redis store at REDIS_URL. Without REDIS_URL the
+            SQLite store stands in, so development needs no Redis server.
+filesystem  The original Flask-Session file store.
+"""
+from datetime import datetime, timezone
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+BACKENDS = ('cookie', 'sqlite', 'redis', 'filesystem')
+DEFAULT_BACKEND = 'sqlite'
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id and whether it was changed"""
+
+    def __init__(self, initial=None, sid=None, new=False, expiry=0.0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expiry = expiry
+        self.modified = False
+
+
+class SqliteSessionStore:
+    """Session rows in a standalone SQLite file, one connection per thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, expiry REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions (expiry)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, sid, now):
+        """(data, expiry) for a live session, or None"""
+        return self._connect().execute(
+            "SELECT data, expiry FROM sessions WHERE id = ? AND expiry > ?", (sid, now)
+        ).fetchone()
+
+    def save(self, sid, data, expiry):
+        self._connect().execute(
+            "INSERT INTO sessions (id, data, expiry) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET data = excluded.data, expiry = excluded.expiry",
+            (sid, data, expiry)
+        )
+
+    def touch(self, sid, expiry):
+        self._connect().execute("UPDATE sessions SET expiry = ? WHERE id = ?", (expiry, sid))
+
+    def delete(self, sid):
+        self._connect().execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def sweep(self, now=None):
+        """Delete expired sessions, returning how many were removed"""
+        cursor = self._connect().execute(
+            "DELETE FROM sessions WHERE expiry <= ?", (time.time() if now is None else now,)
+        )
+        return cursor.rowcount
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class SqliteSessionInterface(SessionInterface):
+    """Server-side sessions kept in a SqliteSessionStore.
+
+    A request that does not change the session costs one indexed read. The
+    expiry is only pushed forward once less than half the lifetime remains,
+    so SESSION_REFRESH_EACH_REQUEST does not turn every page view into a
+    write.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, sweep_probability=0.0):
+        self.store = store
+        self.sweep_probability = sweep_probability
+
+    def _lifetime(self, app):
+        return app.permanent_session_lifetime.total_seconds()
+
+    def open_session(self, app, request):
+        now = time.time()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = self.store.load(sid, now)
+            if row is not None:
+                return ServerSession(self.serializer.loads(row[0]), sid=sid, expiry=row[1])
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            self._maybe_sweep(now)
+            return
+
+        lifetime = self._lifetime(app)
+        expiry = now + lifetime
+        if session.modified or session.new:
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), expiry)
+        elif self.should_set_cookie(app, session) and session.expiry - now < lifetime / 2:
+            self.store.touch(session.sid, expiry)
+        else:
+            self._maybe_sweep(now)
+            return
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=datetime.fromtimestamp(expiry, timezone.utc) if session.permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        self._maybe_sweep(now)
+
+    def _maybe_sweep(self, now):
+        if self.sweep_probability and random.random() < self.sweep_probability:
+            self.store.sweep(now)
+
+
+def sqlite_interface():
+    """Interface over the SQLite store configured in the environment"""
+    store = SqliteSessionStore(os.getenv("SESSION_SQLITE_PATH", "data/sessions.db"))
+    return SqliteSessionInterface(store, float(os.getenv("SESSION_SWEEP_PROBABILITY", 0.001)))
+
+
+def init_session(app, backend=None):
+    """Install the session interface named by `backend` or SESSION_BACKEND"""
+    backend = (backend or os.getenv("SESSION_BACKEND", DEFAULT_BACKEND)).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown SESSION_BACKEND '{backend}', expected one of {', '.join(BACKENDS)}")
+
+    if backend == 'redis' and not os.getenv("REDIS_URL"):
+        backend = 'sqlite'
+
+    if backend == 'sqlite':
+        app.session_interface = sqlite_interface()
+    elif backend in ('redis', 'filesystem'):
+        from flask_session import Session
+        app.config["SESSION_TYPE"] = backend
+        if backend == 'redis':
+            import redis
+            app.config["SESSION_REDIS"] = redis.from_url(os.getenv("REDIS_URL"))
+        Session(app)
+    # 'cookie' keeps Flask's default SecureCookieSessionInterface
+
+    app.config["SESSION_BACKEND"] = backend
+    return backend
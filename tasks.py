@@ -0,0 +1,163 @@
+"""Background job handlers registered with jobs.py.
+
+Each handler runs in a worker thread with its own database session (the
+queue's teardown removes it afterwards) and does what the request handler
+used to do inline: import an uploaded CSV, write an export file, or rebuild
+a user's derived tables. Files handed between requests and jobs live in
+JOBS_FILES_DIR.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from sqlalchemy import func, select
+from cache import dashboard_cache
+from database import get_db
+from models import Transaction
+from queries import parse_transaction_filters, transaction_conditions
+import archive
+import batch
+import budget_states
+import charts
+import export
+import importer
+import jobs
+import ledger
+import refdata
+import rollups
+import search
+import timeseries
+
+FILES_DIR = Path(os.getenv("JOBS_FILES_DIR", "data/job_files"))
+
+
+def file_path(name):
+    """Location of a job file, creating the directory on first use"""
+    FILES_DIR.mkdir(parents=True, exist_ok=True)
+    return FILES_DIR / name
+
+
+def refresh(db, user_id):
+    """Commit, drop the user's cached dashboard and columns and precompute their analytics charts.
+
+    The precompute is best-effort: the job's work is committed by then, and
+    failing it would retry the job (importing a CSV twice). A chart that
+    could not be computed stays stale and is computed on its next read.
+    """
+    charts.mark_stale(db, user_id)
+    db.commit()
+    dashboard_cache.invalidate(user_id)
+    timeseries.invalidate(user_id)
+    try:
+        currency = refdata.currency(db, user_id)
+        for chart in charts.CHARTS:
+            charts.payload(db, user_id, chart, currency)
+    except Exception as e:
+        db.rollback()
+        print(f"Chart precompute for user {user_id} failed: {e}")
+
+
+@jobs.task("import")
+def import_csv(ctx, upload, account_id, dry_run=False):
+    """Import an uploaded CSV; the upload is deleted once it can no longer be retried.
+
+    The result is stored as an idempotency key ("import:<upload>") in the
+    transaction that writes the rows, so a retry after that commit (a
+    crash or lost lease before the job was marked done) returns it
+    instead of importing the file again.
+    """
+    db = get_db()
+    path = file_path(upload)
+    key = f"import:{upload}"
+    try:
+        if not dry_run:
+            # Checked under the write lock, so an attempt still running cannot commit in between
+            ledger.begin(db)
+            done = batch.replay(db, ctx.user_id, key)
+            if done is not None:
+                db.rollback()
+                path.unlink(missing_ok=True)
+                return json.loads(done.response)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as stream:
+            total = -1
+            for line in stream:
+                total += 1
+                digest.update(line)
+            total = max(total, 0)
+            stream.seek(0)
+            result = importer.import_csv(
+                db, ctx.user_id, account_id, stream, dry_run,
+                progress=lambda rows: ctx.progress(rows, total, f"{rows:,} of {total:,} rows")
+            )
+        if not dry_run and not result['errors']:
+            batch.remember(db, ctx.user_id, key, digest.hexdigest(), 200, result)
+            refresh(db, ctx.user_id)
+        else:
+            db.rollback()
+    except Exception:
+        if ctx.last_attempt:
+            path.unlink(missing_ok=True)
+        raise
+    path.unlink(missing_ok=True)
+    return result
+
+
+@jobs.task("export")
+def export_file(ctx, fmt, compress=False, filters=None, batch_size=1000):
+    """Write a filtered export to a file that /jobs/<id>/download serves"""
+    db = get_db()
+    parsed = parse_transaction_filters(filters or {})
+    total = db.execute(
+        select(func.count()).select_from(Transaction).where(*transaction_conditions(ctx.user_id, parsed))
+    ).scalar() + archive.count(db, ctx.user_id, parsed)
+    currency = refdata.currency(db, ctx.user_id)
+
+    written = 0
+
+    def counted(rows):
+        nonlocal written
+        for row in rows:
+            written += 1
+            if written % batch_size == 0:
+                ctx.progress(written, total, f"{written:,} of {total:,} rows")
+            yield row
+
+    rows = counted(export.iter_rows(db, ctx.user_id, parsed, batch_size, currency))
+    encode = export.csv_chunks if fmt == "csv" else export.ndjson_chunks
+    chunks = encode(rows, batch_size)
+    if compress:
+        chunks = export.gzip_chunks(chunks)
+
+    name = f"export-{ctx.job_id}.{fmt}" + (".gz" if compress else "")
+    with open(file_path(name), 'wb') as out:
+        for chunk in chunks:
+            out.write(chunk)
+
+    return {
+        "file": name,
+        "mimetype": "application/gzip" if compress else export.FORMATS[fmt],
+        "rows": written,
+    }
+
+
+@jobs.task("rebuild")
+def rebuild(ctx):
+    """Regenerate a user's rollups, budget states, balances, search index and chart payloads from their transactions"""
+    db = get_db()
+    ctx.progress(0, 5, "Rebuilding monthly totals")
+    rollups.rebuild(db, ctx.user_id)
+    ctx.progress(1, 5, "Rebuilding budgets")
+    budget_states.rebuild(db, ctx.user_id)
+    ctx.progress(2, 5, "Rebuilding balances")
+    ledger.rebuild(db, ctx.user_id)
+    ctx.progress(3, 5, "Rebuilding search index")
+    if search.enabled:
+        search.rebuild(db, ctx.user_id)
+    ctx.progress(4, 5, "Refreshing analytics")
+    refresh(db, ctx.user_id)
+    return {
+        "rollups_ok": not rollups.verify(db, ctx.user_id),
+        "budgets_ok": not budget_states.verify(db, ctx.user_id),
+        "balances_ok": not ledger.verify(db, ctx.user_id),
+    }
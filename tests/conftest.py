@@ -0,0 +1,43 @@
+"""Runs the app against a throwaway data directory: every relative default
+(the database, sessions, job queue, archive) lands in a temporary working
+directory, and no scheduler or job worker threads are started."""
+import itertools
+import os
+from pathlib import Path
+import sys
+import tempfile
+
+import pytest
+
+os.chdir(tempfile.mkdtemp(prefix="fortuna-tests-"))
+os.environ.update(SECRET_KEY="test", RECURRING_INTERVAL="0", JOBS_WORKERS="0")
+os.environ.pop("DATABASE_URL", None)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import app  # noqa: E402
+from database import db_session  # noqa: E402
+from models import User  # noqa: E402
+
+app.config["TESTING"] = True
+_names = itertools.count(1)
+
+
+@pytest.fixture
+def db():
+    yield db_session
+    db_session.remove()
+
+
+@pytest.fixture
+def register():
+    """Register a new user; returns (logged-in test client, user id)"""
+    def make():
+        name = f"user{next(_names)}"
+        client = app.test_client()
+        client.post("/register", data=dict(username=name, password="pw", confirmation="pw", currency="USD"))
+        # The first visit creates the Main Account
+        client.get("/")
+        user_id = db_session.query(User.id).filter_by(username=name).scalar()
+        db_session.remove()
+        return client, user_id
+    return make
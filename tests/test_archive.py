@@ -0,0 +1,116 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.schema import CreateTable
+
+from database import migrate_transaction_ids, transaction_ids_reused
+from models import Account, ArchivedTotal, Base, BalanceSnapshot, MonthlyRollup, Transaction, User
+import archive
+import budget_states
+import ledger
+import rollups
+
+
+def snapshot(db, user_id):
+    """Everything a currency change rescales: the user's rows, derived tables and archive files"""
+    files = {entry.file: archive.path(user_id, entry.file).read_bytes() for entry in archive.years(db, user_id)}
+    state = {
+        'currency': db.query(User.currency).filter_by(id=user_id).scalar(),
+        'transactions': db.query(Transaction.id, Transaction.amount).filter_by(user_id=user_id).order_by(Transaction.id).all(),
+        'accounts': db.query(Account.id, Account.balance, Account.opening_balance).filter_by(user_id=user_id).order_by(Account.id).all(),
+        'rollups': sorted(db.query(MonthlyRollup.account_id, MonthlyRollup.month, MonthlyRollup.category_id,
+                                   MonthlyRollup.type, MonthlyRollup.total).filter_by(user_id=user_id).all()),
+        'snapshots': sorted(db.query(BalanceSnapshot.account_id, BalanceSnapshot.month, BalanceSnapshot.balance)
+                            .filter_by(user_id=user_id).all()),
+        'archived_totals': sorted(db.query(ArchivedTotal.account_id, ArchivedTotal.month, ArchivedTotal.type,
+                                           ArchivedTotal.total).filter_by(user_id=user_id).all()),
+        'files': files,
+        'folder': sorted(path.name for path in (archive.ARCHIVE_DIR / str(user_id)).iterdir()),
+    }
+    db.remove()
+    return state
+
+
+@pytest.mark.parametrize("failing", [rollups, budget_states, ledger])
+def test_failed_currency_change_leaves_archive_and_database_unchanged(db, register, monkeypatch, failing):
+    client, user_id = register()
+    account_id = db.query(Account.id).filter_by(user_id=user_id).scalar()
+    old = date.today().year - archive.KEEP_YEARS - 2
+    entries = [dict(type=trans_type, amount=amount, date=f"{year}-{month:02d}-15", account_id=account_id,
+                    category="Salary" if trans_type == "income" else "Groceries")
+               for year in (old, old + 1, date.today().year)
+               for month, trans_type, amount in ((2, "income", "1000.00"), (5, "expense", "12.35"))]
+    assert client.post("/api/transactions/batch", json=entries).status_code == 201
+    ledger.begin(db)
+    assert archive.run(db, user_id) == {old: 2, old + 1: 2}
+    db.commit()
+    db.remove()
+    before = snapshot(db, user_id)
+
+    # Fail on the way, after rescale_user_money() has rewritten the archive files
+    def broken(db, user_id=None):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(failing, "regenerate", broken)
+    client.post("/change_currency", data=dict(currency="JPY"))
+
+    assert snapshot(db, user_id) == before
+    assert archive.verify(db, user_id) == []
+    assert rollups.verify(db, user_id) == [] and ledger.verify(db, user_id) == []
+
+    # Once the failure is gone the change goes through
+    monkeypatch.undo()
+    client.post("/change_currency", data=dict(currency="JPY"))
+    after = snapshot(db, user_id)
+    assert after['currency'] == "JPY" and after['files'].keys().isdisjoint(before['files'])
+    assert after['folder'] == sorted(after['files'])
+    assert archive.verify(db, user_id) == [] and rollups.verify(db, user_id) == []
+
+
+def test_archiving_the_newest_rows_does_not_free_their_ids(db, register):
+    client, user_id = register()
+    account_id = db.query(Account.id).filter_by(user_id=user_id).scalar()
+    old = date.today().year - archive.KEEP_YEARS - 2
+    entries = [dict(type="expense", amount="5.00", date=f"{old}-03-{day:02d}", account_id=account_id, category="Groceries")
+               for day in (1, 2, 3)]
+    assert client.post("/api/transactions/batch", json=entries).status_code == 201
+    archived = {id for (id,) in db.query(Transaction.id).filter_by(user_id=user_id)}
+    assert max(archived) == db.query(Transaction.id).order_by(Transaction.id.desc()).limit(1).scalar()
+    ledger.begin(db)
+    assert archive.run(db, user_id) == {old: 3}
+    db.commit()
+    db.remove()
+
+    entry = dict(type="expense", amount="1.00", date=date.today().isoformat(), account_id=account_id, category="Groceries")
+    assert client.post("/api/transactions/batch", json=[entry]).status_code == 201
+    (new,) = [id for (id,) in db.query(Transaction.id).filter_by(user_id=user_id)]
+    assert new not in archived and new > max(archived)
+    assert archive.verify(db, user_id) == []
+
+    ledger.begin(db)
+    assert archive.restore(db, user_id, old) == 3
+    db.commit()
+    assert {id for (id,) in db.query(Transaction.id).filter_by(user_id=user_id)} == archived | {new}
+
+
+def test_migration_keeps_ids_and_starts_above_archived_ones(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(engine)
+    transactions = Transaction.__table__
+    # The table as databases created before AUTOINCREMENT have it
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE transactions")
+        conn.exec_driver_sql(str(CreateTable(transactions).compile(engine)).replace(" AUTOINCREMENT", ""))
+        conn.execute(insert(transactions), [dict(user_id=1, amount=100 * i, date=date(2020, 1, i), type="expense")
+                                            for i in (1, 2, 3)])
+    assert transaction_ids_reused(engine)
+
+    migrate_transaction_ids(engine, floor=7)
+    assert not transaction_ids_reused(engine)
+    with engine.begin() as conn:
+        assert conn.execute(select(transactions.c.id, transactions.c.amount).order_by(transactions.c.id)).all() == \
+            [(1, 100), (2, 200), (3, 300)]
+        new = conn.execute(insert(transactions).values(user_id=1, amount=1, date=date(2021, 1, 1), type="expense")
+                           ).inserted_primary_key[0]
+    assert new == 8
+    engine.dispose()
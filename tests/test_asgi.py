@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from app import app
+from asgi import AsyncReads
+from models import Account
+
+
+def get(path, cookie, query=b""):
+    """(status, body) of a GET through a fresh ASGI application"""
+    async def run():
+        application = AsyncReads(app)
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": query,
+                 "headers": [(b"cookie", f"session={cookie}".encode())], "server": ("localhost", 80)}
+        try:
+            await application(scope, receive, send)
+        finally:
+            if application.engine is not None:
+                await application.engine.dispose()
+            await asyncio.to_thread(application.wsgi.executor.shutdown)
+        return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:])
+    return asyncio.run(run())
+
+
+def test_trends_are_served_under_asgi(db, register):
+    client, user_id = register()
+    account_id = db.query(Account.id).filter_by(user_id=user_id).scalar()
+    db.remove()
+    client.post("/add_transaction", data=dict(type="expense", amount="12.50", category="Groceries", account_id=account_id))
+    cookie = client.get_cookie("session").value
+
+    status, body = get("/api/analytics/trends", cookie, b"months=3")
+    assert status == 200
+    payload = json.loads(body)
+    assert payload['chart'] == 'trends' and payload == client.get("/api/analytics/trends?months=3").get_json()
+
+    status, _ = get("/api/analytics/monthly", cookie)
+    assert status == 200
+    status, _ = get("/api/analytics/nonsense", cookie)
+    assert status == 404
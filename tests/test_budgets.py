@@ -0,0 +1,39 @@
+from datetime import date
+import threading
+
+from app import app
+from models import Budget, BudgetState
+import budget_states
+
+
+def test_posting_the_same_budget_twice_keeps_one_budget(db, register):
+    client, user_id = register()
+    for limit in ("100", "150"):
+        assert client.post("/budgets", data=dict(category_id="1", monthly_limit=limit)).status_code == 302
+
+    month = date.today().strftime("%Y-%m")
+    assert db.query(Budget.monthly_limit).filter_by(user_id=user_id, category_id=1, month=month).all() == [(15000,)]
+    assert db.query(BudgetState.monthly_limit).filter_by(user_id=user_id, category_id=1, month=month).all() == [(15000,)]
+    assert budget_states.verify(db, user_id) == []
+
+
+def test_concurrent_submissions_of_a_new_budget(db, register):
+    client, user_id = register()
+    cookie = client.get_cookie("session").value
+    statuses = []
+
+    def submit():
+        other = app.test_client()
+        other.set_cookie("session", cookie)
+        statuses.append(other.post("/budgets", data=dict(category_id="2", monthly_limit="80")).status_code)
+
+    threads = [threading.Thread(target=submit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every request either set the budget or was told to retry; none failed with a 500
+    assert len(statuses) == 4 and set(statuses) <= {302, 409}
+    assert db.query(Budget).filter_by(user_id=user_id, category_id=2).count() == 1
+    assert budget_states.verify(db, user_id) == []
@@ -0,0 +1,38 @@
+import pytest
+
+from models import Account, Budget, RecurringRule, Transaction, User
+import refdata
+
+
+@pytest.fixture
+def stale_usd(db, monkeypatch):
+    """A user switched to JPY whose currency was read as USD before the write lock was taken"""
+    currency = refdata.currency
+
+    def read(db, user_id, for_update=False):
+        return currency(db, user_id, for_update) if for_update else "USD"
+
+    def switch(user_id):
+        db.query(User).filter_by(id=user_id).update({"currency": "JPY"})
+        db.commit()
+        db.remove()
+        monkeypatch.setattr(refdata, "currency", read)
+    return switch
+
+
+def test_writers_parse_amounts_in_the_currency_read_under_the_lock(db, register, stale_usd):
+    client, user_id = register()
+    account_id = db.query(Account.id).filter_by(user_id=user_id).scalar()
+    stale_usd(user_id)
+
+    client.post("/add_transaction", data=dict(type="expense", amount="1050", account_id=account_id, category="Groceries"))
+    client.post("/budgets", data=dict(category_id="1", monthly_limit="20000"))
+    client.post("/recurring", data=dict(type="income", amount="300000", account_id=account_id, category="Salary",
+                                        frequency="monthly", start_date="2999-01-01"))
+    client.post("/create_account", data=dict(account_name="Savings", account_type="savings", initial_balance="5000"))
+
+    assert db.query(Transaction.amount).filter_by(user_id=user_id).scalar() == 1050
+    assert db.query(Budget.monthly_limit).filter_by(user_id=user_id).scalar() == 20000
+    assert db.query(RecurringRule.amount).filter_by(user_id=user_id).scalar() == 300000
+    savings = db.query(Account).filter_by(user_id=user_id, name="Savings").one()
+    assert savings.currency is None and savings.balance == 5000
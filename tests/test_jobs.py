@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+from models import Account, Transaction
+import tasks
+
+CSV = "date,type,amount,category\n" + "".join(f"2025-01-{day:02d},expense,1.50,Groceries\n" for day in range(1, 11))
+
+
+class Crash(BaseException):
+    """The worker process dying: not an Exception, so nothing catches it"""
+
+
+def context(user_id):
+    return SimpleNamespace(user_id=user_id, job_id=1, attempt=1, last_attempt=False,
+                           progress=lambda *args: None)
+
+
+def test_import_retried_after_its_commit_is_not_imported_twice(db, register, monkeypatch):
+    _, user_id = register()
+    account_id = db.query(Account.id).filter_by(user_id=user_id).scalar()
+    db.remove()
+    upload = f"upload-{user_id}-retry.csv"
+    tasks.file_path(upload).write_text(CSV)
+
+    def crash(db, user_id):
+        db.commit()
+        raise Crash()
+    # The rows are committed, then the worker dies before the job is marked done
+    with monkeypatch.context() as patched:
+        patched.setattr(tasks, "refresh", crash)
+        try:
+            tasks.import_csv(context(user_id), upload, account_id)
+        except Crash:
+            pass
+    db.remove()
+    assert db.query(Transaction).filter_by(user_id=user_id).count() == 10
+    assert tasks.file_path(upload).exists()
+    db.remove()
+
+    # The requeued job finds the stored result instead of importing again
+    result = tasks.import_csv(context(user_id), upload, account_id)
+    assert result['imported'] == 10 and result['errors'] == []
+    assert db.query(Transaction).filter_by(user_id=user_id).count() == 10
+    assert not tasks.file_path(upload).exists()
@@ -0,0 +1,54 @@
+from datetime import date, timedelta
+
+from models import Account, RecurringRule, Transaction
+import ledger
+import recurring
+import rollups
+
+
+def add_rule(client, db, user_id, start_date):
+    account_id = db.query(Account.id).filter_by(user_id=user_id).scalar()
+    response = client.post("/recurring", data=dict(
+        type="expense", amount="9.99", account_id=account_id, category="Entertainment",
+        frequency="daily", interval="1", start_date=start_date.isoformat(), description="Streaming"
+    ))
+    assert response.status_code == 302
+    db.remove()
+
+
+def written(db, user_id):
+    return [day for day, in db.query(Transaction.date).filter_by(user_id=user_id).order_by(Transaction.date)]
+
+
+def test_failing_user_does_not_block_the_others(db, register, monkeypatch):
+    today = date.today()
+    (failing_client, failing), (other_client, other) = register(), register()
+    # The failing user's rule is due first, so it is caught up first
+    add_rule(failing_client, db, failing, today + timedelta(days=1))
+    add_rule(other_client, db, other, today + timedelta(days=2))
+
+    catch_up = recurring.catch_up
+
+    def broken(db, user_id, due_rules, today=None):
+        if user_id == failing:
+            raise RuntimeError("broken rule")
+        return catch_up(db, user_id, due_rules, today)
+
+    monkeypatch.setattr(recurring, "catch_up", broken)
+    tick = today + timedelta(days=5)
+    result = recurring.run_due(db, tick)
+
+    assert result['failed'] == 1
+    assert written(db, other) == [today + timedelta(days=n) for n in range(2, 6)]
+    assert written(db, failing) == []
+    rule = db.query(RecurringRule).filter_by(user_id=failing).one()
+    assert rule.occurrences == 0 and rule.next_due == tick + recurring.RETRY_DELAY
+
+    # Backed off: the next tick the same day skips the user instead of failing again
+    assert recurring.run_due(db, tick)['failed'] == 0
+
+    # Once fixed, the retry writes every occurrence missed in between
+    monkeypatch.setattr(recurring, "catch_up", catch_up)
+    recurring.run_due(db, tick + recurring.RETRY_DELAY)
+    assert written(db, failing) == [today + timedelta(days=n) for n in range(1, 7)]
+    assert rollups.verify(db, failing) == [] and ledger.verify(db, failing) == []
@@ -0,0 +1,378 @@
+"""Trend analytics over a user's transactions held as NumPy columns.
+
+load() reads a user's transactions once, archived years (archive.py)
+included, into parallel arrays (Columns) sorted by day: the day as a
+number counted from 1970-01-01, its month number, the amount in minor
+units of the user's currency, a kind code, a compact category code and
+the account id. The columns are cached per user in series_cache; write
+routes drop them with invalidate() after they commit, and other workers
+pick a change up when their entry expires (TIMESERIES_CACHE_TTL). Every
+metric below is array arithmetic over the cached columns: a date range
+is a binary search for a slice, then bincount, cumsum, sorting or least
+squares over that slice, so it costs milliseconds however long the user's
+history.
+
+Amounts of accounts held in another currency are converted per
+transaction at their month's average rate (fx.py). Like the monthly
+chart, income and expense include transfers between the user's own
+accounts; category trends only count categorized transactions.
+"""
+from datetime import date, timedelta
+import os
+import numpy as np
+from sqlalchemy import case, func, select
+from cache import MISSING, TTLCache
+from models import Transaction
+from money import minor_digits
+from queries import epoch_day
+import archive
+import fx
+import refdata
+
+INCOME, EXPENSE, LENT, BORROWED = range(4)
+
+EPOCH = date(1970, 1, 1)
+# Largest months, forecast horizon and rolling window (days) a trends request may ask for
+MAX_MONTHS = 120
+MAX_HORIZON = 24
+MAX_WINDOW = 365
+# Complete months the forecast is fitted on; two seasons or more adds seasonality
+FORECAST_MONTHS = 36
+SEASON = 12
+# Expense categories listed with their trends
+CATEGORY_LIMIT = 10
+
+transactions = Transaction.__table__
+
+# A million transactions take about 25 MB of columns, so only a few users are kept
+series_cache = TTLCache(
+    maxsize=int(os.getenv("TIMESERIES_CACHE_SIZE", 64)),
+    ttl=float(os.getenv("TIMESERIES_CACHE_TTL", 300))
+)
+
+
+class Columns:
+    """One user's transactions as parallel arrays sorted by day.
+
+    Categories are stored as codes into category_ids, whose entry is -1
+    for transactions without a category.
+    """
+
+    __slots__ = ('currency', 'days', 'months', 'amounts', 'kinds', 'codes', 'category_ids', 'accounts')
+
+    def __init__(self, currency, days, amounts, kinds, categories, accounts):
+        order = np.argsort(days, kind='stable')
+        self.currency = currency
+        self.days = days[order]
+        self.months = self.days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+        self.amounts = amounts[order]
+        self.kinds = kinds[order]
+        self.category_ids, codes = np.unique(categories[order], return_inverse=True)
+        # Small integers radix-sort, which keeps percentiles() cheap
+        self.codes = codes.astype(np.int16 if len(self.category_ids) < 2 ** 15 else np.int32)
+        self.accounts = accounts[order]
+
+    def __len__(self):
+        return len(self.days)
+
+    def between(self, first_day, last_day):
+        """Slice of the transactions dated from day number `first_day` to `last_day`"""
+        start, stop = np.searchsorted(self.days, (first_day, last_day + 1))
+        return slice(int(start), int(stop))
+
+    def in_months(self, first, last):
+        """Slice of the transactions from month number `first` to `last`"""
+        return self.between(day_number(month_start(first)), day_number(month_start(last + 1)) - 1)
+
+
+def day_number(day):
+    return (day - EPOCH).days
+
+
+def month_number(day):
+    return (day.year - 1970) * 12 + day.month - 1
+
+
+def month_label(number):
+    """"YYYY-MM" of a month number"""
+    return f"{1970 + number // 12}-{number % 12 + 1:02d}"
+
+
+def month_start(number):
+    """First day of a month number"""
+    return date(1970 + number // 12, number % 12 + 1, 1)
+
+
+# ====================
+# Loading
+# ====================
+def _fetch(db, user_id):
+    """Read a user's transactions into Columns"""
+    kind = case(
+        (transactions.c.type == 'income', INCOME),
+        (transactions.c.type == 'expense', EXPENSE),
+        (transactions.c.direction == 'borrowed', BORROWED),
+        else_=LENT
+    )
+    rows = db.execute(
+        select(
+            epoch_day(transactions.c.date),
+            transactions.c.amount,
+            kind,
+            func.coalesce(transactions.c.category_id, -1),
+            func.coalesce(transactions.c.account_id, -1)
+        ).where(transactions.c.user_id == user_id)
+    ).all()
+    days, amounts, kinds, categories, accounts = zip(*rows) if rows else ((),) * 5
+    parts = [(
+        np.array(days, dtype=np.int32),
+        np.array(amounts, dtype=np.float64),
+        np.array(kinds, dtype=np.int8),
+        np.array(categories, dtype=np.int32),
+        np.array(accounts, dtype=np.int32)
+    )]
+    for year in archive.load(db, user_id):
+        kinds = np.select(
+            [year.type == archive.TYPES.index('income'), year.type == archive.TYPES.index('expense'),
+             year.direction == archive.DIRECTIONS.index('borrowed')],
+            [INCOME, EXPENSE, BORROWED], LENT
+        )
+        parts.append((year.day, year.amount, kinds, year.category_id, year.account_id))
+    days, amounts, kinds, categories, accounts = (np.concatenate(arrays) for arrays in zip(*parts))
+    columns = Columns(
+        refdata.currency(db, user_id),
+        days.astype(np.int32),
+        amounts.astype(np.float64),
+        kinds.astype(np.int8),
+        categories.astype(np.int32),
+        accounts.astype(np.int32)
+    )
+    _, foreign = fx.foreign_accounts(db, user_id)
+    if foreign and len(columns):
+        _convert(columns, foreign, fx.rates(db))
+    return columns
+
+
+def _convert(columns, foreign, rates):
+    """Restate amounts of foreign accounts in the user's currency, in place"""
+    for account_id, source in foreign.items():
+        held = columns.accounts == account_id
+        if not held.any():
+            continue
+        months, index = np.unique(columns.months[held], return_inverse=True)
+        factors = np.array([rates.factor(source, columns.currency, month_label(m)) for m in months.tolist()])
+        columns.amounts[held] = np.round(columns.amounts[held] * factors[index])
+
+
+def load(db, user_id):
+    """A user's Columns, read once and cached until their next write"""
+    key = (user_id,)
+    cached = series_cache.get(key)
+    if cached is MISSING:
+        cached = _fetch(db, user_id)
+        series_cache.set(key, cached)
+    return cached
+
+
+def invalidate(user_id):
+    """Forget a user's cached columns"""
+    series_cache.invalidate(user_id)
+
+
+# ====================
+# Metrics
+# ====================
+def monthly(columns, kind, first, last):
+    """Totals of one kind for every month number from `first` to `last`"""
+    part = columns.in_months(first, last)
+    mask = columns.kinds[part] == kind
+    return np.bincount(columns.months[part][mask] - first, weights=columns.amounts[part][mask],
+                       minlength=last - first + 1)
+
+
+def daily(columns, kind, first, last):
+    """Totals of one kind for every day number from `first` to `last`"""
+    part = columns.between(first, last)
+    mask = columns.kinds[part] == kind
+    return np.bincount(columns.days[part][mask] - first, weights=columns.amounts[part][mask],
+                       minlength=last - first + 1)
+
+
+def by_category(columns, kind, first, last):
+    """Totals of one kind per category and month from `first` to `last`,
+    one row for each of columns.category_ids"""
+    part = columns.in_months(first, last)
+    mask = columns.kinds[part] == kind
+    width = last - first + 1
+    cells = columns.codes[part][mask].astype(np.intp) * width + (columns.months[part][mask] - first)
+    totals = np.bincount(cells, weights=columns.amounts[part][mask], minlength=len(columns.category_ids) * width)
+    return totals.reshape(len(columns.category_ids), width)
+
+
+def rolling_mean(values, window):
+    """Trailing mean over `window` values; NaN until the window is full"""
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    means = np.full(len(values), np.nan)
+    if len(values) >= window:
+        means[window - 1:] = (sums[window:] - sums[:-window]) / window
+    return means
+
+
+def percent_change(values, earlier):
+    """Percent change from `earlier` to `values`; NaN where `earlier` is not positive"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(earlier > 0, (values - earlier) / earlier * 100, np.nan)
+
+
+def change(values, lag):
+    """Percent change from `lag` values earlier, like month over month with lag 1
+    or year over year with lag 12"""
+    earlier = np.full(len(values), np.nan)
+    earlier[lag:] = values[:-lag]
+    return percent_change(values, earlier)
+
+
+def slopes(matrix):
+    """Least-squares slope of every row against its column index"""
+    x = np.arange(matrix.shape[1]) - (matrix.shape[1] - 1) / 2
+    denominator = float(x @ x)
+    if not denominator:
+        return np.zeros(matrix.shape[0])
+    return (matrix - matrix.mean(axis=1, keepdims=True)) @ x / denominator
+
+
+def percentiles(columns, kind, percents, first_day, last_day):
+    """Amounts of single transactions at `percents` per category, one row
+    for each of columns.category_ids (NaN where a category has none).
+
+    Interpolates linearly like np.percentile, for every category at once.
+    """
+    part = columns.between(first_day, last_day)
+    mask = columns.kinds[part] == kind
+    codes = columns.codes[part][mask]
+    amounts = columns.amounts[part][mask]
+    values = np.full((len(columns.category_ids), len(percents)), np.nan)
+    if not len(amounts):
+        return values
+    # Sorted by amount, then stably by category: each category's amounts stay in order
+    by_amount = np.argsort(amounts)
+    codes, amounts = codes[by_amount], amounts[by_amount]
+    by_code = np.argsort(codes, kind='stable')
+    codes, amounts = codes[by_code], amounts[by_code]
+
+    counts = np.bincount(codes, minlength=len(columns.category_ids))
+    starts = np.cumsum(counts) - counts
+    held = counts > 0
+    positions = starts[held, None] + (counts[held, None] - 1) * (np.asarray(percents, dtype=float) / 100)
+    below = np.floor(positions).astype(np.intp)
+    above = np.minimum(below + 1, (starts + counts - 1)[held, None])
+    values[held] = amounts[below] + (amounts[above] - amounts[below]) * (positions - below)
+    return values
+
+
+def forecast(values, horizon, season=SEASON):
+    """The next `horizon` values of a series: a linear trend, plus the average
+    seasonal deviation once the series covers two seasons"""
+    n = len(values)
+    if not n:
+        return np.zeros(horizon)
+    x = np.arange(n)
+    slope, intercept = np.polyfit(x, values, 1) if n > 1 else (0.0, float(values[0]))
+    ahead = np.arange(n, n + horizon)
+    predicted = intercept + slope * ahead
+    if n >= 2 * season:
+        residuals = values - (intercept + slope * x)
+        seasonal = np.bincount(x % season, weights=residuals, minlength=season) / np.bincount(x % season, minlength=season)
+        predicted += seasonal[ahead % season]
+    # Money flows do not go negative
+    return np.maximum(predicted, 0)
+
+
+# ====================
+# Trends payload
+# ====================
+def _rounded(values, digits):
+    """Floats rounded for JSON, NaN as None"""
+    return [None if value != value else value for value in np.round(values, digits).tolist()]
+
+
+def trends(db, user_id, today=None, months=24, horizon=3, window=30):
+    """Monthly flows with rolling averages and changes, category trends,
+    percentiles and a forecast, for the analytics page"""
+    today = today or date.today()
+    columns = load(db, user_id)
+    currency = columns.currency
+    digits = minor_digits(currency)
+    scale = 10 ** digits
+
+    def major(values):
+        return _rounded(np.asarray(values, dtype=float) / scale, digits)
+
+    last = month_number(today)
+    first = last - months + 1
+    # A year more than shown, so the first months have averages and year-over-year changes
+    income = monthly(columns, INCOME, first - SEASON, last)
+    expense = monthly(columns, EXPENSE, first - SEASON, last)
+    net = income - expense
+    shown = slice(SEASON, None)
+
+    end_day = day_number(today)
+    start_day = end_day - 3 * window + 1
+    spending = daily(columns, EXPENSE, start_day - window + 1, end_day)
+
+    # Expense categories ranked by spending over the shown months, with
+    # their monthly slope, the last twelve months against the twelve before
+    # and the median and 90th percentile of a single expense
+    names = {category.id: category.name for category in refdata.categories(db, user_id)}
+    totals = by_category(columns, EXPENSE, min(first, last - 2 * SEASON + 1), last)
+    shown_totals = totals[:, -months:].sum(axis=1)
+    shown_totals[columns.category_ids < 0] = 0
+    yearly = percent_change(totals[:, -SEASON:].sum(axis=1), totals[:, -2 * SEASON:-SEASON].sum(axis=1))
+    trend = slopes(totals[:, -months:])
+    spread = percentiles(columns, EXPENSE, (50, 90), day_number(month_start(first)), end_day)
+    categories = []
+    for i in np.argsort(-shown_totals, kind='stable')[:CATEGORY_LIMIT].tolist():
+        if shown_totals[i] <= 0:
+            break
+        total, slope, median, p90 = major([shown_totals[i], trend[i], spread[i, 0], spread[i, 1]])
+        categories.append({
+            'category': names.get(int(columns.category_ids[i]), "Uncategorized"),
+            'total': total,
+            'trend': slope,
+            'year_change': _rounded(yearly[i:i + 1], 1)[0],
+            'median': median,
+            'p90': p90,
+        })
+
+    # Fitted on complete months only, from the first month with any transactions
+    history_start = min(max(last - FORECAST_MONTHS, int(columns.months[0]) if len(columns) else last), last)
+    history_income = monthly(columns, INCOME, history_start, last - 1)
+    history_expense = monthly(columns, EXPENSE, history_start, last - 1)
+    # The first value predicted is the current month's
+    future_income = forecast(history_income, horizon + 1)[1:]
+    future_expense = forecast(history_expense, horizon + 1)[1:]
+
+    return {
+        'months': [month_label(m) for m in range(first, last + 1)],
+        'income': major(income[shown]),
+        'expense': major(expense[shown]),
+        'net': major(net[shown]),
+        'net_average': major(rolling_mean(net, 3)[shown]),
+        'expense_change': {
+            'month': _rounded(change(expense, 1)[shown], 1),
+            'year': _rounded(change(expense, SEASON)[shown], 1),
+        },
+        'daily': {
+            'days': [(today - timedelta(days=n)).isoformat() for n in range(end_day - start_day, -1, -1)],
+            'window': window,
+            'expense_average': major(rolling_mean(spending, window)[window - 1:]),
+        },
+        'categories': categories,
+        'forecast': {
+            'months': [month_label(m) for m in range(last + 1, last + horizon + 1)],
+            'history': len(history_income),
+            'income': major(future_income),
+            'expense': major(future_expense),
+            'net': major(future_income - future_expense),
+        },
+    }